@@ -9,6 +9,7 @@ import time
 
 import yaml
 
+import porter.journal as journal
 import porter.sensors.sensors_handler as sh
 import porter.threads as threads
 import porter.valon as valon
@@ -74,6 +75,9 @@ signal_to_catch = [
     signal.SIGTERM,
 ]
 
+# Longest time in s to wait for each thread to finish at the end of a run
+JOIN_TIMEOUT = 10
+
 
 def main():
     cfg_name = sys.argv[1]
@@ -92,11 +96,17 @@ def main():
         os.mkdir(home_dir + "/data/" + date + "/sensors_data")
         sensor_path = home_dir + "/data/" + date + "/sensors_data/"
 
+    # Binary journal of the instrument events, decoded with the sensors data
+    journal.start(sensor_path + "events_" + date + ".bin")
+
     for sig in signal_to_catch:
         signal.signal(sig, handler)
 
     time.sleep(1)
 
+    # Threads that journal events, joined before the journal is stopped
+    workers = []
+
     try:
         if "sensors" in config.keys():
             sensor_locks = {}
@@ -117,26 +127,50 @@ def main():
 
             for i in sensor_handler.keys():
                 logging.info(f'Sensor {i} - {sensor_handler[i]}')
-                threads.Sensors(
-                    handler=sensor_handler[i],
-                    sensor_lock=sensor_locks[i],
-                    flag=flag,
-                    date=date,
-                    path=sensor_path,
-                    sensor_name=sensor_names[i],
-                    daemon=False,
-                ).start()
+                workers.append(
+                    threads.Sensors(
+                        handler=sensor_handler[i],
+                        sensor_lock=sensor_locks[i],
+                        flag=flag,
+                        date=date,
+                        path=sensor_path,
+                        sensor_name=sensor_names[i],
+                        daemon=False,
+                    )
+                )
+                workers[-1].start()
 
         if "source" in config.keys():
             synt = valon.Valon(config["source"]["port"], config["source"]["baudrate"])
 
-            synt.set_freq(config["source"]["freq"] / config["source"]["mult_factor"])
-            synt.set_pwr(config["source"]["power"])
+            # The Valon replies once all the settings are applied
             if config["source"]["mod_freq"] > 0:
-                synt.set_amd(config["source"]["mod_amp"], config["source"]["mod_freq"])
+                amd = (config["source"]["mod_amp"], config["source"]["mod_freq"])
             else:
-                synt.set_amd(0, 0)
-            time.sleep(2)
+                amd = (0, 0)
+
+            synt.setup(
+                config["source"]["freq"] / config["source"]["mult_factor"],
+                config["source"]["power"],
+                *amd,
+            )
+
+            if "scan" in config["source"].keys():
+                scan_config = dict(config["source"]["scan"])
+                scan_config.setdefault("power", config["source"]["power"])
+                scan_config.setdefault("mult_factor", config["source"]["mult_factor"])
+
+                workers.append(
+                    threads.Scan(
+                        synt=synt,
+                        handler=sensor_handler[scan_config["adc"]],
+                        flag=flag,
+                        config=scan_config,
+                        filename=home_dir + "/data/" + date + "/spectrum",
+                        daemon=True,
+                    )
+                )
+                workers[-1].start()
 
         if "camera" in config.keys() and not config["local_development"]:
 
@@ -193,16 +227,27 @@ def main():
                     fps = None
                     frames = None
 
-                threads.Camera(
-                    camera=camera,
-                    flag=flag,
-                    mode=config["camera"]["mode"],
-                    camera_name=config["camera"]["name"],
-                    fps=fps,
-                    frames=frames,
-                    duration=duration,
-                    daemon=True,
-                ).start()
+                # Length of the video segments and gap between them in s
+                chunk = config["camera"].get("chunk", 30 * 60)
+                gap = config["camera"].get("gap", 0.0)
+
+                workers.append(
+                    threads.Camera(
+                        camera=camera,
+                        flag=flag,
+                        mode=config["camera"]["mode"],
+                        camera_name=config["camera"]["name"],
+                        fps=fps,
+                        frames=frames,
+                        duration=duration,
+                        chunk=chunk,
+                        gap=gap,
+                        daemon=True,
+                    )
+                )
+                workers[-1].start()
+
+                camera_thread = workers[-1]
 
                 time.sleep(2)
 
@@ -233,16 +278,29 @@ def main():
         logger.info(f"Flag has been raise")
         if flag.is_set():
             logger.info(f"CASE 1")
-            if "camera" in config.keys() and not config["local_development"]:
-                try:
-                    camera.close_usb_connection()
-                except UnboundLocalError:
-                    pass
         else:
             flag.set()
             logger.info(f"CASE 2")
-            if "camera" in config.keys() and not config["local_development"]:
+
+        if "camera" in config.keys() and not config["local_development"]:
+            try:
+                # The camera thread stops the last video segment before the
+                # connection is closed
+                camera_thread.join(timeout=JOIN_TIMEOUT)
                 camera.close_usb_connection()
+            except UnboundLocalError:
+                pass
+
+    finally:
+        # The threads journal their last events, e.g. the closing of the
+        # sensors, when they stop, so the journal is stopped after them
+        flag.set()
+        for worker in workers:
+            worker.join(timeout=JOIN_TIMEOUT)
+            if worker.is_alive():
+                logger.warning(f"{worker.name} still running, its last events are lost")
+
+        journal.stop()
 
 
 if __name__ == "__main__":
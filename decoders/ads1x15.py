@@ -1,9 +1,16 @@
 import argparse
+import contextlib
 import os
-import struct
+import sys
 
 import numpy as np
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import porter.pyramid as pyramid
+import porter.sensors.ads1015_utils as ads
+import porter.sensors.metadata as metadata
+import porter.writers as writers
+
 
 def main():
 
@@ -14,7 +21,7 @@ def main():
     parser.add_argument(
         "--voltage",
         default=False,
-        help="Flag to indicate that the ADC data are saved as voltage",
+        help="Deprecated and ignored, the ADC data are always saved as voltage",
     )
 
     parser.add_argument(
@@ -23,47 +30,106 @@ def main():
         help="Flag to plot the data",
     )
 
+    parser.add_argument(
+        "--format",
+        default="csv",
+        choices=list(writers.WRITERS.keys()),
+        help="Output format, npy saves a folder with a file for each column",
+    )
+
     args = parser.parse_args()
     print(args)
 
-    string = args.path.split("/")
+    if args.voltage:
+        print("--voltage is deprecated and ignored, the data are always in volts")
 
-    filepath = "/".join(string[:-1])
+    decode(args.path, plot=args.plot, fmt=args.format)
 
-    if not os.path.exists(filepath + "/decoded"):
-        os.mkdir(filepath + "/decoded")
 
-    if args.voltage:
-        pattern = "dqf"
-    else:
-        pattern = "di"
+def decode(path, plot=False, fmt="csv", chunk_size=1 << 20, start=0):
+    """Decode an ADC binary file into the decoded folder next to it
 
-    with open(args.path, "rb") as fstream:
-        data = fstream.read()
+    When start is not zero, only the records after this byte offset are
+    decoded and appended to the existing output.
 
-    reps = int(len(data) / 20)
+    Return:
+        end (int): offset after the last decoded record
+    """
 
-    vals = struct.unpack("<" + pattern * reps, data)
+    string = path.split("/")
 
-    final = np.reshape(np.array(vals), (reps, 3))
+    filepath = "/".join(string[:-1])
 
-    decoded_filename = filepath + "/decoded/" + string[-1][:-4] + ".csv"
+    if not os.path.exists(filepath + "/decoded"):
+        os.mkdir(filepath + "/decoded")
 
-    if args.plot:
+    size = os.path.getsize(path)
+
+    trailing = size % ads.RECORD.itemsize
+    if trailing > 0 and start == 0:
+        print(f"Skipped {trailing} bytes of a partial record at the end of {path}")
+
+    decoded_filename = filepath + "/decoded/" + string[-1][:-4]
+
+    info = metadata.load(path)
+
+    # The markers of the step boundaries of a scan are saved separately
+    markers = None
+
+    with contextlib.ExitStack() as stack:
+        writer = stack.enter_context(
+            writers.open_writer(
+                decoded_filename, fmt=fmt, metadata=info, append=start > 0
+            )
+        )
+        for records in ads.iter_records(
+            path, chunk_size=chunk_size, start=start // ads.RECORD.itemsize
+        ):
+            records, marks = ads.split_markers(records)
+            writer.write({i: records[i] for i in ads.RECORD.names})
+
+            if marks["time"].size > 0:
+                if markers is None:
+                    markers = stack.enter_context(
+                        writers.open_writer(
+                            decoded_filename + "_markers",
+                            fmt=fmt,
+                            metadata=info,
+                            append=start > 0,
+                        )
+                    )
+                markers.write(marks)
+
+    final = ads.open_records(path)
+
+    # Min/max/mean pyramid used to plot long recordings
+    pyramid_filename = decoded_filename + ".pyramid"
+    if (start == 0 or plot) and not pyramid.is_current(pyramid_filename, final.size):
+        pyramid.build(pyramid_filename, final["time"], final["value"])
+
+    if plot and final.size == 0:
+        print(f"No data to plot in {path}")
+    elif plot:
         import matplotlib.pyplot as plt
 
-        plt.plot(final[:, 0] - final[0, 0], final[:, 2])
+        pyramid.plot(
+            pyramid.Pyramid(pyramid_filename, final["time"], final["value"]),
+            offset=final["time"][0],
+        )
         plt.xlabel("Time (s)")
         plt.ylabel("Amplitude")
         plt.show()
-        plt.hist(final[:, 1]/1e9, bins=10)
-        plt.hist(np.diff(final[:, 0] - final[0, 0]), bins=10)
+
+        final = final[~ads.is_marker(final)]
+
+        plt.hist(final["read_time"] / 1e9, bins=10)
+        plt.hist(np.diff(final["time"] - final["time"][0]), bins=10)
         plt.show()
-        
-        print(f'Mean Reading Time: {np.mean(final[:, 1]/1e9)}')
-        print(f'Mean Time Samples: {np.mean(np.diff(final[:, 0] - final[0, 0]))}')
 
-    np.savetxt(decoded_filename, final)
+        print(f"Mean Reading Time: {np.mean(final['read_time']/1e9)}")
+        print(f"Mean Time Samples: {np.mean(np.diff(final['time']))}")
+
+    return size - trailing
 
 
 if __name__ == "__main__":
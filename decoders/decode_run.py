@@ -0,0 +1,224 @@
+import argparse
+import concurrent.futures
+import importlib
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import porter.sensors.metadata as metadata
+import porter.writers as writers
+from porter.reader import detect
+
+# Decoder module in this folder for each sensor type
+DECODERS = {
+    "gps": "ubx",
+    "inclinometer": "kernel",
+    "adc": "ads1x15",
+    "journal": "events",
+    "level": "level",
+}
+
+
+def decode(filename, sensor_type, incremental=False, fmt="csv"):
+    """Decode a single file and return the bytes decoded and the time taken
+
+    All the decoders write the same output format fmt, one of writers.WRITERS.
+
+    In incremental mode only the data after the offset saved in the
+    checkpoint of the file are decoded and appended to the outputs, then the
+    checkpoint is moved to the end of the last complete record or frame.
+    """
+
+    decoder = importlib.import_module(DECODERS[sensor_type])
+
+    start = 0
+    if incremental:
+        checkpoint = metadata.load_checkpoint(filename)
+        # A file smaller than at the last decoding has been replaced
+        if checkpoint.get("size", 0) <= os.path.getsize(filename):
+            start = checkpoint.get("offset", 0)
+
+    t0 = time.perf_counter()
+    end = decoder.decode(filename, fmt=fmt, start=start)
+    elapsed = time.perf_counter() - t0
+
+    if incremental:
+        metadata.save_checkpoint(
+            filename, {"offset": end, "size": os.path.getsize(filename)}
+        )
+
+    return end - start, elapsed
+
+
+def scan(path, verbose=True):
+    """Find the sensor data files in a folder and their sensor type"""
+
+    files = {}
+
+    for i in sorted(os.listdir(path)):
+        filename = path + "/" + i
+        if not os.path.isfile(filename) or i.endswith(".yml") or i.endswith(".log"):
+            continue
+
+        sensor_type = detect(filename)
+
+        if sensor_type is None:
+            if verbose:
+                print(f"Skipped {i}: unknown sensor type")
+        else:
+            files[filename] = sensor_type
+
+    return files
+
+
+def follow(path, workers, interval=2.0, fmt="csv"):
+    """Decode the new data of the files of a run while they are written
+
+    The folder is polled every interval seconds and only the files that
+    grew since the previous poll are decoded, starting from their
+    checkpoint. Stop with Ctrl+C.
+    """
+
+    sizes = {}
+    verbose = True
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        while True:
+            t0 = time.perf_counter()
+
+            files = scan(path, verbose=verbose)
+            verbose = False
+
+            futures = {}
+            for filename in files.keys():
+                size = os.path.getsize(filename)
+                if size != sizes.get(filename):
+                    future = pool.submit(decode, filename, files[filename], True, fmt)
+                    futures[future] = (filename, size)
+
+            for future in concurrent.futures.as_completed(futures):
+                filename, sizes[filename] = futures[future]
+                try:
+                    size, dt = future.result()
+                except Exception as err:
+                    print(f"Failed {os.path.basename(filename)}: {err!r}")
+                    continue
+
+                if size > 0:
+                    print(
+                        f"{os.path.basename(filename)}: {size / 1e3:.1f} kB "
+                        f"decoded in {dt:.2f} s"
+                    )
+
+            time.sleep(max(0, interval - (time.perf_counter() - t0)))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Decode all the data of a run.")
+
+    parser.add_argument(
+        "path", type=str, help="Path with the sensors data of the run to be decoded"
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of processes, by default the number of cores available",
+    )
+
+    parser.add_argument(
+        "--incremental",
+        default=False,
+        action="store_true",
+        help="Decode only the data added since the last incremental decoding",
+    )
+
+    parser.add_argument(
+        "--follow",
+        default=False,
+        action="store_true",
+        help="Keep decoding the new data while the files are written",
+    )
+
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=2.0,
+        help="Polling interval in seconds of the follow mode",
+    )
+
+    parser.add_argument(
+        "--format",
+        default="csv",
+        choices=list(writers.WRITERS.keys()),
+        help="Output format of all the decoders",
+    )
+
+    args = parser.parse_args()
+
+    path = os.path.abspath(os.path.expanduser(args.path))
+
+    if args.workers is not None:
+        workers = args.workers
+    elif getattr(os, "sched_getaffinity", None) is not None:
+        workers = len(os.sched_getaffinity(0))
+    else:
+        # sched_getaffinity is only available on Linux
+        workers = os.cpu_count() or 1
+
+    if not os.path.exists(path + "/decoded"):
+        os.mkdir(path + "/decoded")
+
+    if args.follow:
+        try:
+            follow(path, workers, interval=args.interval, fmt=args.format)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    files = scan(path)
+
+    # Largest files first so that they do not end up running alone
+    order = sorted(files.keys(), key=os.path.getsize, reverse=True)
+
+    results = {}
+
+    t0 = time.perf_counter()
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(
+                decode, i, files[i], incremental=args.incremental, fmt=args.format
+            ): i
+            for i in order
+        }
+
+        for future in concurrent.futures.as_completed(futures):
+            filename = futures[future]
+            try:
+                results[filename] = future.result()
+            except Exception as err:
+                print(f"Failed {os.path.basename(filename)}: {err!r}")
+
+    elapsed = time.perf_counter() - t0
+
+    total = 0
+    for filename in sorted(results.keys()):
+        size, dt = results[filename]
+        total += size
+        print(
+            f"{os.path.basename(filename)} ({files[filename]}): "
+            f"{size / 1e6:.1f} MB in {dt:.2f} s, {size / 1e6 / max(dt, 1e-9):.1f} MB/s"
+        )
+
+    print(
+        f"Decoded {len(results)} files, {total / 1e6:.1f} MB in {elapsed:.2f} s "
+        f"with {workers} processes, {total / 1e6 / max(elapsed, 1e-9):.1f} MB/s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+import argparse
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import porter.journal as journal
+import porter.sensors.metadata as metadata
+import porter.writers as writers
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Decode the journal of the events.")
+
+    parser.add_argument("path", type=str, help="Path with the journal to be decoded")
+
+    parser.add_argument(
+        "--format",
+        default="csv",
+        choices=list(writers.WRITERS.keys()),
+        help="Output format",
+    )
+
+    args = parser.parse_args()
+
+    decode(args.path, fmt=args.format)
+
+
+def decode(path, fmt="csv", start=0):
+    """Decode the journal of a run into the decoded folder next to it
+
+    When start is not zero, only the events after this byte offset are
+    decoded and appended to the existing output.
+
+    Return:
+        end (int): offset after the last decoded event
+    """
+
+    string = path.split("/")
+
+    filepath = "/".join(string[:-1])
+
+    if not os.path.exists(filepath + "/decoded"):
+        os.mkdir(filepath + "/decoded")
+
+    events = journal.load(path, start=start // journal.RECORD.itemsize)
+
+    with writers.open_writer(
+        filepath + "/decoded/" + string[-1][:-4],
+        fmt=fmt,
+        metadata=metadata.load(path),
+        append=start > 0,
+    ) as writer:
+        writer.write({i: events[i] for i in events.dtype.names})
+
+    return (
+        start - start % journal.RECORD.itemsize + events.size * journal.RECORD.itemsize
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -2,38 +2,102 @@ import argparse
 import os
 import sys
 
-import pandas as pd
+import numpy as np
 
-sys.path.append("/home/gabriele/Documents/porter")
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
 import porter.sensors.KERNEL_utils as utils
+import porter.sensors.metadata as metadata
+import porter.writers as writers
 
 
 def main():
 
-    file_to_decode = sys.argv[1]
-
     parser = argparse.ArgumentParser(description="Decode data from the Inclinometer.")
 
     parser.add_argument("path", type=str, help="Path with the data to be decoded")
 
+    parser.add_argument(
+        "--udd",
+        nargs="+",
+        default=None,
+        help="User defined data blocks of the file, when they are not saved in "
+        + "the metadata",
+    )
+
+    parser.add_argument(
+        "--health",
+        default=False,
+        action="store_true",
+        help="Flag to print a summary of the faults in the unit status word",
+    )
+
+    parser.add_argument(
+        "--format",
+        default="csv",
+        choices=list(writers.WRITERS.keys()),
+        help="Output format",
+    )
+
     args = parser.parse_args()
 
-    string = args.path.split("/")
+    decode(args.path, udd=args.udd, health=args.health, fmt=args.format)
+
+
+def decode(path, udd=None, health=False, fmt="csv", start=0):
+    """Decode a KERNEL binary file into the decoded folder next to it
+
+    When start is not zero, only the messages after this byte offset are
+    decoded and appended to the existing output.
+
+    Return:
+        end (int): offset after the last decoded message
+    """
+
+    string = path.split("/")
 
     filepath = "/".join(string[:-1])
 
     if not os.path.exists(filepath + "/decoded"):
         os.mkdir(filepath + "/decoded")
 
-    filename = filepath + "/decoded/" + string[-1][:-4] + ".csv"
+    filename = filepath + "/decoded/" + os.path.splitext(string[-1])[0]
 
     kmsg = utils.KernelMsg()
 
-    dt = kmsg.decode_multi(args.path)
+    info = metadata.load(path)
+
+    if udd is not None:
+        kmsg.add_layout("USER_DEFINED_DATA", utils.udd_layout(udd))
+    elif "layout" in info.keys():
+        kmsg.add_layout(info["mode"], info["layout"])
+
+    if utils.is_pickled(path):
+        chunks = kmsg.iter_decode(utils.convert_pickled(path), start=start)
+    else:
+        chunks = kmsg.iter_decode(path, start=start)
+
+    usw = []
+
+    with writers.open_writer(
+        filename, fmt=fmt, metadata=info, append=start > 0
+    ) as writer:
+        for chunk in chunks:
+
+            if "USW" in chunk.keys():
+                usw.append(chunk["USW"])
+
+            writer.write(chunk)
+
+    if health and len(usw) > 0:
+        health = utils.check_health(np.concatenate(usw))
 
-    dataframe = pd.DataFrame(dt)
+        for key in health.keys():
+            print(
+                f"{key}: {health[key]['samples']} samples in "
+                f"{len(health[key]['intervals'])} fault intervals"
+            )
 
-    dataframe.to_csv(filename, index=False)
+    return kmsg.decoded_offset
 
 
 if __name__ == "__main__":
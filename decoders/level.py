@@ -0,0 +1,63 @@
+import argparse
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import porter.sensors.level_utils as level
+import porter.sensors.metadata as metadata
+import porter.writers as writers
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Decode data from the level.")
+
+    parser.add_argument("path", type=str, help="Path with the data to be decoded")
+
+    parser.add_argument(
+        "--format",
+        default="csv",
+        choices=list(writers.WRITERS.keys()),
+        help="Output format",
+    )
+
+    args = parser.parse_args()
+
+    decode(args.path, fmt=args.format)
+
+
+def decode(path, fmt="csv", chunk_size=1 << 20, start=0):
+    """Decode a level binary file into the decoded folder next to it
+
+    When start is not zero, only the records after this byte offset are
+    decoded and appended to the existing output.
+
+    Return:
+        end (int): offset after the last decoded record
+    """
+
+    string = path.split("/")
+
+    filepath = "/".join(string[:-1])
+
+    if not os.path.exists(filepath + "/decoded"):
+        os.mkdir(filepath + "/decoded")
+
+    with writers.open_writer(
+        filepath + "/decoded/" + string[-1][:-4],
+        fmt=fmt,
+        metadata=metadata.load(path),
+        append=start > 0,
+    ) as writer:
+        for records in level.iter_records(
+            path, chunk_size=chunk_size, start=start // level.RECORD.itemsize
+        ):
+            writer.write(level.decode(records))
+
+    size = os.path.getsize(path)
+
+    return size - size % level.RECORD.itemsize
+
+
+if __name__ == "__main__":
+    main()
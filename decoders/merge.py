@@ -0,0 +1,67 @@
+import argparse
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import porter.align as align
+import porter.writers as writers
+from decode_run import scan
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description="Merge the data of all the sensors of a run on a common time base."
+    )
+
+    parser.add_argument(
+        "path", type=str, help="Path with the sensors data of the run to be merged"
+    )
+
+    parser.add_argument(
+        "--rate", type=float, default=100.0, help="Rate of the time base in Hz"
+    )
+
+    parser.add_argument(
+        "--method",
+        default="asof",
+        choices=["asof", "linear"],
+        help="Last sample before each time (asof) or linear interpolation",
+    )
+
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=None,
+        help="Largest distance in s of the samples used for each time, by "
+        + "default twice the sampling period of each sensor",
+    )
+
+    parser.add_argument(
+        "--format",
+        default="npy",
+        choices=list(writers.WRITERS.keys()),
+        help="Output format",
+    )
+
+    args = parser.parse_args()
+
+    path = os.path.abspath(os.path.expanduser(args.path))
+
+    if not os.path.exists(path + "/decoded"):
+        os.mkdir(path + "/decoded")
+
+    count = align.align_run(
+        scan(path),
+        path + "/decoded/merged",
+        args.rate,
+        method=args.method,
+        fmt=args.format,
+        tolerance=args.tolerance,
+    )
+
+    print(f"Merged {count} samples at {args.rate} Hz in {path}/decoded/merged")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,79 +1,206 @@
 import argparse
+import io
 import os
 import sys
 
-import pandas as pd
+import numpy as np
 from pyubx2.ubxreader import UBXReader
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import porter.sensors.metadata as metadata
+import porter.sensors.ubx_utils as utils
+import porter.writers as writers
+
 
 def read(stream):
     """
     Reads and parses UBX message data from stream.
+    The fields missing from some messages of a type, e.g. the repeated groups
+    of NAV-SAT, are None, so that all the columns have the same length.
     """
 
     data = {}
+    rows = {}
 
     ubr = UBXReader(stream, parsing=True)
 
     for raw_data, parsed_data in ubr:
 
-        tmp = parsed_data.__dict__
-
-        if parsed_data.identity in data.keys():
-            if parsed_data.identity[:3] == "RXM":
-                data[parsed_data.identity] += raw_data
-            else:
-                for i in tmp.keys():
-                    if i[0] != "_":
-                        if i in data[parsed_data.identity].keys():
-                            data[parsed_data.identity][i].append(tmp[i])
-                        else:
-                            data[parsed_data.identity][i] = []
-                            data[parsed_data.identity][i].append(tmp[i])
+        identity = parsed_data.identity
+
+        if identity[:3] == "RXM":
+            if identity not in data.keys():
+                data[identity] = bytearray()
+            data[identity] += raw_data
         else:
-            data[parsed_data.identity] = {}
+            if identity not in rows.keys():
+                rows[identity] = []
+            rows[identity].append(
+                {i: j for i, j in parsed_data.__dict__.items() if i[0] != "_"}
+            )
 
-            if parsed_data.identity[:3] == "RXM":
-                data[parsed_data.identity] = raw_data
-            else:
-                for i in tmp.keys():
-                    if i[0] != "_":
-                        data[parsed_data.identity][i] = []
-                        data[parsed_data.identity][i].append(tmp[i])
+    for identity, values in rows.items():
+        names = list(dict.fromkeys(i for row in values for i in row.keys()))
+        data[identity] = {i: [row.get(i) for row in values] for i in names}
 
     return data
 
 
+def message_columns(data):
+    """Columns of each message type found in the data
+
+    The fields of a message depend on its length, e.g. the number of
+    satellites of NAV-SAT, so one frame of each type and length is parsed.
+    The fields of the longest frame come first.
+    """
+
+    starts, lengths = utils.index_frames(data)
+
+    frames = {}
+    for i in np.argsort(-lengths, kind="stable"):
+        key = (bytes(data[starts[i] + 2 : starts[i] + 4]), lengths[i])
+        if key not in frames:
+            frames[key] = data[starts[i] : starts[i] + lengths[i] + 8].tobytes()
+
+    samples = read(io.BytesIO(b"".join(frames.values())))
+
+    return {i: list(j.keys()) for i, j in samples.items() if i[:3] != "RXM"}
+
+
 def main():
 
     parser = argparse.ArgumentParser(description="Decode data from the UBLOX.")
 
     parser.add_argument("path", type=str, help="Path with the data to be decoded")
 
+    parser.add_argument(
+        "--imu",
+        default=False,
+        action="store_true",
+        help="Flag to save the ESF-RAW and ESF-MEAS IMU data as time series",
+    )
+
+    parser.add_argument(
+        "--format",
+        default="csv",
+        choices=list(writers.WRITERS.keys()),
+        help="Output format",
+    )
+
     args = parser.parse_args()
 
-    string = args.path.split("/")
+    decode(args.path, imu=args.imu, fmt=args.format)
 
-    path = "/".join(string[:-1])
 
-    if not os.path.exists(path + "/decoded"):
-        os.mkdir(path + "/decoded")
+def decode(filename, imu=False, fmt="csv", start=0, chunk_size=1 << 22):
+    """Decode a UBX binary file into the decoded folder next to it
+
+    Only the complete frames are decoded, so that a file still being written
+    can be decoded again later from the returned offset. When start is not
+    zero, only the frames after this byte offset are decoded and appended to
+    the existing output. The file is parsed in chunks of about chunk_size
+    bytes, each one written as a chunk, e.g. a Parquet row group.
 
-    with open(args.path, "rb") as fstream:
-        data = read(fstream)
+    Return:
+        end (int): offset after the last decoded frame
+    """
 
-    for key in data.keys():
+    string = filename.split("/")
 
-        if key[:3] == "RXM":
-            filename = path + "/decoded/" + str(key) + "_" + string[-1][:-4] + ".bin"
-            with open(filename, "wb") as fd:
-                fd.write(data[key])
-        else:
-            filename = path + "/decoded/" + str(key) + "_" + string[-1][:-4] + ".csv"
+    path = "/".join(string[:-1])
 
-            dataframe = pd.DataFrame(data[key])
+    if not os.path.exists(path + "/decoded"):
+        os.mkdir(path + "/decoded")
 
-            dataframe.to_csv(filename, index=False)
+    end = utils.last_frame_end(filename, start=start)
+
+    if end == start:
+        return end
+
+    data = utils._as_buffer(filename)
+
+    info = metadata.load(filename)
+
+    # Columns of each message type, from all the frames to be decoded, so
+    # that the chunks have the same columns
+    columns = message_columns(data[start:end])
+
+    if start > 0:
+        for key in columns.keys():
+            output = path + "/decoded/" + key + "_" + string[-1][:-4]
+            saved = writers.read_columns(output, fmt)
+            if saved is None:
+                continue
+            if not set(columns[key]) <= set(saved):
+                # The new frames have more fields than the existing output,
+                # e.g. more satellites, so the whole file is decoded again
+                print(f"{key}: new fields, {filename} decoded again")
+                return decode(filename, imu=imu, fmt=fmt, chunk_size=chunk_size)
+            columns[key] = saved
+
+    # Outputs of each message type, open for all the chunks
+    outputs = {}
+
+    try:
+        offset = start
+        while offset < end:
+            stop = min(offset + chunk_size, end)
+            if stop < end:
+                # The chunks end after a complete frame
+                stop = offset + (
+                    utils.last_frame_end(data[offset:stop]) or stop - offset
+                )
+
+            chunk = read(io.BytesIO(data[offset:stop].tobytes()))
+
+            for key in chunk.keys():
+                if key[:3] == "RXM":
+                    if key not in outputs.keys():
+                        output = path + "/decoded/" + key + "_" + string[-1][:-4]
+                        outputs[key] = open(
+                            output + ".bin", "ab" if start > 0 else "wb"
+                        )
+
+                    outputs[key].write(chunk[key])
+                    continue
+
+                if key not in outputs.keys():
+                    output = path + "/decoded/" + key + "_" + string[-1][:-4]
+                    outputs[key] = writers.open_writer(
+                        output, fmt=fmt, metadata=info, append=start > 0
+                    )
+
+                extra = set(chunk[key].keys()) - set(columns[key])
+                if len(extra) > 0:
+                    raise ValueError(
+                        f"{key}: fields {sorted(extra)} not in the columns"
+                    )
+
+                count = len(next(iter(chunk[key].values())))
+                outputs[key].write(
+                    {i: chunk[key].get(i, [None] * count) for i in columns[key]}
+                )
+
+            offset = stop
+    finally:
+        for output in outputs.values():
+            output.close()
+
+    if imu:
+        for msg in ["RAW", "MEAS"]:
+            esf = utils.decode_esf(data[start:end], message=msg)
+
+            for key in esf.keys():
+                output = (
+                    path + "/decoded/ESF-" + msg + "_" + key + "_" + string[-1][:-4]
+                )
+
+                with writers.open_writer(
+                    output, fmt=fmt, metadata=info, append=start > 0
+                ) as writer:
+                    writer.write(esf[key])
+
+    return end
 
 
 if __name__ == "__main__":
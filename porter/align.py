@@ -0,0 +1,522 @@
+import logging
+import os
+
+import numpy as np
+
+import porter.journal as journal
+import porter.sensors.ads1015_utils as ads
+import porter.sensors.KERNEL_utils as kernel
+import porter.sensors.level_utils as level
+import porter.sensors.metadata as metadata
+import porter.sensors.sensors_db.compiled as compiled
+import porter.sensors.ubx_utils as ubx
+import porter.writers as writers
+
+logger = logging.getLogger()
+
+# Start of the GPS time scale in unix time and GPS-UTC offset
+GPS_EPOCH = 315964800.0
+GPS_LEAP_SECONDS = 18
+WEEK = 604800.0
+
+
+class Clock:
+
+    def __init__(self, reference=0.0, offset=0.0, drift=0.0):
+        """Linear map from the host clock to the GPS time
+
+        Parameters:
+            reference (float): host time where the offset is measured
+            offset (float): GPS time minus host time at the reference
+            drift (float): rate of change of the offset in s/s
+        """
+
+        self.reference = float(reference)
+        self.offset = float(offset)
+        self.drift = float(drift)
+
+    def __call__(self, t):
+
+        return t + self.offset + self.drift * (t - self.reference)
+
+    @classmethod
+    def from_anchors(cls, host, gps):
+        """Clock aligned on the host and GPS times of the first and last
+        navigation messages"""
+
+        offset = gps[0] - host[0]
+
+        if host[1] > host[0]:
+            drift = (gps[1] - gps[0]) / (host[1] - host[0]) - 1
+        else:
+            drift = 0.0
+
+        return cls(reference=host[0], offset=offset, drift=drift)
+
+    def to_dict(self):
+
+        return {
+            "reference": self.reference,
+            "offset": self.offset,
+            "drift": self.drift,
+        }
+
+
+class Stream:
+
+    def __init__(self, name, chunks, start, stop, tolerance=None):
+        """Time series read in chunks and sampled on a common time base
+
+        Only the samples needed by the following calls to sample are kept in
+        memory, so that the grid has to be sampled in increasing time order.
+
+        Parameters:
+            name (str): prefix of the columns in the merged dataset
+            chunks (iterator): chunks of the series as (time, columns), with
+                               the GPS time of the samples and a dictionary
+                               with an array for each column
+            start (float): GPS time of the first sample
+            stop (float): GPS time of the last sample
+            tolerance (float): largest time in s between a grid point and the
+                               samples used for it, by default twice the
+                               median sampling period
+        """
+
+        self.name = name
+        self.start = start
+        self.stop = stop
+        self.tolerance = tolerance
+
+        self._chunks = iter(chunks)
+        self._done = False
+        self._last = -np.inf
+
+        self.time = np.zeros(0)
+        self.columns = None
+
+        # The first chunk gives the columns and the sampling period
+        self._fill(-np.inf)
+
+    def _fill(self, t_end):
+        """Read chunks until a sample after t_end is available"""
+
+        while not self._done and (self.time.size == 0 or self.time[-1] <= t_end):
+            try:
+                t, columns = next(self._chunks)
+            except StopIteration:
+                self._done = True
+                break
+
+            t = np.asarray(t, dtype=np.float64)
+            if t.size == 0:
+                continue
+
+            # Samples going back in time, e.g. after a step of the host
+            # clock, are dropped to keep the series sorted
+            previous = np.maximum.accumulate(np.concatenate(([self._last], t[:-1])))
+            keep = t > previous
+            self._last = max(self._last, t.max())
+
+            if self.columns is None:
+                self.columns = {
+                    self.name + "_" + i: np.zeros(0) for i in columns.keys()
+                }
+
+            self.time = np.concatenate((self.time, t[keep]))
+            for i in columns.keys():
+                key = self.name + "_" + i
+                self.columns[key] = np.concatenate(
+                    (self.columns[key], np.asarray(columns[i], dtype=np.float64)[keep])
+                )
+
+            if self.tolerance is None and self.time.size > 1:
+                self.tolerance = 2 * float(np.median(np.diff(self.time)))
+
+    def sample(self, grid, method="asof"):
+        """Sample the series on the points of a grid
+
+        Args:
+            grid (np.ndarray): increasing GPS times, after the ones of the
+                               previous call
+            method (str): asof to take the last sample before each point,
+                          linear to interpolate between the samples around it
+
+        Return:
+            sampled (dict): array for each column, NaN where there is no
+                            sample within the tolerance
+        """
+
+        self._fill(grid[-1])
+
+        t = self.time
+        tolerance = np.inf if self.tolerance is None else self.tolerance
+
+        if t.size == 0:
+            return {i: np.full(grid.size, np.nan) for i in self.columns.keys()}
+
+        idx = np.searchsorted(t, grid, side="right") - 1
+        prev = np.clip(idx, 0, t.size - 1)
+
+        sampled = {}
+
+        if method == "asof":
+            valid = (idx >= 0) & (grid - t[prev] <= tolerance)
+
+            for key, value in self.columns.items():
+                sampled[key] = np.where(valid, value[prev], np.nan)
+
+        elif method == "linear":
+            nxt = np.clip(idx + 1, 0, t.size - 1)
+            gap = t[nxt] - t[prev]
+
+            exact = (idx >= 0) & (grid == t[prev])
+            valid = exact | ((idx >= 0) & (idx + 1 < t.size) & (gap <= tolerance))
+
+            weight = np.where(
+                exact | ~valid, 0.0, (grid - t[prev]) / np.where(gap > 0, gap, 1)
+            )
+
+            for key, value in self.columns.items():
+                interp = value[prev] + weight * (value[nxt] - value[prev])
+                sampled[key] = np.where(valid, interp, np.nan)
+
+        else:
+            raise ValueError(f"Unknown sampling method {method}")
+
+        # Samples before the last one used are not needed anymore
+        if idx[-1] > 0:
+            self.time = self.time[idx[-1] :]
+            for key in self.columns.keys():
+                self.columns[key] = self.columns[key][idx[-1] :]
+
+        return sampled
+
+
+def gps_time(tow, week):
+    """Unix time of a GPS time of week"""
+
+    return GPS_EPOCH + week * WEEK + tow - GPS_LEAP_SECONDS
+
+
+def gps_week(tow, reference):
+    """GPS week of a time of week closest to a reference unix time"""
+
+    return round((reference - gps_time(tow, 0)) / WEEK)
+
+
+def tow_to_time(tow, reference):
+    """Unix time of consecutive times of week, starting in the week closest
+    to a reference unix time and unwrapped at the end of each week"""
+
+    rollover = np.concatenate(([0], np.cumsum(np.diff(tow) < -WEEK / 2)))
+
+    return gps_time(tow, gps_week(tow[0], reference) + rollover)
+
+
+def _gps_chunks(data, starts, dtype, scales, week, chunk_size=1 << 16):
+    """GPS time and fields of the messages of a type, decoded from the
+    offsets of their frames, the time of week is unwrapped at the end of
+    each week"""
+
+    last = None
+
+    for i in range(0, starts.size, chunk_size):
+        chunk = ubx.decode_frames(data, starts[i : i + chunk_size], dtype, scales)
+        tow = chunk["iTOW"] / 1e3
+
+        if last is not None:
+            tow = np.concatenate(([last], tow))
+
+        rollover = np.concatenate(([0], np.cumsum(np.diff(tow) < -WEEK / 2)))
+
+        if last is not None:
+            tow, rollover = tow[1:], rollover[1:]
+
+        yield gps_time(tow, week + rollover), chunk
+
+        week += int(rollover[-1])
+        last = tow[-1]
+
+
+def gps_streams(filename, tolerance=None):
+    """Streams with the navigation messages of a UBX file and host clock
+
+    The GPS week, not included in the messages, is the one closest to the
+    host time of the first message. The host clock is aligned on the host
+    and GPS times of the first and last navigation messages, when they are
+    saved in the metadata.
+
+    Return:
+        streams (list): a Stream for each type of navigation message with a
+                        time of week
+        clock (Clock): map from the host clock to the GPS time
+    """
+
+    info = metadata.load(filename)
+
+    host = [info.get("first_time"), info.get("last_time")]
+    reference = host[0] if host[0] is not None else os.path.getmtime(filename)
+
+    # The frames are indexed once and grouped by type
+    data = ubx._as_buffer(filename)
+    starts, lengths = ubx.index_frames(data)
+    ids = (data[starts + 2].astype(np.int64) << 8) | data[starts + 3]
+
+    streams = []
+    first, last = np.inf, -np.inf
+
+    for i in np.unique(ids):
+        msg = compiled.ubx_message(i >> 8, i & 0xFF)
+        if msg is None or msg[1] is None:
+            continue
+
+        name, dtype, scales = msg
+        if not name.startswith("NAV-") or "iTOW" not in dtype.names:
+            continue
+
+        sel = starts[(ids == i) & (lengths == dtype.itemsize)]
+        if sel.size == 0:
+            continue
+
+        offset = 6 + dtype.fields["iTOW"][1]
+        tow = data[(sel + offset)[:, np.newaxis] + np.arange(4)].view("<u4")[:, 0]
+        tow = tow / 1e3
+        week = gps_week(tow[0], reference)
+        times = tow_to_time(tow, reference)
+
+        first, last = min(first, times[0]), max(last, times[-1])
+
+        streams.append(
+            Stream(
+                name,
+                _gps_chunks(data, sel, dtype, scales, week),
+                times[0],
+                times[-1],
+                tolerance=tolerance,
+            )
+        )
+
+    if host[0] is not None and len(streams) > 0:
+        clock = Clock.from_anchors(
+            [host[0], host[1] if host[1] is not None else host[0]], [first, last]
+        )
+    else:
+        logger.warning(f"No host time of the GPS messages in {filename}")
+        clock = Clock()
+
+    return streams, clock
+
+
+def adc_stream(filename, clock, tolerance=None):
+    """Stream with the ADC records, timed by the host clock"""
+
+    records = ads.open_records(filename)
+
+    if records.size == 0:
+        return None
+
+    def chunks():
+        for i in ads.iter_records(filename):
+            i = i[~ads.is_marker(i)]
+            yield clock(i["time"]), {"value": i["value"]}
+
+    name = metadata.load(filename).get("name", "ADC")
+
+    return Stream(
+        name,
+        chunks(),
+        clock(records["time"][0]),
+        clock(records["time"][-1]),
+        tolerance=tolerance,
+    )
+
+
+def level_stream(filename, clock, tolerance=None):
+    """Stream with the polls of the Modbus inclinometer, timed by the host
+    clock"""
+
+    records = level.open_records(filename)
+
+    if records.size == 0:
+        return None
+
+    def chunks():
+        for i in level.iter_records(filename):
+            data = level.decode(i)
+            yield clock(data.pop("time")), data
+
+    name = metadata.load(filename).get("name", "Level")
+
+    return Stream(
+        name,
+        chunks(),
+        clock(records["time"][0]),
+        clock(records["time"][-1]),
+        tolerance=tolerance,
+    )
+
+
+def kernel_stream(filename, clock, tolerance=None):
+    """Stream with the KERNEL messages
+
+    The messages carry no timestamp, so they are spread evenly between the
+    host times of the first and last messages saved in the metadata.
+    """
+
+    info = metadata.load(filename)
+
+    if info.get("first_time") is None:
+        logger.warning(f"No host time of the messages in {filename}")
+        return None
+
+    first = info["first_time"]
+    last = info.get("last_time")
+    frames = info.get("frames", 0)
+
+    if frames > 1 and last > first:
+        period = (last - first) / (frames - 1)
+    elif info.get("rate"):
+        period = 1 / info["rate"]
+    else:
+        logger.warning(f"No rate of the messages in {filename}")
+        return None
+
+    kmsg = kernel.KernelMsg()
+    if "layout" in info.keys():
+        kmsg.add_layout(info["mode"], info["layout"])
+
+    if kernel.is_pickled(filename):
+        filename = kernel.convert_pickled(filename)
+
+    def chunks():
+        count = 0
+        for chunk in kmsg.iter_decode(filename, mode=info.get("mode")):
+            size = next(iter(chunk.values())).size
+            yield clock(first + (count + np.arange(size)) * period), chunk
+            count += size
+
+    return Stream(
+        info.get("name", "KERNEL"),
+        chunks(),
+        clock(first),
+        clock(first + (max(frames, 1) - 1) * period),
+        tolerance=tolerance,
+    )
+
+
+def merge(
+    streams, writer, rate, start=None, stop=None, method="asof", chunk_size=65536
+):
+    """Sample the streams on a common time base and write them together
+
+    Args:
+        streams (list): Stream objects to be merged
+        writer: output with write(columns), see porter.writers
+        rate (float): rate of the time base in Hz
+        start (float): first time of the time base, by default the first
+                       sample of all the streams
+        stop (float): last time of the time base, by default the last sample
+                      of all the streams
+        method (str): asof or linear, see Stream.sample
+        chunk_size (int): number of points of the time base merged at once
+
+    Return:
+        count (int): number of points of the time base
+    """
+
+    if start is None:
+        start = min(i.start for i in streams)
+    if stop is None:
+        stop = max(i.stop for i in streams)
+
+    count = int(np.floor((stop - start) * rate)) + 1
+
+    for i in range(0, count, chunk_size):
+        grid = start + np.arange(i, min(i + chunk_size, count)) / rate
+
+        columns = {"time": grid}
+        for stream in streams:
+            columns.update(stream.sample(grid, method=method))
+
+        writer.write(columns)
+
+    return count
+
+
+def align_run(
+    files,
+    output,
+    rate,
+    method="asof",
+    fmt="npy",
+    tolerance=None,
+    chunk_size=65536,
+):
+    """Merge the data of all the sensors of a run on a common time base
+
+    The time base is the GPS time when a GPS file is available, with the
+    host clock aligned to it, otherwise the host clock.
+
+    Args:
+        files (dict): sensor type (gps, inclinometer, level, adc or journal) of
+                      each data file
+        output (str): name of the merged dataset without extension
+        rate (float): rate of the time base in Hz
+        method (str): asof or linear, see Stream.sample
+        fmt (str): output format, one of porter.writers.WRITERS
+        tolerance (float): largest time in s between a point of the time base
+                           and the samples used for it, by default twice the
+                           sampling period of each stream
+        chunk_size (int): number of points of the time base merged at once
+
+    Return:
+        count (int): number of points of the time base
+    """
+
+    streams = []
+    clock = Clock()
+
+    for filename, sensor_type in files.items():
+        if sensor_type == "gps":
+            gps, clock = gps_streams(filename, tolerance=tolerance)
+            streams += gps
+
+    for filename, sensor_type in files.items():
+        if sensor_type == "adc":
+            stream = adc_stream(filename, clock, tolerance=tolerance)
+        elif sensor_type == "inclinometer":
+            stream = kernel_stream(filename, clock, tolerance=tolerance)
+        elif sensor_type == "level":
+            stream = level_stream(filename, clock, tolerance=tolerance)
+        else:
+            continue
+
+        if stream is not None:
+            streams.append(stream)
+
+    streams = [i for i in streams if i.columns is not None]
+
+    if len(streams) == 0:
+        raise ValueError("No data to be aligned")
+
+    info = {
+        "rate": rate,
+        "method": method,
+        "clock": clock.to_dict(),
+        "streams": {i.name: i.tolerance for i in streams},
+        "files": [os.path.basename(i) for i in files.keys()],
+    }
+
+    # The events of the journal are saved with their time on the time base
+    for filename, sensor_type in files.items():
+        if sensor_type == "journal":
+            events = journal.load(filename)
+
+            columns = {i: events[i] for i in events.dtype.names}
+            columns["time"] = clock(events["time"])
+
+            with writers.open_writer(output + "_events", fmt=fmt) as writer:
+                writer.write(columns)
+
+    with writers.open_writer(output, fmt=fmt, metadata=info) as writer:
+        return merge(streams, writer, rate, method=method, chunk_size=chunk_size)
@@ -0,0 +1,250 @@
+import logging
+import os
+import queue
+import struct
+import threading
+import time
+
+import numpy as np
+
+import porter.sensors.metadata as metadata
+
+logger = logging.getLogger()
+
+# Record of an event: monotonic and wall clock time in ns, index of the event
+# name and of the source in the metadata file, sequence number and two values
+RECORD = np.dtype(
+    [
+        ("mono_ns", "<i8"),
+        ("wall_ns", "<i8"),
+        ("event", "<u2"),
+        ("source", "<u2"),
+        ("seq", "<u4"),
+        ("value", "<f8"),
+        ("extra", "<f8"),
+    ]
+)
+
+_PACK = struct.Struct("<qqHHIdd")
+
+# Events of the instruments, new names are added to the metadata when they
+# are first journaled. The meaning of value and extra depends on the event:
+#   valon_<cmd>: value set, round trip time of the command line in s
+#   capture: trigger latency from its deadline in s, round trip time in s
+#   capture_missed: number of slots skipped, first slot skipped
+#   videocontrol: -, round trip time of the command in s
+#   video_start, video_stop: segment, round trip time of the command in s
+#   video_gap: time in s from the stop of a segment to the next start, segment
+#   config_sent: number of keys, -
+#   config_ack: 1 for ACK and 0 for NAK or no reply, attempt
+#   baudrate: new baudrate, -
+#   scan_step: frequency, step
+EVENTS = [
+    "note",
+    "valon_f",
+    "valon_pwr",
+    "valon_amd",
+    "valon_amf",
+    "valon_sweep",
+    "capture",
+    "videocontrol",
+    "config_sent",
+    "config_ack",
+    "baudrate",
+    "scan_step",
+    "capture_missed",
+    "video_start",
+    "video_stop",
+    "video_gap",
+]
+
+# Journal of the run, see start
+_journal = None
+
+
+class Journal:
+
+    def __init__(self, filename):
+        """Binary journal of the events of a run
+
+        The events are put on a queue by the threads that journal them and
+        written by a single writer thread, so journaling never waits on the
+        file. The names of the events and sources are saved in the metadata
+        file of the journal.
+
+        Parameters:
+            filename (str): name of the binary file of the journal
+        """
+
+        self.filename = filename
+
+        # An existing journal is continued with the same names
+        info = metadata.load(filename)
+
+        self.events = info.get("events", list(EVENTS))
+        self.sources = info.get("sources", [""])
+
+        self._ids = {
+            "event": {j: i for i, j in enumerate(self.events)},
+            "source": {j: i for i, j in enumerate(self.sources)},
+        }
+
+        self._queue = queue.SimpleQueue()
+        self._seq = 0
+        if os.path.exists(filename):
+            self._seq = os.path.getsize(filename) // RECORD.itemsize
+
+        self._fd = open(filename, "ab")
+        self._save_metadata()
+
+        self._thread = threading.Thread(
+            target=self._writer, name="journal", daemon=True
+        )
+        self._thread.start()
+
+    def put(self, event, source="", value=np.nan, extra=np.nan):
+
+        self._queue.put(
+            (time.monotonic_ns(), time.time_ns(), event, source, value, extra)
+        )
+
+    def _id(self, kind, name, names):
+
+        ids = self._ids[kind]
+
+        if name not in ids:
+            ids[name] = len(names)
+            names.append(name)
+            self._save_metadata()
+
+        return ids[name]
+
+    def _save_metadata(self):
+
+        metadata.save(
+            self.filename,
+            {
+                "name": "events",
+                "sensor_info": {"type": "journal"},
+                "events": self.events,
+                "sources": self.sources,
+            },
+        )
+
+    def _writer(self):
+
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            mono, wall, event, source, value, extra = item
+
+            self._fd.write(
+                _PACK.pack(
+                    mono,
+                    wall,
+                    self._id("event", event, self.events),
+                    self._id("source", source, self.sources),
+                    self._seq,
+                    value,
+                    extra,
+                )
+            )
+            self._seq += 1
+
+            if self._queue.empty():
+                self._fd.flush()
+
+        self._fd.close()
+
+    def close(self):
+        """Write the events left in the queue and close the file"""
+
+        self._queue.put(None)
+        self._thread.join()
+
+
+def start(filename):
+    """Start the journal of the run, used by event"""
+
+    global _journal
+
+    if _journal is not None:
+        _journal.close()
+
+    _journal = Journal(filename)
+
+    logger.info(f"Journal of the events in {filename}")
+
+    return _journal
+
+
+def stop():
+    """Close the journal of the run"""
+
+    global _journal
+
+    if _journal is not None:
+        _journal.close()
+        _journal = None
+
+
+def event(name, source="", value=np.nan, extra=np.nan):
+    """Journal an event with the current time, if a journal was started
+
+    Args:
+        name (str): name of the event, see EVENTS
+        source (str): name of the instrument, e.g. the sensor name
+        value (float): main value of the event
+        extra (float): second value of the event
+    """
+
+    if _journal is not None:
+        _journal.put(name, source, value, extra)
+
+
+def load(filename, start=0):
+    """Load a journal as an array
+
+    Args:
+        filename (str): name of the binary file of the journal
+        start (int): index of the first event
+
+    Return:
+        events (np.ndarray): structured array with the wall clock time in s,
+                             the monotonic time in ns, the names of the event
+                             and source and the values of each event
+    """
+
+    info = metadata.load(filename)
+
+    count = max(os.path.getsize(filename) // RECORD.itemsize - start, 0)
+
+    records = np.fromfile(
+        filename, dtype=RECORD, count=count, offset=start * RECORD.itemsize
+    )
+
+    events = np.array(info.get("events", EVENTS))
+    sources = np.array(info.get("sources", [""]))
+
+    data = np.zeros(
+        count,
+        dtype=[
+            ("time", "<f8"),
+            ("mono_ns", "<i8"),
+            ("event", events.dtype),
+            ("source", sources.dtype),
+            ("value", "<f8"),
+            ("extra", "<f8"),
+        ],
+    )
+
+    data["time"] = records["wall_ns"] / 1e9
+    data["mono_ns"] = records["mono_ns"]
+    data["event"] = events[records["event"]]
+    data["source"] = sources[records["source"]]
+    data["value"] = records["value"]
+    data["extra"] = records["extra"]
+
+    return data
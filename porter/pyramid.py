@@ -0,0 +1,299 @@
+import os
+
+import numpy as np
+import yaml
+
+# Bin of a level of the pyramid: time of the first sample and minimum,
+# maximum, mean and number of the samples in the bin
+LEVEL = np.dtype(
+    [
+        ("time", "<f8"),
+        ("min", "<f4"),
+        ("max", "<f4"),
+        ("mean", "<f4"),
+        ("count", "<u4"),
+    ]
+)
+
+
+def _reduce(time, low, high, total, count, factor):
+    """Merge groups of factor consecutive bins"""
+
+    idx = np.arange(0, time.size, factor)
+
+    total = np.add.reduceat(total, idx)
+    count = np.add.reduceat(count, idx)
+
+    level = np.zeros(idx.size, dtype=LEVEL)
+    level["time"] = time[idx]
+    level["min"] = np.fmin.reduceat(low, idx)
+    level["max"] = np.fmax.reduceat(high, idx)
+    level["mean"] = np.where(count > 0, total / np.maximum(count, 1), np.nan)
+    level["count"] = count
+
+    return level
+
+
+def build(filename, time, values, factor=8, min_size=1024, chunk_size=1 << 22):
+    """Build the min/max/mean pyramid of a time series
+
+    Each level has one bin every factor bins of the previous one, down to
+    min_size bins, and is saved as a .npy file that can be memory mapped.
+    The levels are computed in chunks so the series can be a memory map
+    larger than the memory. A series of min_size samples or less is saved
+    at full resolution as level 0.
+
+    Args:
+        filename (str): name of the folder of the pyramid
+        time (np.ndarray): time of the samples
+        values (np.ndarray): value of the samples
+        factor (int): number of bins merged in each bin of the next level
+        min_size (int): smallest number of bins of a level
+        chunk_size (int): number of bins read at once, multiple of factor
+    """
+
+    if not os.path.exists(filename):
+        os.mkdir(filename)
+
+    chunk_size -= chunk_size % factor
+
+    source = None
+    size = values.size
+    levels = 0
+
+    while size > min_size:
+        levels += 1
+        count = -(-size // factor)
+
+        level = np.lib.format.open_memmap(
+            filename + "/level_" + str(levels) + ".npy",
+            mode="w+",
+            dtype=LEVEL,
+            shape=(count,),
+        )
+
+        for i in range(0, size, chunk_size):
+            if source is None:
+                data = np.asarray(values[i : i + chunk_size], dtype=np.float64)
+                valid = ~np.isnan(data)
+                chunk = _reduce(
+                    np.asarray(time[i : i + chunk_size], dtype=np.float64),
+                    data,
+                    data,
+                    np.where(valid, data, 0),
+                    valid.astype(np.uint32),
+                    factor,
+                )
+            else:
+                prev = source[i : i + chunk_size]
+                chunk = _reduce(
+                    prev["time"],
+                    prev["min"],
+                    prev["max"],
+                    np.nan_to_num(prev["mean"] * prev["count"].astype(np.float64)),
+                    prev["count"],
+                    factor,
+                )
+
+            level[i // factor : i // factor + chunk.size] = chunk
+
+        level.flush()
+
+        source = level
+        size = count
+
+    if levels == 0:
+        # One bin for each sample, so the pyramid can be used without them
+        data = np.asarray(values, dtype=np.float64)
+        valid = ~np.isnan(data)
+
+        level = np.lib.format.open_memmap(
+            filename + "/level_0.npy", mode="w+", dtype=LEVEL, shape=(data.size,)
+        )
+        if data.size > 0:
+            level[:] = _reduce(
+                np.asarray(time, dtype=np.float64),
+                data,
+                data,
+                np.where(valid, data, 0),
+                valid.astype(np.uint32),
+                1,
+            )
+        level.flush()
+
+    with open(filename + "/info.yml", "w") as fd:
+        yaml.safe_dump(
+            {"factor": factor, "count": int(values.size), "levels": levels},
+            fd,
+            sort_keys=False,
+        )
+
+
+class Pyramid:
+
+    def __init__(self, filename, time=None, values=None):
+        """Multi-resolution view of a time series saved by build
+
+        Parameters:
+            filename (str): name of the folder of the pyramid
+            time (np.ndarray): time of the full resolution samples, if they
+                               are not given the finest level is the first
+                               one of the pyramid
+            values (np.ndarray): value of the full resolution samples
+        """
+
+        with open(filename + "/info.yml", "r") as fd:
+            info = yaml.safe_load(fd)
+
+        self.factor = info["factor"]
+        self.count = info["count"]
+
+        self.time = time
+        self.values = values
+
+        # Short series are saved at full resolution as level 0
+        self._first = 1
+        if info["levels"] == 0 and os.path.exists(filename + "/level_0.npy"):
+            self._first = 0
+
+        self.levels = [
+            np.load(filename + "/level_" + str(i) + ".npy", mmap_mode="r")
+            for i in range(self._first, info["levels"] + 1)
+        ]
+
+        if len(self.levels) == 0 and time is None:
+            raise ValueError(
+                f"The pyramid {filename} has no level, build it again or give "
+                "the time and values of the samples"
+            )
+
+    def window(self, start=None, stop=None, width=1000):
+        """Data of the finest level with at most 2 * width bins in a window
+
+        Only the bins inside the window are read from the files.
+
+        Args:
+            start (float): first time of the window, by default the start of
+                           the series
+            stop (float): last time of the window, by default the end
+            width (int): number of points to be shown, e.g. the width of the
+                         plot in pixels
+
+        Return:
+            level (int): level used, 0 for the full resolution
+            data (dict): time and min, max and mean of each bin, for the full
+                         resolution min, max and mean are the values
+        """
+
+        candidates = list(enumerate(self.levels, start=self._first))
+        if self.time is not None and self._first > 0:
+            candidates.insert(0, (0, None))
+
+        for level, data in candidates:
+            time = self.time if data is None else data["time"]
+
+            first = 0 if start is None else np.searchsorted(time, start, side="right")
+            last = time.size if stop is None else np.searchsorted(time, stop) + 1
+            # Keep the bin that contains the start of the window
+            first = max(first - 1, 0)
+
+            if last - first <= 2 * width or level == candidates[-1][0]:
+                break
+
+        if data is None:
+            values = np.asarray(self.values[first:last])
+            return level, {
+                "time": np.asarray(self.time[first:last]),
+                "min": values,
+                "max": values,
+                "mean": values,
+            }
+
+        data = np.asarray(data[first:last])
+
+        return level, {i: data[i] for i in ["time", "min", "max", "mean"]}
+
+
+def is_current(filename, count):
+    """Check that a pyramid exists and was built with count samples"""
+
+    if not os.path.exists(filename + "/info.yml"):
+        return False
+
+    with open(filename + "/info.yml", "r") as fd:
+        return yaml.safe_load(fd)["count"] == count
+
+
+def plot(pyramid, start=None, stop=None, ax=None, width=None, offset=0.0, **kwargs):
+    """Plot a window of a time series using the level that fits the axes
+
+    The envelope between minimum and maximum is filled and the mean drawn
+    on top, so that spikes remain visible at every zoom level. The plot is
+    updated with the right level when the axes are zoomed or panned.
+
+    Args:
+        pyramid (Pyramid): pyramid of the series
+        start (float): first time of the window
+        stop (float): last time of the window
+        ax (matplotlib.axes.Axes): axes of the plot, by default the current
+        width (int): number of bins shown, by default the width of the axes
+                     in pixels
+        offset (float): time subtracted from the times shown
+        **kwargs: passed to the plot of the mean
+
+    Return:
+        level (int): level of the pyramid shown first
+    """
+
+    import matplotlib.pyplot as plt
+
+    if ax is None:
+        ax = plt.gca()
+
+    artists = []
+
+    def draw(start, stop):
+
+        for i in artists:
+            i.remove()
+        artists.clear()
+
+        level, data = pyramid.window(
+            start=start,
+            stop=stop,
+            width=width or int(ax.get_window_extent().width),
+        )
+
+        time = data["time"] - offset
+
+        if level > 0:
+            artists.append(
+                ax.fill_between(
+                    time,
+                    data["min"],
+                    data["max"],
+                    step="post",
+                    alpha=0.4,
+                    lw=0,
+                    color=kwargs.get("color"),
+                )
+            )
+            artists.extend(
+                ax.plot(time, data["mean"], drawstyle="steps-post", **kwargs)
+            )
+        else:
+            artists.extend(ax.plot(time, data["mean"], **kwargs))
+
+        return level
+
+    level = draw(start, stop)
+
+    # Same color when the plot is updated
+    kwargs.setdefault("color", artists[-1].get_color())
+
+    ax.set_autoscalex_on(False)
+    ax.callbacks.connect(
+        "xlim_changed", lambda ax: draw(*(np.array(ax.get_xlim()) + offset))
+    )
+
+    return level
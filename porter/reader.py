@@ -0,0 +1,560 @@
+import logging
+import os
+import struct
+
+import numpy as np
+
+import porter.align as align
+import porter.journal as journal
+import porter.sensors.ads1015_utils as ads
+import porter.sensors.KERNEL_utils as kernel
+import porter.sensors.level_utils as level
+import porter.sensors.metadata as metadata
+import porter.sensors.sensors_db.compiled as compiled
+import porter.sensors.ubx_utils as ubx
+
+# Keys in the file names of each sensor type, used when there is no metadata
+NAMES = {
+    "gps": ["zed", "ublox", "ubx", "gps"],
+    "inclinometer": ["kernel", "inc"],
+    "adc": ["ads", "adc"],
+    "journal": ["events"],
+    "level": ["level"],
+}
+
+logger = logging.getLogger()
+
+
+def detect(filename):
+    """Detect the sensor type of a data file
+
+    The type saved in the metadata file is used if available, otherwise the
+    type is guessed from the first bytes of the file and then from its name.
+    """
+
+    info = metadata.load(filename)
+
+    if "sensor_info" in info.keys():
+        sensor_type = info["sensor_info"]["type"].lower()
+        if sensor_type in NAMES.keys():
+            return sensor_type
+
+    with open(filename, "rb") as fd:
+        start = fd.read(64)
+
+    if start[:2] == b"\xb5\x62":
+        return "gps"
+    elif start[:2] == b"\xaa\x55":
+        return "inclinometer"
+    elif len(start) >= 8 and 1e9 < struct.unpack("<d", start[:8])[0] < 1e10:
+        # ADC and level records start with the time.time() of the sample, the
+        # size of the records is found from the time of the second one
+        t0 = struct.unpack("<d", start[:8])[0]
+        for sensor_type, size in [
+            ("adc", ads.RECORD.itemsize),
+            ("level", level.RECORD.itemsize),
+        ]:
+            if len(start) >= size + 8:
+                t1 = struct.unpack("<d", start[size : size + 8])[0]
+                if 0 <= t1 - t0 < 60:
+                    return sensor_type
+        return "adc"
+    elif kernel.is_pickled(filename):
+        # Legacy KERNEL captures, after the time check as 0x80 can also be
+        # the first byte of a time
+        return "inclinometer"
+
+    name = os.path.basename(filename).lower()
+
+    for sensor_type in NAMES.keys():
+        for key in NAMES[sensor_type]:
+            if key in name:
+                return sensor_type
+
+    return None
+
+
+class _Series:
+    """Records of a sensor that are decoded only when selected
+
+    Subclasses provide fields, __len__, _rows to find the rows of a time
+    window and _decode to decode a range of rows.
+    """
+
+    def __repr__(self):
+
+        return f"{type(self).__name__}({self.name!r}, {len(self)} records)"
+
+    def select(self, start=None, stop=None, fields=None):
+        """Decode the records in a time window
+
+        Args:
+            start (float): first time of the window, by default the first
+                           record
+            stop (float): end time of the window (excluded), by default after
+                          the last record
+            fields (list): fields to be decoded, by default all of them
+
+        Return:
+            data (dict): time and an array for each field
+        """
+
+        if fields is None:
+            fields = self.fields
+
+        first, last = self._rows(start, stop)
+
+        return self._decode(first, last, fields)
+
+    def _search(self, time, start, stop):
+
+        first = 0 if start is None else int(np.searchsorted(time, start))
+        last = len(time) if stop is None else int(np.searchsorted(time, stop))
+
+        return first, last
+
+
+class AdcSeries(_Series):
+
+    def __init__(self, filename, info):
+        """ADC samples, memory mapped from the binary file"""
+
+        self.name = info.get("name", os.path.basename(filename))
+        self.metadata = info
+
+        self.records = ads.open_records(filename)
+        self.fields = [i for i in ads.RECORD.names if i != "time"]
+
+    def __len__(self):
+
+        return self.records.size
+
+    @property
+    def time(self):
+        """Host time of each sample, as a view of the file"""
+
+        return self.records["time"]
+
+    def markers(self):
+        """Time and step of the markers written at the steps of a scan"""
+
+        records = self.records[ads.is_marker(self.records)]
+
+        return ads.split_markers(records)[1]
+
+    def _rows(self, start, stop):
+
+        return self._search(self.records["time"], start, stop)
+
+    def _decode(self, first, last, fields):
+
+        records, _ = ads.split_markers(self.records[first:last])
+
+        data = {"time": np.array(records["time"])}
+        for i in fields:
+            data[i] = np.array(records[i])
+
+        return data
+
+
+class LevelSeries(_Series):
+
+    def __init__(self, filename, info):
+        """Polls of the Modbus inclinometer, memory mapped from the binary file"""
+
+        self.name = info.get("name", os.path.basename(filename))
+        self.metadata = info
+
+        self.records = level.open_records(filename)
+        self.fields = list(level.SCALE.keys())
+
+    def __len__(self):
+
+        return self.records.size
+
+    @property
+    def time(self):
+        """Host time of each poll, as a view of the file"""
+
+        return self.records["time"]
+
+    def _rows(self, start, stop):
+
+        return self._search(self.records["time"], start, stop)
+
+    def _decode(self, first, last, fields):
+
+        data = level.decode(self.records[first:last])
+
+        return {i: data[i] for i in ["time"] + list(fields)}
+
+
+class EventSeries(_Series):
+
+    def __init__(self, filename, info):
+        """Events of the journal of the run, see porter.journal"""
+
+        self.name = info.get("name", os.path.basename(filename))
+        self.metadata = info
+
+        self.events = journal.load(filename)
+        self.fields = [i for i in self.events.dtype.names if i != "time"]
+
+    def __len__(self):
+
+        return self.events.size
+
+    @property
+    def time(self):
+        """Wall clock time of each event"""
+
+        return self.events["time"]
+
+    def _rows(self, start, stop):
+
+        return self._search(self.events["time"], start, stop)
+
+    def _decode(self, first, last, fields):
+
+        events = self.events[first:last]
+
+        return {i: events[i] for i in ["time"] + list(fields)}
+
+
+# Header of the KERNEL messages read as a little endian word
+HEADER_WORD = np.frombuffer(kernel.HEADER, "<u2")[0]
+
+
+class KernelSeries(_Series):
+
+    def __init__(self, filename, info):
+        """KERNEL messages, memory mapped from the binary file
+
+        The messages carry no timestamp, their host time is spread evenly
+        between the first and last messages saved in the metadata, or is the
+        index of the message when they are not available.
+        """
+
+        self.name = info.get("name", os.path.basename(filename))
+        self.metadata = info
+
+        # Legacy pickled captures are decoded in memory, nothing is written
+        # next to the raw data
+        if kernel.is_pickled(filename):
+            self._data = np.frombuffer(
+                b"".join(kernel.iter_pickled(filename)), dtype=np.uint8
+            )
+        elif os.path.getsize(filename) > 0:
+            self._data = np.memmap(filename, dtype=np.uint8, mode="r")
+        else:
+            self._data = np.zeros(0, dtype=np.uint8)
+
+        kmsg = kernel.KernelMsg()
+        if "layout" in info.keys():
+            kmsg.add_layout(info["mode"], info["layout"])
+
+        mode = info.get("mode") or kmsg._find_mode(np.asarray(self._data[: 1 << 16]))
+        if mode is None:
+            raise ValueError(f"No valid KERNEL message in {filename}")
+
+        self.mode = mode
+        self.layout = kmsg.layouts[mode]
+        self.dtype = kernel.layout_dtype(self.layout)
+
+        names, scale = kernel.layout_scale(self.layout)
+        self.fields = names
+        self.scale = dict(zip(names, scale))
+
+        self._kmsg = kmsg
+        self._starts = None
+
+        length = self.dtype.itemsize
+        count = self._data.size // length
+
+        # Files written by the framer are a plain array of messages, only the
+        # first and last ones are checked here, the others when selected
+        self._records = None
+        if count > 0 and self._data.size == count * length:
+            records = np.asarray(self._data).view(self.dtype)
+            if np.all(records["_header"][[0, -1]] == HEADER_WORD):
+                self._records = records
+
+        first = info.get("first_time")
+        last = info.get("last_time")
+        frames = info.get("frames", 0)
+
+        if first is not None and frames > 1 and last > first:
+            self._t0, self._period = first, (last - first) / (frames - 1)
+        elif first is not None and info.get("rate"):
+            self._t0, self._period = first, 1 / info["rate"]
+        else:
+            self._t0, self._period = 0.0, 1.0
+
+    def _index(self):
+        """Start of every valid message, found once when the file is not a
+        plain array of messages"""
+
+        if self._starts is None:
+            length = self.dtype.itemsize
+            address = self.layout["Address"]
+            chunk = 65536 * length
+
+            starts = [np.zeros(0, dtype=np.int64)]
+
+            offset = 0
+            while offset + length <= self._data.size:
+                buf = np.asarray(self._data[offset : offset + chunk + length])
+                i = self._kmsg._find_records(buf, address, length)
+                i = i[i < chunk]
+                starts.append(i + offset)
+                offset = offset + chunk if i.size == 0 else offset + int(i[-1]) + length
+
+            self._starts = np.concatenate(starts)
+
+        return self._starts
+
+    def __len__(self):
+
+        if self._records is not None:
+            return self._records.size
+
+        return self._index().size
+
+    @property
+    def time(self):
+        """Host time of each message"""
+
+        return self._t0 + np.arange(len(self)) * self._period
+
+    def _rows(self, start, stop):
+
+        count = len(self)
+
+        first = 0 if start is None else int(np.ceil((start - self._t0) / self._period))
+        last = count if stop is None else int(np.ceil((stop - self._t0) / self._period))
+
+        return min(max(first, 0), count), min(max(last, 0), count)
+
+    def _decode(self, first, last, fields):
+
+        if self._records is not None:
+            records = self._records[first:last]
+            if np.any(records["_header"] != HEADER_WORD):
+                # Not a plain array of messages, the valid ones are indexed
+                self._records = None
+                first, last = min(first, len(self)), min(last, len(self))
+
+        if self._records is None:
+            idx = self._index()[first:last, np.newaxis] + np.arange(self.dtype.itemsize)
+            records = self._data[idx].view(self.dtype)[:, 0]
+
+        data = {"time": self._t0 + np.arange(first, last) * self._period}
+        for i in fields:
+            if self.scale[i] != 1:
+                data[i] = records[i] / self.scale[i]
+            else:
+                data[i] = np.array(records[i])
+
+        return data
+
+
+class UbxSeries(_Series):
+
+    def __init__(self, name, data, starts, dtype, scales, reference):
+        """Messages of a type in a UBX stream"""
+
+        self.name = name
+
+        self._data = data
+        self._starts = starts
+        self._reference = reference
+        self._time = None
+
+        self.dtype = dtype
+        self.fields = [i for i in self.dtype.names if self.dtype[i].kind != "V"]
+
+        self.scale = {i: scales.get(i, 1) for i in self.fields}
+
+    def __len__(self):
+
+        return self._starts.size
+
+    def _records(self, first, last):
+
+        idx = (self._starts[first:last] + 6)[:, np.newaxis] + np.arange(
+            self.dtype.itemsize
+        )
+
+        return self._data[idx].view(self.dtype)[:, 0]
+
+    @property
+    def time(self):
+        """GPS time of each message from iTOW, in unix time"""
+
+        if self._time is None:
+            if "iTOW" not in self.fields:
+                self._time = np.arange(len(self), dtype=np.float64)
+            elif len(self) == 0:
+                self._time = np.zeros(0)
+            else:
+                offset = self.dtype.fields["iTOW"][1] + 6
+                idx = (self._starts + offset)[:, np.newaxis] + np.arange(4)
+                tow = self._data[idx].view("<u4")[:, 0] / 1e3
+                self._time = align.tow_to_time(tow, self._reference)
+
+        return self._time
+
+    def _rows(self, start, stop):
+
+        return self._search(self.time, start, stop)
+
+    def _decode(self, first, last, fields):
+
+        records = self._records(first, last)
+
+        data = {"time": self.time[first:last]}
+        for i in fields:
+            if self.scale[i] != 1:
+                data[i] = records[i] * self.scale[i]
+            else:
+                data[i] = np.array(records[i])
+
+        return data
+
+
+class UbxData:
+
+    def __init__(self, filename, info):
+        """Messages of a UBX file, grouped by type
+
+        The frames are indexed at the first access, then each type of
+        message with a fixed payload is available as a UbxSeries.
+        """
+
+        self.name = info.get("name", os.path.basename(filename))
+        self.metadata = info
+
+        self._data = ubx._as_buffer(filename)
+        self._reference = info.get("first_time") or os.path.getmtime(filename)
+        self._messages = None
+
+    def __repr__(self):
+
+        return f"UbxData({self.name!r}, {list(self.messages.keys())})"
+
+    @property
+    def messages(self):
+        """Series of each type of message in the file"""
+
+        if self._messages is None:
+            starts, lengths = ubx.index_frames(self._data)
+
+            self._messages = {}
+
+            if starts.size == 0:
+                return self._messages
+
+            ids = (self._data[starts + 2].astype(np.int64) << 8) | self._data[
+                starts + 3
+            ]
+
+            for i in np.unique(ids):
+                msg = compiled.ubx_message(i >> 8, i & 0xFF)
+                if msg is None or msg[1] is None:
+                    continue
+
+                name, dtype, scales = msg
+
+                sel = (ids == i) & (lengths == dtype.itemsize)
+                if np.any(sel):
+                    self._messages[name] = UbxSeries(
+                        name, self._data, starts[sel], dtype, scales, self._reference
+                    )
+
+        return self._messages
+
+    def __getitem__(self, name):
+
+        return self.messages[name]
+
+    def keys(self):
+
+        return self.messages.keys()
+
+
+class Run:
+
+    def __init__(self, path):
+        """Data of all the sensors of a run, decoded only when selected
+
+        Parameters:
+            path (str): folder of the run or with the binary files of the
+                        sensors
+        """
+
+        self.path = os.path.abspath(os.path.expanduser(path))
+
+        if os.path.isdir(self.path + "/sensors_data"):
+            self.path = self.path + "/sensors_data"
+
+        self.sensors = {}
+
+        for i in sorted(os.listdir(self.path)):
+            filename = self.path + "/" + i
+            if not os.path.isfile(filename) or not i.endswith(".bin"):
+                continue
+
+            sensor_type = detect(filename)
+            if sensor_type is None:
+                continue
+
+            info = metadata.load(filename)
+            info.setdefault("name", os.path.splitext(i)[0])
+
+            try:
+                sensor = SENSORS[sensor_type](filename, info)
+            except ValueError as err:
+                logger.warning(f"{i} skipped: {err}")
+                continue
+
+            name = info["name"]
+            if name in self.sensors:
+                name = os.path.splitext(i)[0]
+            self.sensors[name] = sensor
+
+    def __repr__(self):
+
+        return f"Run({self.path!r}, {list(self.sensors.keys())})"
+
+    def __getitem__(self, name):
+
+        return self.sensors[name]
+
+    def keys(self):
+
+        return self.sensors.keys()
+
+
+SENSORS = {
+    "adc": AdcSeries,
+    "inclinometer": KernelSeries,
+    "gps": UbxData,
+    "journal": EventSeries,
+    "level": LevelSeries,
+}
+
+
+def open_run(path):
+    """Open the data of a run without decoding them
+
+    Example:
+        run = open_run("data/20260101_120000")  # or its sensors_data folder
+        adc = run["ADS1015"].select(start, stop)
+        pos = run["ZED-F9P"]["NAV-POSLLH"].select(fields=["lat", "lon"])
+
+    Return:
+        run (Run): sensors of the run by name, the ADC and KERNEL as series
+                   and the GPS as a group of series for each message type
+    """
+
+    return Run(path)
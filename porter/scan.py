@@ -0,0 +1,200 @@
+import logging
+import queue
+import threading
+import time
+
+import numpy as np
+
+import porter.journal as journal
+import porter.writers as writers
+
+logger = logging.getLogger()
+
+# Columns of the spectrum table, one row for each step of the scan
+COLUMNS = [
+    "step",
+    "freq",
+    "power",
+    "time",
+    "start",
+    "stop",
+    "count",
+    "mean",
+    "std",
+    "min",
+    "max",
+]
+
+
+def sweep(start, stop, step, power):
+    """Steps of a frequency sweep at a fixed power
+
+    Args:
+        start (float): first frequency
+        stop (float): last frequency, included
+        step (float): frequency step, negative for a downward sweep
+        power (float): output power of the Valon in dBm
+
+    Return:
+        steps (list): (frequency, power) of each step
+    """
+
+    count = int(round((stop - start) / step)) + 1
+
+    return [(start + i * step, power) for i in range(count)]
+
+
+def reduce(step, freq, power, marker, start, stop, values):
+    """Row of the spectrum table with the statistics of a dwell"""
+
+    row = {
+        "step": step,
+        "freq": freq,
+        "power": power,
+        "time": marker,
+        "start": start,
+        "stop": stop,
+        "count": values.size,
+    }
+
+    if values.size > 0:
+        row.update(
+            {
+                "mean": np.mean(values),
+                "std": np.std(values),
+                "min": np.min(values),
+                "max": np.max(values),
+            }
+        )
+    else:
+        row.update({i: np.nan for i in ["mean", "std", "min", "max"]})
+
+    return row
+
+
+class Scan:
+
+    def __init__(self, synt, adc, settle=0.05, dwell=1.0, mult_factor=1):
+        """Host driven scan of the Valon, integrating the ADC at each step
+
+        At each step the frequency and power are sent to the Valon, which
+        replies once they are set, a marker is written in the ADC data and
+        the samples are integrated for the dwell time after the settle time.
+        The statistics of a step are computed by a worker thread while the
+        next step is sent, and the markers allow to reduce the raw data again
+        with ads1015_utils.steps.
+
+        Parameters:
+            synt (valon.Valon): synthesizer
+            adc (ads1015.ADS1015): ADC, with its reading loop running
+            settle (float): time in s skipped after each step
+            dwell (float): integration time in s of each step
+            mult_factor (int): multiplication factor of the frequency chain,
+                               the Valon is set to freq / mult_factor
+        """
+
+        self.synt = synt
+        self.adc = adc
+
+        self.settle = settle
+        self.dwell = dwell
+        self.mult_factor = mult_factor
+
+    def _collect(self, tap, start, stop):
+        """Values of the samples between start and stop
+
+        The samples before start, e.g. taken while the Valon was settling,
+        are discarded. Return when the first sample after stop arrives.
+        """
+
+        values = []
+
+        timeout = max(stop - time.time(), 0) + 1.0
+
+        while True:
+            try:
+                t, value = tap.get(timeout=timeout)
+            except queue.Empty:
+                raise RuntimeError(f"No ADC data from {self.adc.name}")
+
+            if t >= stop:
+                break
+            if t >= start:
+                values.append(value)
+
+        return np.array(values)
+
+    def _reducer(self, jobs, rows, writer):
+
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+
+            row = reduce(*job)
+            rows.append(row)
+
+            if writer is not None:
+                writer.write({i: [row[i]] for i in COLUMNS})
+
+            logger.info(
+                f"Scan step {row['step']}: {row['freq']} {row['mean']:.6g} V "
+                f"({row['count']} samples)"
+            )
+
+    def run(self, steps, output=None, fmt="csv", flag=None):
+        """Run the scan
+
+        Args:
+            steps (list): (frequency, power) of each step, see sweep
+            output (str): name of the spectrum table without extension, the
+                          table is only returned if it is None
+            fmt (str): format of the spectrum table, one of writers.WRITERS
+            flag (threading.Event): stops the scan when it is set
+
+        Return:
+            spectrum (dict): an array for each of COLUMNS
+        """
+
+        tap = self.adc.add_tap()
+
+        writer = None
+        if output is not None:
+            writer = writers.open_writer(output, fmt=fmt)
+
+        rows = []
+        jobs = queue.SimpleQueue()
+
+        worker = threading.Thread(
+            target=self._reducer, args=(jobs, rows, writer), daemon=True
+        )
+        worker.start()
+
+        try:
+            for step, (freq, power) in enumerate(steps):
+                if flag is not None and flag.is_set():
+                    logger.info(f"Scan stopped at step {step}")
+                    break
+
+                # The Valon replies once the settings are applied
+                self.synt.set_freq_pwr(freq / self.mult_factor, power)
+
+                marker = self.adc.mark(step)
+                journal.event("scan_step", self.adc.name, freq, step)
+
+                start = marker + self.settle
+                stop = start + self.dwell
+
+                values = self._collect(tap, start, stop)
+
+                jobs.put((step, freq, power, marker, start, stop, values))
+        finally:
+            jobs.put(None)
+            worker.join()
+
+            self.adc.remove_tap(tap)
+
+            if writer is not None:
+                writer.close()
+
+        return {i: np.array([row[i] for row in rows]) for i in COLUMNS}
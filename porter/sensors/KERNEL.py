@@ -1,10 +1,12 @@
 import copy
 import logging
+import math
 import pickle
 import time
 
 import serial
 
+import porter.journal as journal
 import porter.sensors.KERNEL_utils as utils
 import porter.sensors.sensors_db.KERNEL as Kdb
 
@@ -20,33 +22,111 @@ class KernelInertial:
 
         self.__first_msg = True
 
-        self.conn = serial.Serial(port, baudrate=baudrate, timeout=1)
+        self.framer = utils.KernelFramer()
+
+        self.decoder = utils.KernelMsg()
+        self.first_time = None
+        self.last_values = None
+        self.last_time = None
+
+        self.rate = None
+
+        self.metadata = {}
+
+        # Serial-like connection given by the caller, e.g. a replay
+        self.conn = kwargs.get("conn") or serial.Serial(
+            port, baudrate=baudrate, timeout=1
+        )
 
         self.name = kwargs.get("name", "Generic Kernel")
 
         if self.conn.is_open:
             logger.info(f"Connected to KERNEL sensor {self.name}")
 
-    def _check_rate(self, mode):
+    def _message_length(self, mode):
+        """Length of the output messages of a mode, None for the modes
+        without output messages, e.g. STOP"""
+
+        layout = self.decoder.layouts.get(mode)
+
+        if layout is None:
+            return None
 
-        length = Kdb.MODES[mode]["length"] + 8
-        bits_per_sample = 11
+        return utils.layout_dtype(layout).itemsize
 
-        rate_max = self.baudrate / bits_per_sample / length
+    def _check_rate(self, mode, baudrate=None):
+        """Maximum rate of the messages of a mode that fits in the serial link,
+        None if the mode has no output messages"""
 
-        rate_max = int(5 * round(rate_max / 5))
+        if baudrate is None:
+            baudrate = self.baudrate
+
+        length = self._message_length(mode)
+
+        if length is None:
+            return None
+
+        rate_max = baudrate / Kdb.BITS_PER_BYTE / length
+
+        rate_max = int(5 * math.floor(rate_max / 5))
 
         return rate_max
 
-    def payload_cmds(self, mode):
+    def _plan_rate(self, mode, rate=None, strict=False):
+        """Check that the requested output rate fits in the serial link
+
+        If the rate would overflow the link, the lowest supported baudrate that
+        can carry it is reported and either a warning is logged or, if strict,
+        the configuration is refused. The rate is not sent to the device, so
+        it is not limited here.
+
+        Args:
+            mode (str): mode of the messages
+            rate (float): requested output rate in Hz
+            strict (bool): if True, raise an error when the link overflows
+
+        Return:
+            rate (float): requested output rate in Hz
+        """
+
+        rate_max = self._check_rate(mode)
+
+        if rate_max is None:
+            return rate
+
+        logger.info(
+            f"{self.name}: {self._message_length(mode)} bytes per message, "
+            f"maximum rate {rate_max} Hz @ {self.baudrate}"
+        )
+
+        if rate is None or rate <= rate_max:
+            return rate
+
+        baudrates = [i for i in Kdb.BAUDRATES if self._check_rate(mode, i) >= rate]
+
+        if len(baudrates) > 0:
+            msg = f"{mode} @ {rate} Hz requires at least {baudrates[0]} baud"
+        else:
+            msg = f"{mode} @ {rate} Hz overflows the link at any baudrate"
+
+        if strict:
+            raise ValueError(msg)
+
+        logger.warning(
+            f"{msg}, the link will overflow above {rate_max} Hz @ {self.baudrate}"
+        )
+
+        return rate
+
+    def payload_cmds(self, mode, payload=b""):
 
         msg = (
             utils.HEADER
             + b"\x00"
             + b"\x00"
-            + b"\x07"
-            + b"\x00"
+            + (7 + len(payload)).to_bytes(2, byteorder="little")
             + Kdb.MODES[mode]["Address"]
+            + payload
         )
 
         chk = utils._checksum(msg)
@@ -54,9 +134,11 @@ class KernelInertial:
         return msg + chk, chk
 
     def payload_UDD(self, data):
+        """Payload of the USER_DEFINED_DATA command: number of data blocks
+        followed by their addresses"""
 
         if isinstance(data, bytes):
-            return data
+            return len(data).to_bytes(1, byteorder="little") + data
 
         elif isinstance(data, list):
             msg = b""
@@ -65,7 +147,7 @@ class KernelInertial:
                 if isinstance(i, str):
                     msg += Kdb.User_Defined_Data[i]["Address"]
 
-            return msg
+            return len(msg).to_bytes(1, byteorder="little") + msg
 
     def configure(self, config):
 
@@ -73,21 +155,36 @@ class KernelInertial:
 
         self._INC_mode = mode
 
+        self.framer = utils.KernelFramer(address=Kdb.MODES[mode]["Address"])
+
+        self.metadata = {"mode": mode}
+
         if mode == "USER_DEFINED_DATA":
-            msg_1, chk = self.payload_cmds(mode)
-            msg_2 = self.payload_UDD(config["UDD_data"])
+            layout = utils.udd_layout(config["UDD_data"])
+
+            self.decoder.add_layout(mode, layout)
+            self.metadata["layout"] = layout
 
-            self.conn.write(msg_1)
-            self.conn.write(msg_2)
+        self.rate = self._plan_rate(
+            mode, config.get("rate"), strict=config.get("strict_rate", False)
+        )
+        self.metadata["rate"] = self.rate
+        self.metadata["rate_max"] = self._check_rate(mode)
+
+        if mode == "USER_DEFINED_DATA":
+            msg, chk = self.payload_cmds(mode, self.payload_UDD(config["UDD_data"]))
         else:
             msg, chk = self.payload_cmds(mode)
 
-            self.conn.write(msg)
+        self.conn.write(msg)
+        journal.event("config_sent", self.name, 1)
 
         ack = self.conn.read(10)
 
         val = copy.copy(ack[6:8])
 
+        journal.event("config_ack", self.name, val == chk, 0)
+
         if val == chk:
             logger.info("Sent message to start collecting Inclinometer data")
             logger.info(f"Mode Used: {mode}")
@@ -97,25 +194,42 @@ class KernelInertial:
     def read_continous_binary(self, fs, flag, sensor_lock):
 
         while not flag.is_set():
-            
-            fs.write(self.read(sensor_lock))
+
+            msg = self.read(sensor_lock)
+
+            if len(msg) > 0:
+                fs.write(msg)
 
         self.close()
 
     def read(self, sensor_lock, chunk_size=None):
+        """Read the bytes available and return the valid messages found
 
-        if self.__first_msg:
-            msg, length = self._find_msg()
+        The latest message is also decoded and published, together with the
+        time it was read, in last_values and last_time.
 
-        else:
-            sensor_lock.acquire()
-            if self.expected_length is not None:
-                msg = self.conn.read(self.expected_length)
-            else:
-                msg = self.conn.read(chunk_size)
-            sensor_lock.release()
+        Args:
+            sensor_lock (threading.Lock): lock on the sensor connection
+            chunk_size (int): number of bytes to read, by default
+                              all the bytes waiting in the buffer are read
+        """
 
-        return msg
+        sensor_lock.acquire()
+        if chunk_size is None:
+            chunk_size = max(1, self.conn.in_waiting)
+        data = self.conn.read(chunk_size)
+        sensor_lock.release()
+
+        frames = self.framer.feed(data)
+
+        if len(frames) > 0:
+            self.last_values = self.decoder.decode_single(frames[-1], return_dict=True)
+            self.last_time = time.time()
+
+            if self.first_time is None:
+                self.first_time = self.last_time
+
+        return b"".join(frames)
 
     def close(self):
 
@@ -126,6 +240,28 @@ class KernelInertial:
 
         self.conn.close()
 
+        logger.info(
+            f"{self.name}: {self.framer.frames} messages, "
+            f"{self.framer.resyncs} resyncs, "
+            f"{self.framer.bad_checksums} bad checksums, "
+            f"{self.framer.dropped_bytes} dropped bytes"
+        )
+
+        # Host time of the first and last messages, the messages carry no
+        # timestamp of their own
+        self.metadata["first_time"] = self.first_time
+        self.metadata["last_time"] = self.last_time
+        self.metadata["frames"] = self.framer.frames
+
+        if self.framer.frames > 1 and self.last_time > self.first_time:
+            rate = (self.framer.frames - 1) / (self.last_time - self.first_time)
+
+            logger.info(
+                f"{self.name}: achieved rate {rate:.2f} Hz, "
+                f"expected {self.rate} Hz, "
+                f"maximum {self._check_rate(self._INC_mode)} Hz @ {self.baudrate}"
+            )
+
         logging.info(f"Closed sensor {self.name}")
 
     def _find_msg(self, waiting=2):
@@ -1,11 +1,20 @@
-import copy
+import os
 import pickle
 import struct
 
+import numpy as np
+import numpy.lib.recfunctions as rfn
+
+import porter.sensors.sensors_db.compiled as compiled
 import porter.sensors.sensors_db.KERNEL as Kdb
 
 HEADER = b"\xAA\x55"
 
+# Bounds of the length field of a message: type, id, length and checksum are
+# always present while the longest data message is well below MAX_LENGTH
+MIN_LENGTH = 6
+MAX_LENGTH = 512
+
 
 def _checksum(msg):
     """Compute the checksum of a message
@@ -25,18 +34,443 @@ def _checksum(msg):
     if msg.startswith(HEADER):
         msg = msg[2:]
 
-    return sum(msg).to_bytes(2, byteorder="little", signed=False)
+    return (sum(msg) & 0xFFFF).to_bytes(2, byteorder="little", signed=False)
+
+
+def _field_dtype(fmt):
+    """Return the numpy type of a field described by a struct format
+
+    Fields made of more than one value, like the reserved words, are kept as
+    raw bytes
+    """
+
+    if len(fmt) == 1:
+        return np.dtype("<" + fmt)
+    else:
+        return np.dtype("V" + str(struct.calcsize("<" + fmt)))
+
+
+def layout_dtype(layout):
+    """Return the numpy structured type of a full message of a given layout
+
+    Args:
+        layout (dict): dictionary with Parameters and Type of the payload, as
+                       the entries of Kdb.MODES
+    Return:
+        dtype (np.dtype)
+    """
+
+    fields = [
+        ("_header", "<u2"),
+        ("_type", "u1"),
+        ("_address", "u1"),
+        ("_length", "<u2"),
+    ]
+
+    for name, fmt in zip(layout["Parameters"], layout["Type"]):
+        fields.append((name, _field_dtype(fmt)))
+
+    fields.append(("_checksum", "<u2"))
+
+    return np.dtype(fields)
+
+
+def layout_scale(layout):
+    """Return the names and the scale vector of the numeric fields of a layout
+
+    A scale of 0 is used in the sensors db for quantities without a known
+    conversion, which are then left as raw counts
+    """
+
+    names = []
+    scale = []
+
+    for name, fmt, val in zip(layout["Parameters"], layout["Type"], layout["Scale"]):
+        if len(fmt) == 1:
+            names.append(name)
+            scale.append(val if val != 0 else 1)
+
+    return names, np.array(scale, dtype=np.float64)
+
+
+def udd_layout(blocks):
+    """Compose the layout of a USER_DEFINED_DATA message
+
+    Args:
+        blocks (list or bytes): names of the Kdb.User_Defined_Data blocks, or
+                                their addresses, in the order they are sent
+    Return:
+        layout (dict): dictionary with Address, Parameters, Type, Scale and
+                       Blocks of the message, as the entries of Kdb.MODES
+    """
+
+    if isinstance(blocks, (bytes, bytearray)):
+        blocks = [compiled.kernel_block(i) for i in blocks]
+
+    layout = {
+        "Address": Kdb.MODES["USER_DEFINED_DATA"]["Address"],
+        "Blocks": list(blocks),
+        "Parameters": [],
+        "Type": [],
+        "Scale": [],
+    }
+
+    for block in blocks:
+        entry = Kdb.User_Defined_Data[block]
+
+        if isinstance(entry["Name"], list):
+            params = zip(entry["Name"], entry["Struct"], entry["Scale"])
+        else:
+            params = [(entry["Name"], entry["Struct"], entry["Scale"])]
+
+        for name, fmt, scale in params:
+            # The same quantity can be sent by more than one block
+            if name in layout["Parameters"]:
+                name = name + " " + block
+
+            layout["Parameters"].append(name)
+            layout["Type"].append(fmt)
+            layout["Scale"].append(scale)
+
+    layout["length"] = struct.calcsize("<" + "".join(layout["Type"]))
+
+    return layout
+
+
+def usw_flags():
+    """Return the bit of each flag of the unit status word in Kdb.USW_TABLE
+
+    Reserved bits are skipped and flags with the same name are told apart by
+    their bit number
+    """
+
+    table = Kdb.USW_TABLE["low"] + Kdb.USW_TABLE["high"]
+
+    flags = {}
+    for bit, name in enumerate(table):
+        if name.lower() == "reserved":
+            continue
+        if table.count(name) > 1:
+            name = name + "_" + str(bit)
+        flags[name] = bit
+
+    return flags
+
+
+def decode_USW(usw):
+    """Split an array of unit status words into a boolean array per flag
+
+    Args:
+        usw (np.ndarray): unit status words, as the USW column of a decoded file
+
+    Return:
+        flags (dict): for each flag, True where the flag reports a fault
+    """
+
+    usw = np.asarray(usw).astype(np.uint16)
+
+    return {name: (usw >> bit) & 1 == 1 for name, bit in usw_flags().items()}
+
+
+def fault_intervals(flag, time=None):
+    """Run length summary of the intervals where a flag is set
+
+    Args:
+        flag (np.ndarray): boolean array of a flag
+        time (np.ndarray): if given, the intervals are returned as times
+
+    Return:
+        intervals (np.ndarray): start and stop (excluded) index of each fault
+                                interval or, if time is given, time of the
+                                first and of the last sample of the interval
+    """
+
+    edges = np.diff(np.concatenate(([0], flag.astype(np.int8), [0])))
+
+    intervals = np.column_stack(
+        (np.flatnonzero(edges == 1), np.flatnonzero(edges == -1))
+    )
+
+    if time is not None:
+        time = np.asarray(time)
+        intervals = np.column_stack(
+            (time[intervals[:, 0]], time[np.maximum(intervals[:, 1] - 1, 0)])
+        )
+
+    return intervals
+
+
+def check_health(usw, time=None):
+    """Health summary of the unit status words of a whole recording
+
+    Args:
+        usw (np.ndarray): unit status words, as the USW column of a decoded file
+        time (np.ndarray): if given, the intervals are returned as times
+
+    Return:
+        health (dict): for each flag, number of samples with a fault and the
+                       fault intervals
+    """
+
+    health = {}
+
+    for name, flag in decode_USW(usw).items():
+        health[name] = {
+            "samples": int(np.count_nonzero(flag)),
+            "intervals": fault_intervals(flag, time=time),
+        }
+
+    return health
+
+
+def is_pickled(filename):
+    """Check if a file is a legacy capture saved by KernelInertial._save_binary"""
+
+    with open(filename, "rb") as fd:
+        start = fd.read(2)
+
+    # Pickle protocols from 2 onwards start with the PROTO opcode
+    return len(start) == 2 and start[0] == 0x80 and 2 <= start[1] <= 5
+
+
+def iter_pickled(filename):
+    """Iterate over the chunks of bytes of a legacy pickled capture
+
+    The capture is a sequence of pickle.dump calls, each one with a chunk of
+    the stream, which are read one at a time
+    """
+
+    with open(filename, "rb") as fd:
+        while True:
+            try:
+                yield pickle.load(fd)
+            except (EOFError, pickle.UnpicklingError):
+                break
+
+
+def convert_pickled(filename, output=None, buffer_size=1 << 20):
+    """Convert a legacy pickled capture to a raw binary file
+
+    The raw file is written under a temporary name and renamed at the end, so
+    an interrupted conversion leaves no partial file. The default raw file is
+    kept and used again while it is newer than the capture.
+
+    Args:
+        filename (str): name of the pickled capture
+        output (str): name of the raw binary file, by default decoded/<name>.raw
+                      in the folder of the capture
+        buffer_size (int): number of bytes written at once
+
+    Return:
+        output (str): name of the raw binary file
+    """
+
+    if output is None:
+        folder, name = os.path.split(filename)
+        output = os.path.join(
+            folder, "decoded", os.path.splitext(name)[0] + ".raw"
+        )
+
+        if (
+            os.path.exists(output)
+            and os.path.getmtime(output) >= os.path.getmtime(filename)
+        ):
+            return output
+
+    if os.path.realpath(output) == os.path.realpath(filename):
+        raise ValueError(f"The output of the conversion of {filename} is the capture")
+
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+
+    tmp = output + "." + str(os.getpid())
+
+    buf = bytearray()
+
+    try:
+        with open(tmp, "wb") as fd:
+            for chunk in iter_pickled(filename):
+                buf += chunk
+
+                if len(buf) >= buffer_size:
+                    fd.write(buf)
+                    buf.clear()
+
+            fd.write(buf)
+
+        os.replace(tmp, output)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    return output
+
+
+def _open_data(source):
+    """Return a uint8 view of a filename or of a bytes-like object"""
+
+    if not isinstance(source, str):
+        return np.frombuffer(source, dtype=np.uint8)
+    elif os.path.getsize(source) == 0:
+        return np.zeros(0, dtype=np.uint8)
+    else:
+        return np.memmap(source, dtype=np.uint8, mode="r")
+
+
+class KernelFramer:
+
+    def __init__(self, address=None, max_length=MAX_LENGTH):
+        """Split a stream of bytes from a KERNEL device into valid messages
+
+        The stream is searched for the HEADER, the length field is checked to
+        be within sensible bounds and the checksum of the message is verified.
+        After a corrupted or misaligned message the framer moves on to the
+        next HEADER, so that a dropped or extra byte only loses the messages
+        that contain it.
+
+        Parameters:
+            address (bytes): if given, only the messages with this address are
+                             returned, e.g. the ones of the configured mode
+            max_length (int): maximum value accepted for the length field
+        """
+
+        self.address = address
+        self.max_length = max_length
+
+        self.frames = 0
+        self.resyncs = 0
+        self.bad_checksums = 0
+        self.dropped_bytes = 0
+        self.skipped_frames = 0
+
+        self._buffer = bytearray()
+        self._locked = False
+
+    def _discard(self, count):
+
+        self.dropped_bytes += count
+
+        if self._locked:
+            self.resyncs += 1
+            self._locked = False
+
+    def feed(self, data):
+        """Add data to the stream and return the complete valid messages
+
+        Args:
+            data (bytes): bytes read from the device
+
+        Return:
+            frames (list): list with the valid messages found
+        """
+
+        buf = self._buffer
+        buf += data
+
+        frames = []
+        pos = 0
+
+        while True:
+            start = buf.find(HEADER, pos)
+
+            if start < 0:
+                # The last byte may be the first half of the next HEADER
+                end = len(buf) - 1 if buf.endswith(HEADER[:1]) else len(buf)
+                if end > pos:
+                    self._discard(end - pos)
+                    pos = end
+                break
+
+            if start > pos:
+                self._discard(start - pos)
+                pos = start
+
+            if len(buf) - start < MIN_LENGTH:
+                break
+
+            length = int.from_bytes(buf[start + 4 : start + 6], byteorder="little")
+
+            if length < MIN_LENGTH or length > self.max_length:
+                self._discard(1)
+                pos = start + 1
+                continue
+
+            end = start + 2 + length
+
+            if end > len(buf):
+                break
+
+            chk = sum(buf[start + 2 : end - 2]) & 0xFFFF
+
+            if chk != int.from_bytes(buf[end - 2 : end], byteorder="little"):
+                self.bad_checksums += 1
+                self._discard(1)
+                pos = start + 1
+                continue
+
+            self._locked = True
+            pos = end
+
+            if self.address is not None and buf[start + 3] != self.address[0]:
+                self.skipped_frames += 1
+                continue
+
+            frames.append(bytes(buf[start:end]))
+            self.frames += 1
+
+        del buf[:pos]
+
+        return frames
 
 
 class KernelMsg:
 
     def __init__(self):
+        """Decoder of the messages sent by the inclinometer
+
+        A struct and a scale vector are compiled for every mode with a known
+        layout and stored by address, so that each message is decoded with a
+        single dictionary lookup and unpack.
+        """
 
         self.msg_address = []
 
+        self.layouts = {}
+        self._codecs = {}
+
         for i in Kdb.MODES.keys():
             self.msg_address.append(Kdb.MODES[i]["Address"])
 
+            if "Type" in Kdb.MODES[i]:
+                self.add_layout(i, Kdb.MODES[i])
+
+    def add_layout(self, mode, layout):
+        """Compile the struct and the scale vector of a message layout
+
+        Args:
+            mode (str): name of the mode
+            layout (dict): dictionary with Address, Parameters, Type and Scale
+                           of the payload, as the entries of Kdb.MODES
+        """
+
+        fmt = "<"
+        scale = []
+
+        for i, val in zip(layout["Type"], layout["Scale"]):
+            if len(i) == 1:
+                fmt += i
+                scale.append(val if val != 0 else 1)
+            else:
+                fmt += str(struct.calcsize("<" + i)) + "s"
+                scale.append(None)
+
+        self.layouts[mode] = layout
+        self._codecs[layout["Address"][0]] = (
+            mode,
+            struct.Struct(fmt),
+            tuple(layout["Parameters"]),
+            tuple(scale),
+        )
+
     def decode_single(self, msg, return_dict=False):
         """Decode a single message sent by the inclinometer
 
@@ -45,62 +479,172 @@ class KernelMsg:
         Args:
             msg (bytes): message to be decoded
         Return:
-            vals ()
+            vals (tuple or dict): raw values or, if return_dict, scaled values
+                                  for each parameter
         """
 
-        if msg[:2] == HEADER:
+        view = memoryview(msg)
+
+        if view[:2] == HEADER:
             type_idx = 3
         else:
             type_idx = 1
 
-        msg_type = msg[type_idx].to_bytes(1, byteorder="little")
-        modes = list(Kdb.MODES.keys())
-
-        idx = self.msg_address.index(msg_type)
+        _, codec, names, scale = self._codecs[view[type_idx]]
 
-        struct_type = "<" + "".join(Kdb.MODES[modes[idx]]["Type"])
-        scale = Kdb.MODES[modes[idx]]["Scale"]
-
-        vals = struct.unpack(struct_type, msg[type_idx + 3 : -2])
+        vals = codec.unpack_from(view, type_idx + 3)
 
         if return_dict:
-            vals = dict(
-                zip(
-                    Kdb.MODES[modes[idx]]["Parameters"],
-                    list(map(lambda x, y: x / y, vals, scale)),
-                )
-            )
+            vals = {
+                name: val if k is None else val / k
+                for name, val, k in zip(names, vals, scale)
+            }
 
         return vals
 
-    def decode_multi(self, filename):
-        """Decode multiple messages saved in a binary file"""
+    def _find_mode(self, buf):
+        """Find the mode of the first valid message in a buffer"""
 
-        count = 0
+        for start in np.flatnonzero((buf[:-1] == HEADER[0]) & (buf[1:] == HEADER[1])):
+            if start + MIN_LENGTH > buf.size:
+                break
 
-        with open(filename, "rb") as fd:
-            if filename[-3:].lower() == ".pck":
-                data = pickle.load(fd)
-            else:
-                data = fd.read()
+            if buf[start + 3] not in self._codecs:
+                continue
 
-        data = data[data.find(HEADER) :]
+            mode = self._codecs[buf[start + 3]][0]
 
-        length = int.from_bytes(data[4:5], byteorder="little", signed=False)
+            length = layout_dtype(self.layouts[mode]).itemsize
+            msg = buf[start : start + length].tobytes()
 
-        length += 2
+            if (
+                len(msg) == length
+                and int.from_bytes(msg[4:6], byteorder="little") == length - 2
+                and _checksum(msg[:-2]) == msg[-2:]
+            ):
+                return mode
 
-        decoded = {}
+        return None
+
+    def _find_records(self, buf, address, length):
+        """Find the start of all the valid messages with a given address
 
-        for i in range(int(len(data) / length) - 1):
+        Header, address, length field and checksum of every candidate message
+        are checked at once on the whole buffer
+        """
+
+        starts = np.flatnonzero((buf[:-1] == HEADER[0]) & (buf[1:] == HEADER[1]))
+        starts = starts[starts + length <= buf.size]
+
+        valid = (buf[starts + 3] == address[0]) & (
+            (buf[starts + 4].astype(np.int64) | (buf[starts + 5].astype(np.int64) << 8))
+            == length - 2
+        )
+        starts = starts[valid]
+
+        total = np.concatenate(([0], np.cumsum(buf, dtype=np.int64)))
+        chk = (total[starts + length - 2] - total[starts + 2]) & 0xFFFF
+        valid = chk == (
+            buf[starts + length - 2].astype(np.int64)
+            | (buf[starts + length - 1].astype(np.int64) << 8)
+        )
+        starts = starts[valid]
+
+        # Overlapping candidates only happen when a header pattern inside a
+        # payload passes all the checks, so the loop over messages is rare
+        if starts.size > 1 and np.any(np.diff(starts) < length):
+            keep = np.zeros(starts.size, dtype=bool)
+            last_end = -1
+            for i, start in enumerate(starts.tolist()):
+                if start >= last_end:
+                    keep[i] = True
+                    last_end = start + length
+            starts = starts[keep]
+
+        return starts
+
+    def iter_decode(self, filename, chunk_size=65536, mode=None, start=0):
+        """Decode the messages saved in a binary file in chunks
+
+        The file is memory mapped and read in chunks of at most chunk_size
+        messages, so that the memory used does not depend on the size of the
+        file. Corrupted or misaligned messages are skipped.
+
+        Args:
+            filename (str or bytes): name of the binary file or data
+            chunk_size (int): maximum number of messages decoded at once
+            mode (str): mode of the messages, by default the mode of the
+                        first valid message in the file
+            start (int): byte offset where the decoding starts
+
+        Yield:
+            decoded (dict): dictionary with an array for each parameter of
+                            the mode
+        """
+
+        data = _open_data(filename)
+
+        self.decoded_bytes = 0
+        # End of the last decoded message, where an incremental decoding of
+        # a file still being written has to restart
+        self.decoded_offset = start
+
+        if mode is None:
+            mode = self._find_mode(np.asarray(data[start : start + (1 << 16)]))
+            if mode is None:
+                return
+
+        layout = self.layouts[mode]
+        address = layout["Address"]
+
+        dtype = layout_dtype(layout)
+        length = dtype.itemsize
+        names, scale = layout_scale(layout)
+
+        # Fields without a scale keep their native type
+        scaled = [i for i, k in zip(names, scale) if k != 1]
+        scale = scale[scale != 1]
+
+        offset = start
+        while offset + length <= data.size:
+            stop = offset + chunk_size * length
+            buf = np.asarray(data[offset : stop + length])
 
-            tmp = copy.copy(data[i * length : (i + 1) * length])
-            tmp = self.decode_single(tmp, return_dict=True)
+            starts = self._find_records(buf, address, length)
+            starts = starts[starts < stop - offset]
+
+            if starts.size > 0:
+                stop = max(stop, offset + int(starts[-1]) + length)
+
+                idx = starts[:, np.newaxis] + np.arange(length)
+                records = buf[idx].view(dtype)[:, 0]
+
+                vals = rfn.structured_to_unstructured(records[scaled], dtype=np.float64)
+                vals /= scale
+                vals = dict(zip(scaled, vals.T))
+
+                self.decoded_bytes += starts.size * length
+                self.decoded_offset = offset + int(starts[-1]) + length
+
+                yield {i: vals[i] if i in vals else records[i].copy() for i in names}
+
+            offset = stop
+
+    def decode_multi(self, filename, chunk_size=65536):
+        """Decode multiple messages saved in a binary file"""
+
+        if is_pickled(filename):
+            filename = convert_pickled(filename)
+
+        decoded = {}
 
-            for j in tmp.keys():
-                if i == 0:
-                    decoded[j] = []
+        for chunk in self.iter_decode(filename, chunk_size=chunk_size):
+            for key in chunk.keys():
+                if key not in decoded:
+                    decoded[key] = []
+                decoded[key].append(chunk[key])
 
-                decoded[j].append(tmp[j])
+        for key in decoded.keys():
+            decoded[key] = np.concatenate(decoded[key])
 
         return decoded
@@ -1,9 +1,14 @@
 import logging
+import math
+import queue
 import random
 import struct
 import time
 
-import lgpio
+try:
+    import lgpio
+except ModuleNotFoundError:
+    lgpio = None
 
 # ADS1015 registers
 ADS1015_REG_CONVERSION = 0x00
@@ -57,6 +62,10 @@ ADS1015_CONFIG_RATE = {
     "3300": 0x00C0,
 }
 
+# Marker record written by mark: time of the step boundary, -1 - step in
+# place of the read time and NaN value, see ads1015_utils.split_markers
+MARKER = struct.Struct("<dqf")
+
 logger = logging.getLogger()
 
 
@@ -85,7 +94,10 @@ class ADS1015:
 
         self.__mux_channels = ADS1015_CONFIG_MUX[string]
 
-        self.bus = lgpio.i2c_open(bus, address)
+        # lgpio or an object with the same i2c functions, e.g. a replay
+        self._i2c = kwargs.get("conn") or lgpio
+
+        self.bus = self._i2c.i2c_open(bus, address)
 
         self.__adc_sample = 1 / 1600.0
         self.__time_sample = 1 / 1600.0
@@ -104,6 +116,10 @@ class ADS1015:
 
         self.__read_buffer = bytearray(2)
 
+        # Queues that receive the (time, value) of each sample, see add_tap
+        self.taps = ()
+        self._markers = queue.SimpleQueue()
+
         logger.info(f"Connected to ADC {self.name}")
         logger.info(f"Current ADC Data Rate in s: {self.__adc_sample}")
         logger.info(f"Current Reading Data Rate in s: {self.__time_sample}")
@@ -115,7 +131,7 @@ class ADS1015:
             (self.__config_register >> 8) & 0xFF,
             self.__config_register & 0xFF,
         ]
-        lgpio.i2c_write_i2c_block_data(self.bus, ADS1015_REG_CONFIG, config_bytes)
+        self._i2c.i2c_write_i2c_block_data(self.bus, ADS1015_REG_CONFIG, config_bytes)
 
         msg_buffer = bytearray(20)
 
@@ -125,7 +141,7 @@ class ADS1015:
             sensor_lock.acquire()
             t_start = time.perf_counter_ns()
 
-            _, raw_value = lgpio.i2c_read_i2c_block_data(
+            _, raw_value = self._i2c.i2c_read_i2c_block_data(
                 self.bus, ADS1015_REG_CONVERSION, 2
             )
             
@@ -139,17 +155,57 @@ class ADS1015:
             if raw_value > 2047:
                 raw_value -= 4096
             
-            struct.pack_into("<d", msg_buffer, 0, time.time())
+            sample_time = time.time()
+            value = (raw_value * self._gain) / 4096.
+
+            struct.pack_into("<d", msg_buffer, 0, sample_time)
             struct.pack_into("<q", msg_buffer, 8, read_time)
-            struct.pack_into("<f", msg_buffer, 16, (raw_value * self._gain) / 4096.)
+            struct.pack_into("<f", msg_buffer, 16, value)
+
+            while not self._markers.empty():
+                fs.write(self._markers.get())
 
             fs.write(msg_buffer)
             sensor_lock.release()
+
+            for tap in self.taps:
+                tap.put((sample_time, value))
+
             while time.perf_counter() < next_sample_time:
                 pass
 
         self.close()
 
+    def add_tap(self):
+        """Queue that receives the time and value of each new sample"""
+
+        tap = queue.SimpleQueue()
+        self.taps = self.taps + (tap,)
+
+        return tap
+
+    def remove_tap(self, tap):
+
+        self.taps = tuple(i for i in self.taps if i is not tap)
+
+    def mark(self, step):
+        """Tag the current time in the data stream, e.g. a step of a scan
+
+        The marker record is written by the reading loop before the next
+        sample, so that the file is written by a single thread.
+
+        Parameters:
+            step (int): index of the step, 0 or more
+
+        Return:
+            time (float): time.time() of the marker
+        """
+
+        t = time.time()
+        self._markers.put(MARKER.pack(t, -1 - step, math.nan))
+
+        return t
+
     def configure(self, config):
 
         keys = ["gain", "ADC_rate", "reading_rate"]
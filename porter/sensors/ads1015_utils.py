@@ -0,0 +1,110 @@
+import os
+
+import numpy as np
+
+# Record written by ADS1015.read_continous_binary for each sample: time.time()
+# of the sample, duration of the i2c read in ns and value in V
+RECORD = np.dtype([("time", "<f8"), ("read_time", "<i8"), ("value", "<f4")])
+
+
+def open_records(filename):
+    """Memory map the complete records of an ADC binary file
+
+    A trailing partial record, e.g. when the acquisition was interrupted
+    while writing, is left out.
+
+    Args:
+        filename (str): name of the binary file
+
+    Return:
+        records (np.memmap): structured array with the records
+    """
+
+    count = os.path.getsize(filename) // RECORD.itemsize
+
+    if count == 0:
+        return np.zeros(0, dtype=RECORD)
+
+    return np.memmap(filename, dtype=RECORD, mode="r", shape=(count,))
+
+
+def iter_records(filename, chunk_size=1 << 20, start=0):
+    """Iterate over the records of an ADC binary file in chunks
+
+    Args:
+        filename (str): name of the binary file
+        chunk_size (int): maximum number of records read at once
+        start (int): index of the first record
+
+    Yield:
+        records (np.ndarray): structured array with the records of the chunk
+    """
+
+    records = open_records(filename)
+
+    for i in range(start, records.size, chunk_size):
+        yield np.array(records[i : i + chunk_size])
+
+
+def is_marker(records):
+    """Find the marker records written by ADS1015.mark
+
+    A marker has the time of a step boundary, the negative code -1 - step in
+    read_time, which is never negative for a sample, and a NaN value.
+    """
+
+    return records["read_time"] < 0
+
+
+def split_markers(records):
+    """Separate the samples from the markers of the step boundaries
+
+    Args:
+        records (np.ndarray): structured array with the records
+
+    Return:
+        samples (np.ndarray): records of the samples
+        markers (dict): time and step of each marker
+    """
+
+    marker = is_marker(records)
+
+    if not np.any(marker):
+        return records, {"time": np.zeros(0), "step": np.zeros(0, dtype=np.int64)}
+
+    return records[~marker], {
+        "time": records["time"][marker],
+        "step": -1 - records["read_time"][marker],
+    }
+
+
+def steps(records, markers, settle=0.0, dwell=None):
+    """Group the samples by the step of a scan, using the markers
+
+    The samples of a step are the ones between its marker and the next one,
+    so the data can be reduced again with a different settle or dwell time.
+
+    Args:
+        records (np.ndarray): records of the samples
+        markers (dict): markers returned by split_markers
+        settle (float): time in s skipped after each marker
+        dwell (float): longest time in s used after the settle time, by
+                       default up to the next marker
+
+    Yield:
+        step (int): index of the step in the scan
+        samples (np.ndarray): records of the samples of the step
+    """
+
+    time = records["time"]
+
+    for i in range(markers["time"].size):
+        start = markers["time"][i] + settle
+
+        stop = markers["time"][i + 1] if i + 1 < markers["time"].size else np.inf
+        if dwell is not None:
+            stop = min(stop, start + dwell)
+
+        first, last = np.searchsorted(time, [start, stop])
+
+        yield int(markers["step"][i]), records[first:last]
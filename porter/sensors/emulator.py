@@ -0,0 +1,733 @@
+import argparse
+import logging
+import os
+import re
+import select
+import struct
+import sys
+import threading
+import time
+import tty
+
+import numpy as np
+
+import porter.align as align
+import porter.sensors.KERNEL_utils as kernel
+import porter.sensors.replay as replay
+import porter.sensors.sensors_db.compiled as compiled
+import porter.sensors.sensors_db.KERNEL as Kdb
+import porter.sensors.ubx_utils as ubx
+import porter.valon as valon
+
+logger = logging.getLogger()
+
+# Start, 8 data and stop bit of each byte on the serial link
+BITS_PER_BYTE = 10
+
+# Size in bytes of the value of a configuration key, from bits 28-30 of its ID
+KEY_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8}
+
+# Messages enabled by the CFG_MSGOUT keys of UART1
+MSGOUT = re.compile(r"^CFG_MSGOUT_UBX_([A-Z0-9]+)_([A-Z0-9]+)_UART1$")
+
+
+class Faults:
+
+    def __init__(self, drop=0.0, flip=0.0, stall=0.0, stall_time=0.5, seed=None):
+        """Faults injected in the bytes sent by an emulator
+
+        Parameters:
+            drop (float): probability that a byte is dropped
+            flip (float): probability that a byte has one bit flipped
+            stall (float): stalls of the output per second
+            stall_time (float): duration in s of each stall
+            seed (int): seed of the random generator, for repeatable faults
+        """
+
+        self.drop = drop
+        self.flip = flip
+        self.stall = stall
+        self.stall_time = stall_time
+
+        self.rng = np.random.default_rng(seed)
+
+        self.counts = {"dropped": 0, "flipped": 0, "stalls": 0}
+
+    def apply(self, data):
+        """Bytes to be sent with the dropped and flipped bytes"""
+
+        if len(data) == 0 or (self.drop <= 0 and self.flip <= 0):
+            return data
+
+        buf = np.frombuffer(data, dtype=np.uint8).copy()
+
+        if self.flip > 0:
+            idx = np.flatnonzero(self.rng.random(buf.size) < self.flip)
+            buf[idx] ^= np.left_shift(1, self.rng.integers(0, 8, idx.size)).astype(
+                np.uint8
+            )
+            self.counts["flipped"] += idx.size
+
+        if self.drop > 0:
+            keep = self.rng.random(buf.size) >= self.drop
+            self.counts["dropped"] += buf.size - np.count_nonzero(keep)
+            buf = buf[keep]
+
+        return buf.tobytes()
+
+    def stalled(self, dt):
+        """Duration of a stall starting in an interval of dt s, 0 if none"""
+
+        if self.stall > 0 and self.rng.random() < self.stall * dt:
+            self.counts["stalls"] += 1
+            return self.stall_time
+
+        return 0.0
+
+
+class Emulator:
+
+    def __init__(self, name, baudrate, faults=None, link=None, backlog=1.0):
+        """Serial device emulated on a pseudo-terminal pair
+
+        The driver opens the port of the emulator as the serial port of the
+        device. The bytes are sent at the throughput of the baudrate, the
+        data that does not fit in the backlog of the device is lost as in a
+        full transmit buffer, and the faults are applied to everything sent.
+
+        Parameters:
+            name (str): name of the device in the logs
+            baudrate (int): baudrate of the emulated link
+            faults (Faults): faults injected in the output, None for no faults
+            link (str): path of a symlink to the port, e.g. the port in the
+                        sensor configuration
+            backlog (float): seconds of output buffered by the device
+        """
+
+        self.name = name
+        self.baudrate = baudrate
+        self.faults = faults or Faults()
+        self.backlog = backlog
+
+        self.master, self.slave = os.openpty()
+        # No echo or line translation, as a serial port
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+
+        self.port = os.ttyname(self.slave)
+
+        self.link = link
+        if link is not None:
+            if os.path.lexists(link):
+                os.remove(link)
+            os.symlink(self.port, link)
+
+        self.counts = {"epochs": 0, "sent": 0, "received": 0, "overflow": 0}
+
+        self._input = bytearray()
+        self._output = bytearray()
+        # Replies waiting for their processing time, (time, bytes)
+        self._scheduled = []
+
+        self._flag = threading.Event()
+        self._thread = None
+
+    @property
+    def throughput(self):
+        """Bytes per second of the link"""
+
+        return self.baudrate / BITS_PER_BYTE
+
+    def period(self):
+        """Time in s between the epochs of the data stream, None if idle"""
+
+        return None
+
+    def epoch(self, t):
+        """Messages of the data stream at the wall clock time t"""
+
+        return b""
+
+    def handle(self):
+        """Process the commands in the input, see _send for the replies"""
+
+        self._input.clear()
+
+    def _send(self, data, delay=0.0):
+
+        if delay > 0:
+            self._scheduled.append((time.monotonic() + delay, data))
+            return
+
+        data = self.faults.apply(data)
+
+        room = int(self.backlog * self.throughput) - len(self._output)
+        if len(data) > room:
+            self.counts["overflow"] += len(data) - max(room, 0)
+            data = data[: max(room, 0)]
+
+        self._output += data
+
+    def _receive(self):
+
+        try:
+            data = os.read(self.master, 4096)
+        except (BlockingIOError, OSError):
+            return
+
+        self.counts["received"] += len(data)
+        self._input += data
+
+        self.handle()
+
+    def _write(self, count):
+
+        if count <= 0 or len(self._output) == 0:
+            return 0
+
+        try:
+            written = os.write(self.master, self._output[:count])
+        except BlockingIOError:
+            # The driver is not reading, the data waits in the backlog
+            return 0
+
+        del self._output[:written]
+        self.counts["sent"] += written
+
+        return written
+
+    def run(self, flag=None, tick=0.002):
+        """Emulate the device until the flag or stop
+
+        Args:
+            flag (threading.Event): stops the emulator when it is set
+            tick (float): longest time in s between two writes
+        """
+
+        if flag is None:
+            flag = self._flag
+
+        logger.info(f"{self.name} emulated on {self.port} @ {self.baudrate}")
+
+        last = time.monotonic()
+        budget = 0.0
+        stall = 0.0
+        next_epoch = None
+
+        while not flag.is_set() and not self._flag.is_set():
+            ready, _, _ = select.select([self.master], [], [], tick)
+            if ready:
+                self._receive()
+
+            now = time.monotonic()
+            dt = now - last
+            last = now
+
+            while len(self._scheduled) > 0 and self._scheduled[0][0] <= now:
+                self._send(self._scheduled.pop(0)[1])
+
+            period = self.period()
+            if period is None:
+                next_epoch = None
+            else:
+                if next_epoch is None:
+                    next_epoch = now
+                # The epochs late by more than a second are skipped
+                next_epoch = max(next_epoch, now - 1.0)
+                while next_epoch <= now:
+                    self._send(self.epoch(time.time() - (now - next_epoch)))
+                    self.counts["epochs"] += 1
+                    next_epoch += period
+
+            if now < stall:
+                continue
+            stall = now + self.faults.stalled(dt)
+            if now < stall:
+                continue
+
+            # Bytes allowed by the baudrate, without bursts after an idle time
+            budget = min(budget + dt * self.throughput, self.throughput * tick + 1)
+            budget -= self._write(int(budget))
+
+        self.close()
+
+    def start(self):
+        """Run the emulator in a thread"""
+
+        self._thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+        self._thread.start()
+
+        return self
+
+    def stop(self):
+
+        self._flag.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def close(self):
+
+        counts = {**self.counts, **self.faults.counts}
+        logger.info(f"{self.name}: " + ", ".join(f"{j} {i}" for i, j in counts.items()))
+
+        if self.link is not None and os.path.islink(self.link):
+            os.remove(self.link)
+
+        os.close(self.master)
+        os.close(self.slave)
+
+
+def _frames(buf, sync, length):
+    """Split the complete frames at the start of a buffer
+
+    Args:
+        buf (bytearray): input, the frames and the bytes before them are
+                         removed
+        sync (bytes): start of the frames
+        length (callable): length of a frame from its first 6 bytes
+
+    Return:
+        frames (list): bytes of each frame
+    """
+
+    frames = []
+
+    while True:
+        start = buf.find(sync)
+        if start < 0:
+            del buf[: max(len(buf) - len(sync) + 1, 0)]
+            break
+
+        del buf[:start]
+        if len(buf) < 6:
+            break
+
+        size = length(buf)
+        if len(buf) < size:
+            break
+
+        frames.append(bytes(buf[:size]))
+        del buf[:size]
+
+    return frames
+
+
+def rawx_frame(t, count=12):
+    """RXM-RAWX frame with count measurements at the wall clock time t"""
+
+    # The layout of the repeated group is only in the sensors db
+    import porter.sensors.sensors_db.ublox as Udb
+
+    msg = Udb.rxm_dict["RAWXM"]
+    fields = {i: j for i, j in msg["payload"].items() if i != "group"}
+
+    head = np.zeros(1, dtype=ubx.payload_dtype({"payload": fields}))
+    group = np.zeros(
+        count, dtype=ubx.payload_dtype({"payload": msg["payload"]["group"][1]})
+    )
+
+    gps = t - align.GPS_EPOCH + align.GPS_LEAP_SECONDS
+
+    head["rcvTOW"] = gps % align.WEEK
+    head["week"] = gps // align.WEEK
+    head["leapS"] = align.GPS_LEAP_SECONDS
+    head["numMeas"] = count
+    head["version"] = 1
+
+    sv = np.arange(count)
+    group["prMeas"] = 2.2e7 + 1e5 * sv + 700 * (t % 1000)
+    group["cpMeas"] = group["prMeas"] / 0.19
+    group["doMeas"] = 100 * np.sin(sv + t / 600)
+    group["svId"] = sv + 1
+    group["lockTime"] = 64500
+    group["cNo"] = 40
+    group["trkStat"] = 0x07
+
+    msg_class, msg_id = compiled.ubx_ids(msg["name"])
+
+    return replay.ubx_frame(msg_class, msg_id, head.tobytes() + group.tobytes())
+
+
+class UBXEmulator(Emulator):
+
+    def __init__(
+        self, baudrate=38400, rate=1.0, messages=("NAV-PVT",), measurements=12, **kwargs
+    ):
+        """u-blox receiver on UART1
+
+        The receiver keeps the configuration keys set with CFG-VALSET, replies
+        to CFG-VALGET with their values, ACKs the CFG messages and switches
+        its baudrate when CFG_UART1_BAUDRATE is set. The messages enabled by
+        the CFG_MSGOUT keys of UART1 are sent at the rate of CFG_RATE_MEAS:
+        the NAV messages with a fixed payload and RXM-RAWX.
+
+        Parameters:
+            baudrate (int): initial baudrate
+            rate (float): initial measurement rate in Hz
+            messages (list): messages enabled at the start, e.g. NAV-PVT
+            measurements (int): number of measurements of RXM-RAWX
+        """
+
+        super().__init__(kwargs.pop("name", "u-blox"), baudrate, **kwargs)
+
+        self.measurements = measurements
+
+        # Raw value of each configuration key by key ID
+        self.config = {}
+        self._set_key("CFG_RATE_MEAS", int(round(1000 / rate)))
+        self._set_key("CFG_UART1_BAUDRATE", baudrate)
+        for i in messages:
+            self._set_key("CFG_MSGOUT_UBX_" + i.replace("-", "_") + "_UART1", 1)
+
+    def _set_key(self, name, value):
+
+        key_id = compiled.config_key(name)[0]
+        size = KEY_SIZES[(key_id >> 28) & 0x7]
+
+        self.config[key_id] = int(value).to_bytes(size, "little")
+
+    def _get_key(self, name, default=0):
+
+        value = self.config.get(compiled.config_key(name)[0])
+
+        return default if value is None else int.from_bytes(value, "little")
+
+    def period(self):
+
+        return max(self._get_key("CFG_RATE_MEAS", 1000), 25) / 1000
+
+    def _enabled(self):
+        """Name and output rate divider of the enabled messages"""
+
+        messages = []
+
+        for key_id, value in self.config.items():
+            match = MSGOUT.match(compiled.config_name(key_id)[0])
+            rate = int.from_bytes(value, "little")
+            if match is not None and rate > 0:
+                messages.append((match.group(1) + "-" + match.group(2), rate))
+
+        return messages
+
+    def epoch(self, t):
+
+        frames = b""
+
+        for name, rate in self._enabled():
+            if self.counts["epochs"] % rate != 0:
+                continue
+
+            if name == "RXM-RAWX":
+                frames += rawx_frame(t, self.measurements)
+            elif replay._fixed_ubx(name):
+                frames += replay.synthetic_ubx(1.0, 1.0, [name], start=t)[0]
+
+        return frames
+
+    def _values(self, payload):
+        """Key ID and raw value of the keys of a CFG-VALSET payload"""
+
+        pos = 4
+        while pos + 4 <= len(payload):
+            key_id = struct.unpack_from("<I", payload, pos)[0]
+            size = KEY_SIZES.get((key_id >> 28) & 0x7)
+            if size is None:
+                break
+
+            yield key_id, bytes(payload[pos + 4 : pos + 4 + size])
+            pos += 4 + size
+
+    def _valget(self, payload):
+
+        layer = payload[1:2]
+        position = payload[2:4]
+
+        keys = struct.unpack_from(f"<{(len(payload) - 4) // 4}I", payload, 4)
+
+        body = b"\x01" + layer + position
+        for key_id in keys:
+            try:
+                compiled.config_name(key_id)
+            except KeyError:
+                return None
+
+            size = KEY_SIZES[(key_id >> 28) & 0x7]
+            body += struct.pack("<I", key_id) + self.config.get(key_id, bytes(size))
+
+        return replay.ubx_frame(0x06, 0x8B, body)
+
+    def handle(self):
+
+        def length(buf):
+            return 8 + int.from_bytes(buf[4:6], "little")
+
+        for frame in _frames(self._input, ubx.SYNC, length):
+            msg_class, msg_id = frame[2], frame[3]
+            payload = frame[6:-2]
+
+            # Frames with a bad checksum are ignored by the receiver
+            if replay.ubx_frame(msg_class, msg_id, payload) != frame:
+                logger.warning(f"{self.name}: bad checksum {frame.hex()}")
+                continue
+
+            if msg_class != 0x06:
+                continue
+
+            baudrate = None
+            reply = b""
+
+            if msg_id == 0x8A:
+                for key_id, value in self._values(payload):
+                    self.config[key_id] = value
+                baudrate = self._get_key("CFG_UART1_BAUDRATE", self.baudrate)
+
+            elif msg_id == 0x8B:
+                reply = self._valget(payload)
+
+            if reply is None:
+                self._send(replay.ubx_frame(0x05, 0x00, frame[2:4]))
+                continue
+
+            self._send(reply + replay.ubx_ack(frame))
+
+            # The ACK is sent at the old baudrate
+            if baudrate is not None and baudrate != self.baudrate:
+                logger.info(f"{self.name}: baudrate {baudrate}")
+                self.baudrate = baudrate
+
+
+class KernelEmulator(Emulator):
+
+    def __init__(self, baudrate=115200, rate=100.0, mode=None, **kwargs):
+        """KERNEL inclinometer
+
+        The commands are ACKed with their checksum and select the mode of the
+        messages sent at rate Hz, including USER_DEFINED_DATA with the blocks
+        of the command. STOP and the commands without data stop the output.
+
+        Parameters:
+            baudrate (int): baudrate of the link
+            rate (float): output rate of the messages in Hz
+            mode (str): mode sent at the start, None to wait for a command
+        """
+
+        super().__init__(kwargs.pop("name", "KERNEL"), baudrate, **kwargs)
+
+        self.rate = rate
+
+        self.layout = None
+        self.t0 = time.time()
+        if mode is not None:
+            self.layout = Kdb.MODES[mode]
+
+        self.bad = 0
+
+    def period(self):
+
+        return None if self.layout is None else 1.0 / self.rate
+
+    def epoch(self, t):
+
+        values = replay.kernel_values(self.layout, np.array([t - self.t0]))
+
+        return replay.kernel_frames(self.layout, values)
+
+    def handle(self):
+
+        def length(buf):
+            return 2 + int.from_bytes(buf[4:6], "little")
+
+        for frame in _frames(self._input, kernel.HEADER, length):
+            if kernel._checksum(frame[:-2]) != frame[-2:]:
+                self.bad += 1
+                logger.warning(f"{self.name}: bad checksum {frame.hex()}")
+                continue
+
+            self._send(replay.kernel_ack(frame))
+
+            mode = compiled.kernel_mode(frame[6])
+            payload = frame[7:-2]
+
+            if mode == "USER_DEFINED_DATA":
+                self.layout = kernel.udd_layout(payload[1 : 1 + payload[0]])
+            elif "Parameters" in Kdb.MODES.get(mode, {}):
+                self.layout = Kdb.MODES[mode]
+            else:
+                self.layout = None
+
+            logger.info(f"{self.name}: mode {mode}")
+
+
+class ValonEmulator(Emulator):
+
+    def __init__(self, baudrate=9600, delay=0.002, **kwargs):
+        """Valon synthesizer
+
+        The command lines are echoed and each command is answered on its own
+        line after the processing delay, then the prompt is sent. The
+        settings of valon.STATE are kept and reported in the replies, the
+        other commands are acknowledged with their own text.
+
+        Parameters:
+            baudrate (int): baudrate of the link
+            delay (float): processing time in s of each command
+        """
+
+        super().__init__(kwargs.pop("name", "Valon"), baudrate, **kwargs)
+
+        self.delay = delay
+
+        self.state = {"f": 1000.0, "pwr": 0.0, "amd": 0.0, "amf": 1.0}
+
+    def _reply(self, cmd):
+
+        fields = cmd.split()
+        name = fields[0].lower().rstrip("?")
+
+        if name not in self.state:
+            return " ".join(fields).upper() + ";"
+
+        if not fields[0].endswith("?") and len(fields) > 1:
+            value = float(fields[1])
+            unit = fields[2].lower() if len(fields) > 2 else ""
+            if name in valon.FREQ_UNITS and unit in valon.UNITS:
+                value *= valon.UNITS[unit] / valon.UNITS[valon.FREQ_UNITS[name]]
+            self.state[name] = value
+
+        value = self.state[name]
+
+        if name == "f":
+            return f"F {value:g} MHz; // Act {value:g} MHz"
+        if name == "amf":
+            return f"AMF {value:g} Hz;"
+        if name == "amd":
+            return f"AMD {value:g}; // dB"
+
+        return f"PWR {value:g}; // dBm"
+
+    def handle(self):
+
+        while b"\r" in self._input:
+            line, _, rest = self._input.partition(b"\r")
+            self._input = bytearray(rest)
+
+            line = line.decode(errors="replace")
+            commands = [i.strip() for i in line.split(";") if i.strip()]
+
+            reply = line + "\r\n"
+            for cmd in commands:
+                try:
+                    reply += self._reply(cmd) + "\r\n"
+                except ValueError:
+                    reply += f"Invalid command: {cmd}\r\n"
+
+            self._send(reply.encode() + valon.PROMPT, delay=self.delay * len(commands))
+
+
+# Emulator of each device for the command line
+EMULATORS = {
+    "ubx": UBXEmulator,
+    "kernel": KernelEmulator,
+    "valon": ValonEmulator,
+}
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description="Emulate a serial device on a pseudo-terminal."
+    )
+
+    parser.add_argument("device", choices=list(EMULATORS.keys()))
+
+    parser.add_argument(
+        "--link",
+        type=str,
+        default=None,
+        help="Symlink to the port, e.g. the port in the sensor configuration",
+    )
+
+    parser.add_argument("--baudrate", type=int, default=None, help="Initial baudrate")
+
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=None,
+        help="Rate in Hz of the u-blox measurements or of the KERNEL messages",
+    )
+
+    parser.add_argument(
+        "--messages",
+        type=str,
+        nargs="+",
+        default=None,
+        help="u-blox messages sent at the start, e.g. NAV-PVT RXM-RAWX",
+    )
+
+    parser.add_argument(
+        "--mode", type=str, default=None, help="KERNEL mode sent at the start"
+    )
+
+    parser.add_argument(
+        "--drop", type=float, default=0.0, help="Probability of a dropped byte"
+    )
+
+    parser.add_argument(
+        "--flip", type=float, default=0.0, help="Probability of a bit flip in a byte"
+    )
+
+    parser.add_argument(
+        "--stall", type=float, default=0.0, help="Stalls of the output per second"
+    )
+
+    parser.add_argument(
+        "--stall-time", type=float, default=0.5, help="Duration in s of a stall"
+    )
+
+    parser.add_argument(
+        "--seed", type=int, default=None, help="Seed of the faults, for repeatable runs"
+    )
+
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=None,
+        help="Seconds to run, by default until interrupted",
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(message)s", stream=sys.stdout
+    )
+
+    kwargs = {
+        "link": args.link,
+        "faults": Faults(args.drop, args.flip, args.stall, args.stall_time, args.seed),
+    }
+
+    if args.baudrate is not None:
+        kwargs["baudrate"] = args.baudrate
+    if args.rate is not None and args.device != "valon":
+        kwargs["rate"] = args.rate
+    if args.messages is not None and args.device == "ubx":
+        kwargs["messages"] = args.messages
+    if args.mode is not None and args.device == "kernel":
+        kwargs["mode"] = args.mode
+
+    emulator = EMULATORS[args.device](**kwargs)
+
+    print(emulator.port, flush=True)
+
+    flag = threading.Event()
+    if args.duration is not None:
+        threading.Timer(args.duration, flag.set).start()
+
+    try:
+        emulator.run(flag)
+    except KeyboardInterrupt:
+        emulator.close()
+
+
+if __name__ == "__main__":
+    main()
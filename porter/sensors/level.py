@@ -0,0 +1,146 @@
+import logging
+import time
+
+try:
+    import minimalmodbus as mm
+except ModuleNotFoundError:
+    mm = None
+
+import porter.journal as journal
+import porter.sensors.level_utils as utils
+
+logger = logging.getLogger()
+
+
+class Level:
+
+    def __init__(self, port, address, baudrate=38400, **kwargs):
+        """Modbus inclinometer, polled at the output rate of its filter
+
+        Parameters:
+            port (str): serial port of the RS485 adapter
+            address (int): Modbus address of the device
+            baudrate (int): baudrate of the serial connection
+        """
+
+        self.name = kwargs.get("name", "Generic Level")
+
+        # minimalmodbus-like instrument given by the caller, e.g. a replay
+        self.instrument = kwargs.get("conn") or mm.Instrument(port, address)
+        self.instrument.serial.baudrate = baudrate
+        self.instrument.serial.timeout = kwargs.get("timeout", 0.1)
+
+        self.rate = None
+
+        self.polls = 0
+        self.errors = 0
+        self.missed = 0
+
+        self.metadata = {}
+
+        logger.info(f"Connected to level sensor {self.name} @ {baudrate}")
+
+    def get_filter(self):
+        """Output rate in Hz of the filter of the device"""
+
+        return utils.freq_dict[
+            str(int(self.instrument.read_register(utils.REG_FILTER)))
+        ]
+
+    def set_filter(self, freq):
+        """Set the filter of the device to an output rate in Hz of freq_dict"""
+
+        codes = {j: i for i, j in utils.freq_dict.items()}
+
+        if freq not in codes:
+            raise ValueError(
+                f"Filter rate {freq} Hz not supported, use one of "
+                f"{list(utils.freq_dict.values())}"
+            )
+
+        self.instrument.write_register(
+            utils.REG_FILTER, int(codes[freq]), functioncode=6
+        )
+
+    def configure(self, config):
+
+        if "filter" in config.keys():
+            self.set_filter(config["filter"])
+            journal.event("config_sent", self.name, config["filter"])
+
+        if "zero" in config.keys():
+            self.instrument.write_register(
+                utils.REG_ZERO, int(bool(config["zero"])), functioncode=6
+            )
+
+        filter_rate = self.get_filter()
+
+        # New data are available at the filter rate, a faster polling would
+        # only read the same values again
+        self.rate = min(config.get("rate", filter_rate), filter_rate)
+
+        self.metadata = {"filter": filter_rate, "rate": self.rate}
+
+        logger.info(f"{self.name}: filter {filter_rate} Hz, polling at {self.rate} Hz")
+
+    def read(self):
+        """Read angles and temperature with a single block transaction
+
+        Return:
+            msg (bytes): binary record of the poll, see level_utils.RECORD
+        """
+
+        registers = self.instrument.read_registers(utils.REG_BLOCK, utils.BLOCK_SIZE)
+
+        return utils.pack(time.time(), registers)
+
+    def read_continous_binary(self, fs, flag, sensor_lock):
+
+        period = int(1e9 / self.rate)
+        start = time.monotonic_ns()
+        slot = 0
+
+        while not flag.is_set():
+            wait = start + slot * period - time.monotonic_ns()
+            if wait > 0 and flag.wait(wait / 1e9):
+                break
+
+            sensor_lock.acquire()
+            try:
+                msg = self.read()
+            except (IOError, ValueError) as err:
+                msg = None
+                self.errors += 1
+                logger.warning(f"{self.name}: poll failed, {err}")
+            finally:
+                sensor_lock.release()
+
+            if msg is not None:
+                fs.write(msg)
+                self.polls += 1
+
+                if "first_time" not in self.metadata:
+                    self.metadata["first_time"] = time.time()
+                self.metadata["last_time"] = time.time()
+
+            # Skip the polls that are already late
+            slot += 1
+            late = (time.monotonic_ns() - start) // period + 1
+            if late > slot:
+                self.missed += late - slot
+                slot = late
+
+        self.close()
+
+    def close(self):
+
+        self.instrument.serial.close()
+
+        self.metadata["polls"] = self.polls
+
+        logger.info(
+            f"{self.name}: {self.polls} polls, {self.errors} errors, "
+            f"{self.missed} polls skipped"
+        )
+
+        logging.info(f"Closed sensor {self.name}")
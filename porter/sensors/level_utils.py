@@ -0,0 +1,116 @@
+import os
+import struct
+
+import numpy as np
+
+# Output rate in Hz of the filter for each value of the filter register
+freq_dict = {
+    "1": 0.125,
+    "2": 0.25,
+    "3": 0.5,
+    "4": 1,
+    "5": 2,
+    "6": 4,
+    "7": 8,
+    "8": 16,
+}
+
+# Holding registers of the inclinometer
+REG_BLOCK = 0
+BLOCK_SIZE = 8
+REG_FILTER = 9
+REG_ZERO = 20
+
+
+# Record written by Level.read_continous_binary for each poll: time.time() of
+# the reply, angles in mdeg and temperature in 0.01 C
+RECORD = np.dtype(
+    [
+        ("time", "<f8"),
+        ("angle_x", "<i4"),
+        ("angle_y", "<i4"),
+        ("temperature", "<i2"),
+    ]
+)
+
+# Scale of the fields, the values are divided by it
+SCALE = {
+    "angle_x": 1000,
+    "angle_y": 1000,
+    "temperature": 100,
+}
+
+_PACK = struct.Struct("<diih")
+_WORDS = struct.Struct(">4H")
+_ANGLES = struct.Struct(">2l")
+
+
+def pack(t, registers):
+    """Record of a poll from the block of registers 0 to 7
+
+    Args:
+        t (float): time.time() of the poll
+        registers (list): unsigned 16 bit registers read from the device, the
+                          angles are signed 32 bit values in registers 0-1 and
+                          2-3 and the temperature a signed 16 bit value in 7
+    """
+
+    angle_x, angle_y = _ANGLES.unpack(_WORDS.pack(*registers[:4]))
+
+    temperature = registers[7] - 0x10000 if registers[7] & 0x8000 else registers[7]
+
+    return _PACK.pack(t, angle_x, angle_y, temperature)
+
+
+def open_records(filename):
+    """Memory map the complete records of a level binary file
+
+    Args:
+        filename (str): name of the binary file
+
+    Return:
+        records (np.memmap): structured array with the records
+    """
+
+    count = os.path.getsize(filename) // RECORD.itemsize
+
+    if count == 0:
+        return np.zeros(0, dtype=RECORD)
+
+    return np.memmap(filename, dtype=RECORD, mode="r", shape=(count,))
+
+
+def iter_records(filename, chunk_size=1 << 20, start=0):
+    """Iterate over the records of a level binary file in chunks
+
+    Args:
+        filename (str): name of the binary file
+        chunk_size (int): maximum number of records read at once
+        start (int): index of the first record
+
+    Yield:
+        records (np.ndarray): structured array with the records of the chunk
+    """
+
+    records = open_records(filename)
+
+    for i in range(start, records.size, chunk_size):
+        yield np.array(records[i : i + chunk_size])
+
+
+def decode(records):
+    """Angles in deg and temperature in C of the records
+
+    Args:
+        records (np.ndarray): structured array with the records
+
+    Return:
+        data (dict): time and an array for each field
+    """
+
+    data = {"time": np.array(records["time"])}
+
+    for i in SCALE.keys():
+        data[i] = records[i] / SCALE[i]
+
+    return data
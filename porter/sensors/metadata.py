@@ -0,0 +1,71 @@
+import os
+
+import yaml
+
+
+def filename(datafile):
+    """Name of the metadata file saved next to a sensor data file"""
+
+    return os.path.splitext(datafile)[0] + ".yml"
+
+
+def save(datafile, metadata):
+    """Save the metadata of a sensor data file
+
+    Args:
+        datafile (str): name of the binary file with the sensor data
+        metadata (dict): dictionary with the sensor information, configuration
+                         and any layout needed to decode the file
+    """
+
+    with open(filename(datafile), "w") as fd:
+        yaml.safe_dump(metadata, fd, sort_keys=False)
+
+
+def load(datafile):
+    """Load the metadata of a sensor data file, if it exists"""
+
+    if not os.path.exists(filename(datafile)):
+        return {}
+
+    with open(filename(datafile), "r") as fd:
+        return yaml.safe_load(fd)
+
+
+def checkpoint_filename(datafile):
+    """Name of the file with the decoding progress of a sensor data file"""
+
+    path, name = os.path.split(os.path.splitext(datafile)[0])
+
+    return os.path.join(path, "decoded", name + ".checkpoint.yml")
+
+
+def load_checkpoint(datafile):
+    """Load the decoding progress of a sensor data file
+
+    Return:
+        checkpoint (dict): offset of the end of the data already decoded and
+                           size of the file at that time, empty if the file
+                           was never decoded incrementally
+    """
+
+    if not os.path.exists(checkpoint_filename(datafile)):
+        return {}
+
+    with open(checkpoint_filename(datafile), "r") as fd:
+        return yaml.safe_load(fd) or {}
+
+
+def save_checkpoint(datafile, checkpoint):
+    """Save the decoding progress of a sensor data file
+
+    The file is replaced atomically, so that an interrupted decoding never
+    leaves a partial checkpoint.
+    """
+
+    tmp = checkpoint_filename(datafile) + ".tmp"
+
+    with open(tmp, "w") as fd:
+        yaml.safe_dump(checkpoint, fd, sort_keys=False)
+
+    os.replace(tmp, checkpoint_filename(datafile))
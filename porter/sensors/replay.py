@@ -0,0 +1,629 @@
+import logging
+import os
+import struct
+import time
+import types
+
+import numpy as np
+
+import porter.align as align
+import porter.sensors.ads1015_utils as ads
+import porter.sensors.KERNEL_utils as kernel
+import porter.sensors.level_utils as level
+import porter.sensors.metadata as metadata
+import porter.sensors.sensors_db.compiled as compiled
+import porter.sensors.sensors_db.KERNEL as Kdb
+
+logger = logging.getLogger()
+
+
+class ReplaySerial:
+
+    def __init__(
+        self,
+        data,
+        rate,
+        speed=1.0,
+        loop=True,
+        timeout=1,
+        replies=None,
+        sync=None,
+        idle=False,
+    ):
+        """Serial-like connection that replays a recorded byte stream
+
+        The bytes become available at the rate of the original stream, so
+        the drivers read them as they would from the sensor. The replies to
+        the commands written, e.g. the ACKs of a configuration, are inserted
+        in the stream before the next frame.
+
+        Parameters:
+            data (bytes): recorded stream, e.g. a memory map of a .bin file
+            rate (float): bytes per second of the original stream
+            speed (float): replay speed, 2 replays twice as fast
+            loop (bool): if True, the stream starts again at the end
+            timeout (float): longest wait in s of a read, as serial.Serial
+            replies (callable): reply in bytes to the data written, or None
+            sync (bytes): start of the frames of the stream
+            idle (bool): if True, the stream starts at the first write, as a
+                         sensor that sends data only once configured
+        """
+
+        self.data = np.frombuffer(data, dtype=np.uint8)
+        self.rate = rate * speed
+        self.loop = loop
+        self.timeout = timeout
+
+        self.replies = replies
+        self.sync = sync
+
+        self.is_open = True
+        self.baudrate = None
+
+        self.position = 0
+        self.written = bytearray()
+
+        # Replies waiting for the next frame and replies being read
+        self._inserts = []
+        self._buffer = bytearray()
+
+        self._t0 = None if idle else time.monotonic()
+
+    def _produced(self):
+
+        if self._t0 is None:
+            return 0
+
+        count = int((time.monotonic() - self._t0) * self.rate)
+
+        return count if self.loop else min(count, self.data.size)
+
+    @property
+    def in_waiting(self):
+
+        return self._produced() - self.position + len(self._buffer)
+
+    def inWaiting(self):
+
+        return self.in_waiting
+
+    def _next_frame(self):
+        """Position of the start of the next frame in the stream"""
+
+        if self.sync is None or self.position == 0:
+            return self.position
+
+        chunk = 1 << 16
+        for i in range(self.position, self.position + self.data.size, chunk):
+            idx = np.arange(i, i + chunk + len(self.sync) - 1) % self.data.size
+            found = self.data[idx].tobytes().find(self.sync)
+            if found >= 0:
+                return i + found
+
+        return self.position
+
+    def read(self, size=1):
+
+        deadline = time.monotonic() + (self.timeout or 0)
+
+        while self.in_waiting < size and time.monotonic() < deadline:
+            if not self.loop and self._produced() == self.data.size:
+                break
+            time.sleep(min(max(size - self.in_waiting, 1) / self.rate, 0.01))
+
+        msg = bytearray()
+
+        while len(msg) < size:
+            if self._inserts and self._inserts[0][0] == self.position:
+                self._buffer += self._inserts.pop(0)[1]
+
+            if len(self._buffer) > 0:
+                count = min(size - len(msg), len(self._buffer))
+                msg += self._buffer[:count]
+                del self._buffer[:count]
+                continue
+
+            count = min(size - len(msg), self._produced() - self.position)
+            if self._inserts:
+                count = min(count, self._inserts[0][0] - self.position)
+            if count <= 0:
+                break
+
+            idx = np.arange(self.position, self.position + count) % self.data.size
+            msg += self.data[idx].tobytes()
+            self.position += count
+
+        return bytes(msg)
+
+    def read_until(self, expected=b"\n", size=None):
+
+        msg = b""
+        while not msg.endswith(expected) and (size is None or len(msg) < size):
+            byte = self.read(1)
+            if len(byte) == 0:
+                break
+            msg += byte
+
+        return msg
+
+    def write(self, data):
+
+        self.written += data
+
+        reply = self.replies(bytes(data)) if self.replies is not None else None
+        if reply:
+            self._inserts.append((self._next_frame(), reply))
+
+        if self._t0 is None:
+            self._t0 = time.monotonic()
+
+        return len(data)
+
+    def reset_input_buffer(self):
+
+        self.position = self._produced()
+        self._buffer.clear()
+
+    def flush(self):
+        pass
+
+    def close(self):
+
+        self.is_open = False
+
+
+class ReplayI2C:
+
+    def __init__(self, times, values, speed=1.0, loop=True):
+        """lgpio-like connection of the ADS1015 replaying recorded samples
+
+        The conversion register holds the last sample whose time has passed,
+        as the ADC does, so the driver samples it at its own rate.
+
+        Parameters:
+            times (np.ndarray): time of the samples
+            values (np.ndarray): value of the samples in V
+            speed (float): replay speed, 2 replays twice as fast
+            loop (bool): if True, the samples start again at the end
+        """
+
+        self.times = np.asarray(times, dtype=np.float64) - times[0]
+        self.values = np.asarray(values, dtype=np.float64)
+        self.speed = speed
+        self.loop = loop
+
+        # Multiplier of the raw counts of the driver, set after configure
+        self.gain = None
+
+        self._duration = self.times[-1] + np.median(np.diff(self.times))
+        self._t0 = time.monotonic()
+
+    def i2c_open(self, bus, address):
+
+        return 0
+
+    def i2c_write_i2c_block_data(self, handle, register, data):
+        pass
+
+    def i2c_read_i2c_block_data(self, handle, register, count):
+
+        elapsed = (time.monotonic() - self._t0) * self.speed
+        if self.loop:
+            elapsed %= self._duration
+
+        idx = max(np.searchsorted(self.times, elapsed, side="right") - 1, 0)
+
+        raw = int(round(self.values[idx] * 4096 / (self.gain or 1)))
+        raw = (min(max(raw, -2048), 2047) & 0xFFF) << 4
+
+        return 2, [raw >> 8, raw & 0xFF]
+
+
+class ReplayModbus:
+
+    def __init__(self, times, registers, holding=None, speed=1.0, loop=True):
+        """minimalmodbus-like instrument replaying recorded polls of the level
+
+        Parameters:
+            times (np.ndarray): time of the polls
+            registers (np.ndarray): registers 0 to 7 of each poll
+            holding (dict): value of the other registers, e.g. the filter
+            speed (float): replay speed, 2 replays twice as fast
+            loop (bool): if True, the polls start again at the end
+        """
+
+        self.times = np.asarray(times, dtype=np.float64) - times[0]
+        self.registers = np.asarray(registers)
+        self.holding = dict(holding or {})
+        self.speed = speed
+        self.loop = loop
+
+        self.serial = types.SimpleNamespace(
+            baudrate=None, timeout=None, close=lambda: None
+        )
+
+        self._duration = self.times[-1] + (
+            np.median(np.diff(self.times)) if self.times.size > 1 else 1.0
+        )
+        self._t0 = time.monotonic()
+
+    def read_registers(self, start, count):
+
+        elapsed = (time.monotonic() - self._t0) * self.speed
+        if self.loop:
+            elapsed %= self._duration
+
+        idx = max(np.searchsorted(self.times, elapsed, side="right") - 1, 0)
+
+        return [int(i) for i in self.registers[idx, start : start + count]]
+
+    def read_register(self, register, **kwargs):
+
+        return self.holding.get(register, 0)
+
+    def write_register(self, register, value, **kwargs):
+
+        self.holding[register] = value
+
+
+class Idle:
+
+    def __init__(self, name):
+        """Sensor without a replay, which only waits for the end of the run"""
+
+        self.name = name
+
+        logger.info(f"Created idle sensor for {name}")
+
+    def configure(self, config):
+        pass
+
+    def read_continous_binary(self, fs, flag, sensor_lock):
+
+        flag.wait()
+
+        self.close()
+
+    def close(self):
+
+        logger.info(f"Closed idle sensor {self.name}")
+
+
+def _fletcher(body):
+    """UBX checksum of the class, id, length and payload of each row"""
+
+    body = body.astype(np.int64)
+    n = body.shape[1]
+
+    ck_a = body.sum(axis=1) & 0xFF
+    ck_b = (body * np.arange(n, 0, -1)).sum(axis=1) & 0xFF
+
+    return np.stack([ck_a, ck_b], axis=1).astype(np.uint8)
+
+
+def ubx_frames(name, payloads):
+    """UBX frames of a message with a fixed payload
+
+    Args:
+        name (str): name of the message, e.g. NAV-PVT
+        payloads (np.ndarray): structured array with the payload dtype of the
+                               message in the sensors db
+
+    Return:
+        frames (bytes): frames one after the other
+    """
+
+    msg_class, msg_id = compiled.ubx_ids(name)
+
+    size = payloads.dtype.itemsize
+    count = payloads.size
+
+    body = np.zeros((count, 4 + size), dtype=np.uint8)
+    body[:, 0] = msg_class
+    body[:, 1] = msg_id
+    body[:, 2:4] = np.frombuffer(struct.pack("<H", size), dtype=np.uint8)
+    body[:, 4:] = payloads.view(np.uint8).reshape(count, size)
+
+    frames = np.zeros((count, 6 + size + 2), dtype=np.uint8)
+    frames[:, 0:2] = [0xB5, 0x62]
+    frames[:, 2:-2] = body
+    frames[:, -2:] = _fletcher(body)
+
+    return frames.tobytes()
+
+
+def _fixed_ubx(name):
+    """Check that a UBX message is in the db and has a fixed payload"""
+
+    try:
+        return compiled.ubx_message(*compiled.ubx_ids(name))[1] is not None
+    except KeyError:
+        return False
+
+
+def ubx_frame(msg_class, msg_id, payload):
+    """Single UBX frame"""
+
+    body = np.frombuffer(
+        bytes([msg_class, msg_id]) + struct.pack("<H", len(payload)) + payload,
+        dtype=np.uint8,
+    )
+
+    return b"\xb5\x62" + body.tobytes() + _fletcher(body[np.newaxis])[0].tobytes()
+
+
+def ubx_ack(command):
+    """ACK-ACK of the u-blox to a CFG message, None for other messages"""
+
+    if command[:2] != b"\xb5\x62" or len(command) < 4 or command[2] != 0x06:
+        return None
+
+    return ubx_frame(0x05, 0x01, command[2:4])
+
+
+def synthetic_ubx(duration, rate=1.0, messages=("NAV-POSLLH",), start=None):
+    """Stream of UBX messages with a fixed payload, e.g. for a GPS replay
+
+    The iTOW of the messages follows the GPS time from start and the other
+    fields are a slow random walk.
+
+    Return:
+        data (bytes): stream of duration s
+        rate (float): bytes per second of the stream
+    """
+
+    if start is None:
+        start = time.time()
+
+    count = max(int(duration * rate), 1)
+    t = start + np.arange(count) / rate
+    tow = (t - align.GPS_EPOCH + align.GPS_LEAP_SECONDS) % align.WEEK
+
+    rng = np.random.default_rng()
+
+    streams = []
+    for name in messages:
+        dtype = compiled.ubx_message(*compiled.ubx_ids(name))[1]
+
+        payloads = np.zeros(count, dtype=dtype)
+        for i in dtype.names:
+            if i == "iTOW":
+                payloads[i] = np.round(tow * 1e3)
+            elif dtype[i].kind in "iu" and dtype[i].itemsize >= 4:
+                payloads[i] = np.cumsum(rng.integers(-10, 11, count))
+
+        streams.append(np.frombuffer(ubx_frames(name, payloads), dtype=np.uint8))
+
+    # Messages of the same epoch one after the other
+    size = [i.size // count for i in streams]
+    data = np.concatenate([i.reshape(count, j) for i, j in zip(streams, size)], axis=1)
+
+    return data.tobytes(), data.size / count * rate
+
+
+def kernel_frames(layout, values):
+    """KERNEL frames of a layout with a valid checksum
+
+    Args:
+        layout (dict): layout of the payload, as the entries of Kdb.MODES
+        values (dict): raw value of the fields for each frame, the missing
+                       fields are 0
+
+    Return:
+        frames (bytes): frames one after the other
+    """
+
+    dtype = kernel.layout_dtype(layout)
+    count = len(next(iter(values.values()))) if values else 1
+
+    frames = np.zeros(count, dtype=dtype)
+    frames["_header"] = np.frombuffer(kernel.HEADER, "<u2")[0]
+    frames["_type"] = 1
+    frames["_address"] = layout["Address"][0]
+    frames["_length"] = dtype.itemsize - 2
+
+    for i, j in values.items():
+        frames[i] = j
+
+    raw = frames.view(np.uint8).reshape(count, dtype.itemsize)
+    frames["_checksum"] = raw[:, 2:-2].sum(axis=1, dtype=np.int64) & 0xFFFF
+
+    return frames.tobytes()
+
+
+def kernel_ack(command):
+    """Reply of the KERNEL to a command, with the checksum of the command"""
+
+    if command[:2] != kernel.HEADER:
+        return None
+
+    msg = kernel.HEADER + b"\x01\x00" + (8).to_bytes(2, "little") + command[-2:]
+
+    return msg + kernel._checksum(msg)
+
+
+def kernel_values(layout, t):
+    """Raw values of the fields of a layout at the times t in s
+
+    The angles are slow sines and the other fields noise around 0.
+    """
+
+    dtype = kernel.layout_dtype(layout)
+    names, scale = kernel.layout_scale(layout)
+
+    rng = np.random.default_rng()
+
+    values = {}
+    for name, val in zip(names, scale):
+        if name in ["Heading", "Pitch", "Roll"]:
+            signal = 10 * np.sin(2 * np.pi * t / 60) + 10
+        else:
+            signal = rng.normal(0, 0.01, t.size)
+
+        values[name] = np.round(signal * val)
+        if dtype[name].kind in "iu":
+            info = np.iinfo(dtype[name])
+            values[name] = np.clip(values[name], info.min, info.max)
+
+    return values
+
+
+def synthetic_kernel(duration, rate=100.0, mode="KERNEL_CalibHR"):
+    """Stream of KERNEL messages of a mode with a fixed layout
+
+    Return:
+        data (bytes): stream of duration s
+        rate (float): bytes per second of the stream
+    """
+
+    layout = Kdb.MODES[mode]
+
+    count = max(int(duration * rate), 1)
+    t = np.arange(count) / rate
+
+    data = kernel_frames(layout, kernel_values(layout, t))
+
+    return data, len(data) / duration
+
+
+def synthetic_adc(duration, rate=1600.0, amplitude=0.1, freq=1.0, noise=0.001):
+    """Sine with noise, sampled at rate Hz for duration s"""
+
+    t = np.arange(int(duration * rate)) / rate
+
+    rng = np.random.default_rng()
+
+    return t, amplitude * np.sin(2 * np.pi * freq * t) + rng.normal(0, noise, t.size)
+
+
+def level_registers(records):
+    """Registers 0 to 7 of the polls of the level, from its records"""
+
+    registers = np.zeros((records.size, 8), dtype=np.int64)
+
+    for i, name in [(0, "angle_x"), (2, "angle_y")]:
+        value = records[name].astype(np.int64) & 0xFFFFFFFF
+        registers[:, i] = value >> 16
+        registers[:, i + 1] = value & 0xFFFF
+
+    registers[:, 7] = records["temperature"].astype(np.int64) & 0xFFFF
+
+    return registers
+
+
+def _rate(filename, info):
+    """Bytes per second of a recorded stream, from the times in its metadata"""
+
+    first = info.get("first_time")
+    last = info.get("last_time")
+
+    if first is None or last is None or last <= first:
+        raise ValueError(f"No first_time and last_time in the metadata of {filename}")
+
+    return os.path.getsize(filename) / (last - first)
+
+
+def connect(sensor_params):
+    """Replay connection of a sensor for the local development
+
+    The replay section of the sensor configuration gives a recorded .bin
+    file or the parameters of a synthetic stream:
+
+        replay:
+          file: data/20260101_120000/sensors_data/ZED-F9P_20260101.bin
+          speed: 4
+          loop: True
+          synthetic: {duration: 60, rate: 10}
+
+    Return:
+        conn: object to be passed as conn to the driver, None if the sensor
+              type cannot be replayed
+    """
+
+    sensor_type = sensor_params["sensor_info"]["type"].lower()
+
+    replay = sensor_params.get("replay") or {}
+    filename = replay.get("file")
+    speed = replay.get("speed", 1.0)
+    loop = replay.get("loop", True)
+    synthetic = replay.get("synthetic") or {}
+
+    if filename is not None:
+        filename = os.path.expanduser(filename)
+        info = metadata.load(filename)
+        logger.info(f"Replaying {filename} for {sensor_params['name']} x{speed}")
+
+    if sensor_type == "gps":
+        if filename is not None:
+            data = np.memmap(filename, dtype=np.uint8, mode="r")
+            rate = _rate(filename, info)
+        else:
+            # Rate and NAV messages of the configuration, when they are known
+            config = sensor_params.get("configuration") or {}
+            defaults = {"duration": 60}
+            if "RATE" in config.keys():
+                defaults["rate"] = config["RATE"]["value"]
+            nav = config.get("UBX_MSG", {}).get("NAV", [])
+            nav = [i for i in ["NAV-" + j for j in nav] if _fixed_ubx(i)]
+            if len(nav) > 0:
+                defaults["messages"] = nav
+
+            data, rate = synthetic_ubx(**{**defaults, **synthetic})
+
+        return ReplaySerial(
+            data, rate, speed=speed, loop=loop, replies=ubx_ack, sync=b"\xb5\x62"
+        )
+
+    elif sensor_type == "inclinometer":
+        if filename is not None:
+            if kernel.is_pickled(filename):
+                filename = kernel.convert_pickled(filename)
+            data = np.memmap(filename, dtype=np.uint8, mode="r")
+            rate = _rate(filename, info)
+        else:
+            mode = sensor_params.get("configuration", {}).get("mode", "KERNEL_CalibHR")
+            data, rate = synthetic_kernel(**{"duration": 60, "mode": mode, **synthetic})
+
+        # The KERNEL sends data only after the command of the mode
+        return ReplaySerial(
+            data,
+            rate,
+            speed=speed,
+            loop=loop,
+            replies=kernel_ack,
+            sync=kernel.HEADER,
+            idle=True,
+        )
+
+    elif sensor_type == "adc":
+        if filename is not None:
+            records, _ = ads.split_markers(ads.open_records(filename))
+            t, values = records["time"], records["value"]
+        else:
+            t, values = synthetic_adc(**{"duration": 60, **synthetic})
+
+        return ReplayI2C(t, values, speed=speed, loop=loop)
+
+    elif sensor_type == "level":
+        filter_rate = sensor_params.get("configuration", {}).get("filter", 16)
+
+        if filename is not None:
+            records = level.open_records(filename)
+            t, registers = records["time"], level_registers(records)
+            filter_rate = info.get("filter", filter_rate)
+        else:
+            t = np.arange(int(synthetic.get("duration", 60) * filter_rate))
+            t = t / filter_rate
+            angles = np.zeros(t.size, dtype=level.RECORD)
+            angles["angle_x"] = 1000 * np.sin(2 * np.pi * t / 60)
+            angles["angle_y"] = 1000 * np.cos(2 * np.pi * t / 60)
+            angles["temperature"] = 2500
+            registers = level_registers(angles)
+
+        code = {j: int(i) for i, j in level.freq_dict.items()}[filter_rate]
+
+        return ReplayModbus(
+            t, registers, {level.REG_FILTER: code}, speed=speed, loop=loop
+        )
+
+    return None
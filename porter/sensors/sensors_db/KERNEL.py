@@ -9,6 +9,11 @@ WORD_LONG = 'I'
 SWORD_LONG = 'i'
 WORD_LONG_LONG = 'Q'
 
+BAUDRATES = [4800, 9600, 19200, 38400, 57600, 115200, 230400, 460800, 921600]
+
+# Start, stop and parity bits with some margin for the gaps between bytes
+BITS_PER_BYTE = 11
+
 
 USW_TABLE = {
     'low': [
@@ -36,23 +41,21 @@ USW_TABLE = {
 def extract_USW(USW):
 
     def check_byte(byte):
-        if isinstance(byte, int):
-            return bin(byte).lstrip('0b')
-        elif isinstance(byte, str):
-            return bin(int(byte, base=16)).lstrip('0b')
+        if isinstance(byte, str):
+            byte = int(byte, base=16)
+        return [(byte >> i) & 1 for i in range(8)]
 
     def check_values(bits, table):
-        count = 0
         tmp = ''
-        for i in bits:
-            if table[count] == 'reserved':
-                tmp = 'RES_'
+        for bit, name in zip(bits, table):
+            if name.lower() == 'reserved':
+                tmp += 'RES_'
             else:
-                if i == 1:
-                    tmp = 'KO_'
+                if bit == 1:
+                    tmp += 'KO_'
                 else:
-                    tmp = 'OK_'
-        
+                    tmp += 'OK_'
+
         return tmp[:-1]
 
     low = check_byte(USW[0])
@@ -0,0 +1,169 @@
+import os
+import pickle
+
+import numpy as np
+
+SOURCES = ["ublox.py", "KERNEL.py"]
+
+CACHE = os.path.join(os.path.dirname(__file__), "__pycache__", "compiled_db.pickle")
+
+# The ublox and KERNEL dictionaries are compiled into flat tables keyed by
+# the bytes found in the streams and saved in __pycache__. The tables are
+# loaded on first use and the db modules are imported again only when their
+# source files change. Run this module to build the tables ahead of time.
+_tables = None
+
+
+def _stamp():
+    """Modification time and size of the db source files"""
+
+    folder = os.path.dirname(__file__)
+
+    stamp = {}
+    for i in SOURCES:
+        info = os.stat(os.path.join(folder, i))
+        stamp[i] = (info.st_mtime_ns, info.st_size)
+
+    return stamp
+
+
+def _compile():
+
+    import porter.sensors.sensors_db.KERNEL as Kdb
+    import porter.sensors.sensors_db.ublox as Udb
+    import porter.sensors.ubx_utils as ubx
+
+    messages = {}
+    names = {}
+
+    for group in Udb.ubx_dict.values():
+        for key, msg in group.items():
+            if key == "char" or "payload" not in msg:
+                continue
+
+            dtype = ubx.payload_dtype(msg)
+
+            scales = {}
+            if dtype is not None:
+                for i in dtype.names:
+                    aux = msg.get("aux", {}).get(i)
+                    if isinstance(aux, list) and aux[0] != 1:
+                        scales[i] = aux[0]
+
+            ids = (group["char"][0], msg["char"][0])
+            messages[ids] = (msg["name"], dtype, scales)
+            names[msg["name"]] = ids
+
+    config_keys = {}
+    config_ids = {}
+
+    for key, (key_id, fmt) in Udb.UBX_CONFIG_DATABASE.items():
+        config_keys[key] = (key_id, fmt)
+        config_ids[key_id] = (key, fmt)
+
+    kernel_modes = {}
+    for key, mode in Kdb.MODES.items():
+        kernel_modes[mode["Address"][0]] = key
+
+    kernel_blocks = {}
+    for key, block in Kdb.User_Defined_Data.items():
+        kernel_blocks[block["Address"][0]] = key
+
+    return {
+        "ubx_messages": messages,
+        "ubx_names": names,
+        "config_keys": config_keys,
+        "config_ids": config_ids,
+        "kernel_modes": kernel_modes,
+        "kernel_blocks": kernel_blocks,
+    }
+
+
+def build():
+    """Compile the tables and save them in the cache"""
+
+    tables = _compile()
+
+    try:
+        os.makedirs(os.path.dirname(CACHE), exist_ok=True)
+
+        tmp = CACHE + "." + str(os.getpid())
+        with open(tmp, "wb") as fd:
+            pickle.dump({"stamp": _stamp(), "tables": tables}, fd)
+        os.replace(tmp, CACHE)
+    except OSError:
+        # Read-only installation, the tables are compiled at every run
+        pass
+
+    return tables
+
+
+def tables():
+    """Compiled tables, loaded from the cache or compiled on first use"""
+
+    global _tables
+
+    if _tables is None:
+        try:
+            with open(CACHE, "rb") as fd:
+                cache = pickle.load(fd)
+            if cache["stamp"] != _stamp():
+                raise ValueError("Outdated tables")
+            _tables = cache["tables"]
+        except (OSError, ValueError, KeyError, pickle.UnpicklingError, EOFError):
+            _tables = build()
+
+    return _tables
+
+
+def ubx_message(msg_class, msg_id):
+    """Name, payload dtype and scales of a UBX message
+
+    Args:
+        msg_class (int): class byte of the message
+        msg_id (int): id byte of the message
+
+    Return:
+        name (str): name of the message, e.g. NAV-PVT
+        dtype (np.dtype): dtype of the payload, None if it has repeated
+                          groups or a variable length
+        scales (dict): scale of the fields with a unit scale different from 1
+
+        None if the message is not in the db.
+    """
+
+    return tables()["ubx_messages"].get((int(msg_class), int(msg_id)))
+
+
+def ubx_ids(name):
+    """Class and id bytes of a UBX message from its name, e.g. NAV-PVT"""
+
+    return tables()["ubx_names"][name]
+
+
+def config_key(name):
+    """Key ID and type of a configuration key from its name"""
+
+    return tables()["config_keys"][name]
+
+
+def config_name(key_id):
+    """Name and type of a configuration key from its key ID"""
+
+    return tables()["config_ids"][key_id]
+
+
+def kernel_mode(address):
+    """Name of the KERNEL mode with a given address byte, None if unknown"""
+
+    return tables()["kernel_modes"].get(int(np.uint8(address)))
+
+
+def kernel_block(address):
+    """Name of the KERNEL user defined data block with a given address byte"""
+
+    return tables()["kernel_blocks"][int(np.uint8(address))]
+
+
+if __name__ == "__main__":
+    build()
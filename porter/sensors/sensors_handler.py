@@ -1,15 +1,21 @@
-import porter.sensors.FakeSensor as fake
 import porter.sensors.KERNEL as KERNEL
+import porter.sensors.replay as replay
 import porter.sensors.ubx as ubx
 
-import porter.sensors.ads1015 as ads
-
 try:
     import porter.sensors.ads1015 as ads
 except ModuleNotFoundError:
     pass
 
-import porter.sensors.mcp4725 as mcp
+try:
+    import porter.sensors.mcp4725 as mcp
+except ModuleNotFoundError:
+    pass
+
+try:
+    import porter.sensors.level as level
+except ModuleNotFoundError:
+    pass
 
 
 class Handler:
@@ -19,48 +25,87 @@ class Handler:
         self.sensor_params = sensor_params
         self.local = local
 
-    def _connection(self):
+        # Replay connection of the sensor in local development
+        self.replay = None
 
-        if self.local:
-            self.obj = fake.FakeConnection(self.sensor_params["name"])
+    def _connection(self):
 
-        else:
-            if self.sensor_params["sensor_info"]["type"].lower() == "gps":
+        conn = None
 
-                self.obj = ubx.UBX(
-                    port=self.sensor_params["connection"]["parameters"]["port"],
-                    baudrate=self.sensor_params["connection"]["parameters"]["baudrate"],
+        if self.local:
+            conn = replay.connect(self.sensor_params)
+            self.replay = conn
+
+            if conn is None:
+                self.obj = replay.Idle(self.sensor_params["name"])
+                return
+
+        if self.sensor_params["sensor_info"]["type"].lower() == "gps":
+
+            self.obj = ubx.UBX(
+                port=self.sensor_params["connection"]["parameters"]["port"],
+                baudrate=self.sensor_params["connection"]["parameters"]["baudrate"],
+                name=self.sensor_params["name"],
+                conn=conn,
+            )
+
+        elif self.sensor_params["sensor_info"]["type"].lower() == "adc":
+
+            self.obj = ads.ADS1015(
+                self.sensor_params["connection"]["parameters"]["channels"],
+                address=self.sensor_params["connection"]["parameters"]["address"],
+                bus=self.sensor_params["connection"]["parameters"]["bus"],
+                mode=self.sensor_params["connection"]["parameters"]["mode"],
+                name=self.sensor_params["name"],
+                conn=conn,
+            )
+
+        elif self.sensor_params["sensor_info"]["type"].lower() == "dac":
+
+            self.obj = mcp.MCP4725(
+                self.sensor_params["connection"]["parameters"]["address"],
+            )
+
+        elif self.sensor_params["sensor_info"]["type"].lower() == "inclinometer":
+            if (
+                self.sensor_params["sensor_info"]["manufacturer"].lower()
+                == "inertial_labs"
+            ):
+
+                self.obj = KERNEL.KernelInertial(
+                    self.sensor_params["connection"]["parameters"]["port"],
+                    self.sensor_params["connection"]["parameters"]["baudrate"],
                     name=self.sensor_params["name"],
+                    conn=conn,
                 )
 
-            elif self.sensor_params["sensor_info"]["type"].lower() == "adc":
+        elif self.sensor_params["sensor_info"]["type"].lower() == "level":
 
-                self.obj = ads.ADS1015(
-                    self.sensor_params["connection"]["parameters"]["channels"],
-                    address=self.sensor_params["connection"]["parameters"]["address"],
-                    bus=self.sensor_params["connection"]["parameters"]["bus"],
-                    mode=self.sensor_params["connection"]["parameters"]["mode"],
-                    name=self.sensor_params["name"],
-                )
+            self.obj = level.Level(
+                self.sensor_params["connection"]["parameters"]["port"],
+                self.sensor_params["connection"]["parameters"]["address"],
+                baudrate=self.sensor_params["connection"]["parameters"]["baudrate"],
+                name=self.sensor_params["name"],
+                conn=conn,
+            )
+
+    def _configuration(self):
 
-            elif self.sensor_params["sensor_info"]["type"].lower() == "dac":
+        self.obj.configure(self.sensor_params["configuration"])
 
-                self.obj = mcp.MCP4725(
-                    self.sensor_params["connection"]["parameters"]["address"],
-                )
+        # The replay gives the raw counts of the gain set by the configuration
+        if isinstance(self.replay, replay.ReplayI2C):
+            self.replay.gain = self.obj._gain
 
-            elif self.sensor_params["sensor_info"]["type"].lower() == "inclinometer":
-                if (
-                    self.sensor_params["sensor_info"]["manufacturer"].lower()
-                    == "inertial_labs"
-                ):
+    def _metadata(self):
 
-                    self.obj = KERNEL.KernelInertial(
-                        self.sensor_params["connection"]["parameters"]["port"],
-                        self.sensor_params["connection"]["parameters"]["baudrate"],
-                        name=self.sensor_params["name"],
-                    )
+        metadata = {
+            "name": self.sensor_params["name"],
+            "sensor_info": self.sensor_params["sensor_info"],
+            "configuration": self.sensor_params.get("configuration"),
+        }
 
-    def _configuration(self):
+        if hasattr(self.obj, "metadata"):
+            metadata.update(self.obj.metadata)
 
-        self.obj.configure(self.sensor_params["configuration"])
+        return metadata
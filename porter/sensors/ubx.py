@@ -4,18 +4,33 @@ import time
 import pyubx2 as ubx
 import serial
 
+import porter.journal as journal
+import porter.sensors.sensors_db.compiled as compiled
+
 logger = logging.getLogger()
 
+# Class of the navigation messages, their host times align the GPS clock
+NAV_CLASS = b"\x01"
+
 
 class UBX:
 
-    def __init__(self, port, baudrate, name):
+    def __init__(self, port, baudrate, name, conn=None):
 
         self.name = name
 
+        # Host time of the first and last navigation messages, used to align
+        # the host clock to the GPS time
+        self.metadata = {}
+
         self.__new_baudrate = False
 
-        if baudrate != 38400:
+        if conn is not None:
+            # Serial-like connection given by the caller, e.g. a replay
+            self.conn = conn
+            self.reader = ubx.UBXReader(self.conn, protfilter=2)
+
+        elif baudrate != 38400:
             self.__new_baudrate = True
             self.__port = port
             self.__brate = int(baudrate)
@@ -100,6 +115,12 @@ class UBX:
                 if isinstance(config[i], list):
                     keys.append((config[i][0], config[i][1]))
 
+        for key, _ in keys:
+            try:
+                compiled.config_key(key)
+            except KeyError:
+                logger.warning(f"Configuration key {key} not in the sensors db")
+
         cfgs = ubx.UBXMessage.config_set(layers, transaction, keys)
         serial_cfgs = cfgs.serialize()
 
@@ -125,6 +146,7 @@ class UBX:
                 logging.info(
                     f"Sent UBLOX configuration message {cfgs} - Count: {msg_count}"
                 )
+                journal.event("config_sent", self.name, len(keys))
                 tm = time.perf_counter()
 
             parsed_data = self.read(parsing=True)
@@ -142,6 +164,8 @@ class UBX:
                     break
                 count += 1
 
+            journal.event("config_ack", self.name, parsed_data.identity == "ACK-ACK", i)
+
             while time.perf_counter() - tm < 1:
                 _ = self.read(parsing=True)
 
@@ -155,6 +179,8 @@ class UBX:
             )
             self.conn.write(msg_baud.serialize())
 
+            journal.event("baudrate", self.name, self.__brate)
+
             while time.perf_counter() - t0 <= 1.0:
                 pass
 
@@ -177,8 +203,18 @@ class UBX:
             sensor_lock.acquire()
             msg = self.read()
             sensor_lock.release()
+
+            # No message before the timeout of the connection
+            if msg is None:
+                continue
+
             fs.write(msg)
 
+            if msg[2:3] == NAV_CLASS:
+                if "first_time" not in self.metadata:
+                    self.metadata["first_time"] = time.time()
+                self.metadata["last_time"] = time.time()
+
         self.close()
 
     def read(self, parsing=False):
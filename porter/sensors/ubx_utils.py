@@ -0,0 +1,456 @@
+import os
+import struct
+
+import numpy as np
+
+import porter.sensors.sensors_db.compiled as compiled
+
+SYNC = b"\xb5\x62"
+
+# Largest possible UBX frame: sync, class, id, length, 65535 bytes payload, checksum
+MAX_FRAME = 65535 + 8
+
+# Little endian numpy types of the struct formats used in the sensors db
+STRUCT_DTYPES = {
+    "B": "u1",
+    "b": "i1",
+    "H": "<u2",
+    "h": "<i2",
+    "I": "<u4",
+    "i": "<i4",
+    "L": "<u4",
+    "l": "<i4",
+    "f": "<f4",
+    "d": "<f8",
+    "c": "S1",
+}
+
+
+def _as_buffer(source):
+    """Return a uint8 view of a filename, bytes-like object or array"""
+
+    if isinstance(source, np.ndarray):
+        return source.view(np.uint8)
+    elif isinstance(source, str):
+        if os.path.getsize(source) == 0:
+            return np.zeros(0, dtype=np.uint8)
+        return np.memmap(source, dtype=np.uint8, mode="r")
+    else:
+        return np.frombuffer(source, dtype=np.uint8)
+
+
+def _u16(buf, pos):
+
+    return buf[pos].astype(np.int64) | (buf[pos + 1].astype(np.int64) << 8)
+
+
+def _u32(buf, pos):
+
+    val = buf[pos].astype(np.uint32)
+    for i in range(1, 4):
+        val |= buf[pos + i].astype(np.uint32) << (8 * i)
+
+    return val
+
+
+def _bitfield(word, field):
+    """Extract a field described in the sensors db from an array of words"""
+
+    val = (word.astype(np.int64) >> field["start"]) & ((1 << field["length"]) - 1)
+
+    if field["type"] == "signed":
+        sign = 1 << (field["length"] - 1)
+        val = (val ^ sign) - sign
+
+    return val
+
+
+def find_frames(buf):
+    """Find all the complete UBX frames with a valid checksum in a buffer
+
+    The Fletcher checksum of every candidate frame is computed at once from
+    the cumulative sums of the buffer, so that the buffer is scanned without
+    a Python loop over the bytes. The sums are allowed to wrap around since
+    only the last byte is used.
+
+    Args:
+        buf (np.ndarray): uint8 array with the data
+
+    Return:
+        starts (np.ndarray): index of the sync chars of each frame
+        lengths (np.ndarray): payload length of each frame
+    """
+
+    n = buf.size
+
+    starts = np.flatnonzero((buf[:-1] == SYNC[0]) & (buf[1:] == SYNC[1]))
+    starts = starts[starts + 8 <= n]
+
+    lengths = _u16(buf, starts + 4)
+    ends = starts + 8 + lengths
+
+    complete = ends <= n
+    starts, lengths, ends = starts[complete], lengths[complete], ends[complete]
+
+    if starts.size == 0:
+        return starts, lengths
+
+    data = buf.astype(np.uint64)
+    zero = np.zeros(1, dtype=np.uint64)
+    sum_a = np.concatenate((zero, np.cumsum(data)))
+    sum_b = np.concatenate((zero, np.cumsum(data * np.arange(n, dtype=np.uint64))))
+
+    first = (starts + 2).astype(np.intp)
+    last = (ends - 2).astype(np.intp)
+
+    ck_a = sum_a[last] - sum_a[first]
+    ck_b = last.astype(np.uint64) * ck_a - (sum_b[last] - sum_b[first])
+
+    valid = (buf[last] == (ck_a & np.uint64(0xFF))) & (
+        buf[last + 1] == (ck_b & np.uint64(0xFF))
+    )
+
+    starts, lengths, ends = starts[valid], lengths[valid], ends[valid]
+
+    # A sync pattern inside a payload can only very rarely carry a valid
+    # checksum, so the overlaps are resolved in a loop over frames only
+    if starts.size > 1 and np.any(starts[1:] < ends[:-1]):
+        keep = np.zeros(starts.size, dtype=bool)
+        last_end = -1
+        for i, (start, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+            if start >= last_end:
+                keep[i] = True
+                last_end = end
+        starts, lengths = starts[keep], lengths[keep]
+
+    return starts, lengths
+
+
+def last_frame_end(source, start=0):
+    """Find the end of the last complete and valid frame of a UBX stream
+
+    Only the end of the stream is scanned, with a window that is enlarged
+    until a frame is found, so that a growing file can be checked quickly.
+
+    Args:
+        source (str, bytes or np.ndarray): filename or data with the stream
+        start (int): offset where the search stops, e.g. the end of the data
+                     already decoded
+
+    Return:
+        end (int): offset after the last frame, or start if there is none
+    """
+
+    data = _as_buffer(source)
+
+    window = 1 << 16
+    while True:
+        first = max(start, data.size - window)
+        starts, lengths = find_frames(np.asarray(data[first:]))
+
+        if starts.size > 0:
+            return first + int(starts[-1] + lengths[-1]) + 8
+        elif first == start:
+            return start
+
+        window *= 4
+
+
+def _iter_chunks(data, chunk_size):
+    """Find the frames of a stream in chunks, with the offset of each chunk"""
+
+    offset = 0
+    while offset < data.size - 8:
+        stop = offset + chunk_size
+        buf = np.asarray(data[offset : stop + MAX_FRAME])
+
+        starts, lengths = find_frames(buf)
+
+        inside = starts < chunk_size
+        starts, lengths = starts[inside], lengths[inside]
+
+        if starts.size > 0:
+            stop = max(stop, offset + int(starts[-1] + lengths[-1]) + 8)
+
+        yield offset, buf, starts, lengths
+
+        offset = stop
+
+
+def iter_frames(source, msg_class=None, msg_id=None, chunk_size=1 << 22):
+    """Iterate over a UBX stream in chunks of bounded size
+
+    Args:
+        source (str, bytes or np.ndarray): filename or data with the stream
+        msg_class (bytes): if given, only the frames of this class are returned
+        msg_id (bytes): if given, only the frames with this id are returned
+        chunk_size (int): number of bytes scanned for each chunk
+
+    Yield:
+        buf (np.ndarray): uint8 array with the data of the chunk
+        starts (np.ndarray): index in buf of the sync chars of each frame
+        lengths (np.ndarray): payload length of each frame
+    """
+
+    for _, buf, starts, lengths in _iter_chunks(_as_buffer(source), chunk_size):
+        if starts.size == 0:
+            continue
+
+        if msg_class is not None:
+            sel = buf[starts + 2] == msg_class[0]
+            if msg_id is not None:
+                sel &= buf[starts + 3] == msg_id[0]
+            starts, lengths = starts[sel], lengths[sel]
+
+        yield buf, starts, lengths
+
+
+def index_frames(source, chunk_size=1 << 22):
+    """Position of all the valid frames of a UBX stream
+
+    Args:
+        source (str, bytes or np.ndarray): filename or data with the stream
+        chunk_size (int): number of bytes scanned for each chunk
+
+    Return:
+        starts (np.ndarray): offset of the sync chars of each frame
+        lengths (np.ndarray): payload length of each frame
+    """
+
+    starts, lengths = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+
+    for offset, _, i, j in _iter_chunks(_as_buffer(source), chunk_size):
+        starts.append(i + offset)
+        lengths.append(j)
+
+    return np.concatenate(starts), np.concatenate(lengths)
+
+
+def payload_dtype(msg):
+    """Numpy dtype of a fixed length payload described in the sensors db
+
+    Fields made of several values, e.g. reserved bytes, are kept as raw
+    bytes. Bitfields are returned as the whole word.
+
+    Args:
+        msg (dict): entry of the sensors db with the payload of the message
+
+    Return:
+        dtype (np.dtype): dtype of the payload, None if the payload has
+                          repeated groups or a variable length
+    """
+
+    fields = []
+
+    for name, fmt in msg["payload"].items():
+        if isinstance(fmt, tuple):
+            fmt = fmt[0]
+
+        if not isinstance(fmt, str) or any(i not in STRUCT_DTYPES for i in fmt):
+            return None
+
+        if len(fmt) == 1:
+            fields.append((name, STRUCT_DTYPES[fmt]))
+        else:
+            fields.append((name, "V" + str(struct.calcsize("<" + fmt))))
+
+    return np.dtype(fields)
+
+
+def iter_messages(source, msg_class, msg, chunk_size=1 << 22):
+    """Decode all the messages of a given type in a UBX stream in chunks
+
+    Args:
+        source (str, bytes or np.ndarray): filename or data with the stream
+        msg_class (dict): entry of the sensors db with the message class,
+                          e.g. nav_dict
+        msg (dict): entry of the sensors db with the message
+
+    Yield:
+        decoded (dict): dictionary with an array for each numeric field of
+                        the payload, scaled according to the sensors db
+    """
+
+    dtype = payload_dtype(msg)
+
+    scales = {}
+    for i in dtype.names:
+        aux = msg.get("aux", {}).get(i)
+        if isinstance(aux, list) and aux[0] != 1:
+            scales[i] = aux[0]
+
+    yield from _iter_records(
+        source, msg_class["char"], msg["char"], dtype, scales, chunk_size
+    )
+
+
+def iter_named(source, name, chunk_size=1 << 22):
+    """Decode all the messages of a given type in a UBX stream in chunks
+
+    Same as iter_messages, with the dtype and scales of the message taken
+    from the compiled tables instead of the sensors db.
+
+    Args:
+        source (str, bytes or np.ndarray): filename or data with the stream
+        name (str): name of the message, e.g. NAV-PVT
+    """
+
+    msg_class, msg_id = compiled.ubx_ids(name)
+    _, dtype, scales = compiled.ubx_message(msg_class, msg_id)
+
+    yield from _iter_records(
+        source, bytes([msg_class]), bytes([msg_id]), dtype, scales, chunk_size
+    )
+
+
+def decode_frames(buf, starts, dtype, scales):
+    """Decode the fixed length payloads of frames of the same type
+
+    Args:
+        buf (np.ndarray): uint8 data with the frames
+        starts (np.ndarray): offset of the sync chars of each frame
+        dtype (np.dtype): dtype of the payload
+        scales (dict): scale of the fields
+
+    Return:
+        data (dict): array of each field, without the reserved bytes
+    """
+
+    idx = (starts + 6)[:, np.newaxis] + np.arange(dtype.itemsize)
+    records = buf[idx].view(dtype)[:, 0]
+
+    return {
+        i: records[i] * scales[i] if i in scales else records[i].copy()
+        for i in dtype.names
+        if dtype[i].kind != "V"
+    }
+
+
+def _iter_records(source, msg_class, msg_id, dtype, scales, chunk_size):
+
+    for buf, starts, lengths in iter_frames(
+        source, msg_class, msg_id, chunk_size=chunk_size
+    ):
+        starts = starts[lengths == dtype.itemsize]
+
+        if starts.size == 0:
+            continue
+
+        yield decode_frames(buf, starts, dtype, scales)
+
+
+def _imu_scales(table):
+
+    scales = np.full(256, np.nan)
+    for key, entry in table.items():
+        if key != "ref_key":
+            scales[int(key)] = entry["scale"]
+
+    return scales
+
+
+def _esf_raw(buf, starts, lengths):
+
+    import porter.sensors.sensors_db.ublox as Udb
+
+    fields = Udb.esf_dict["RAW"]["payload"]["group"][1]["data"][1]
+
+    blocks = (lengths - 4) // 8
+
+    base = np.repeat(starts + 6 + 4, blocks)
+    step = np.arange(blocks.sum()) - np.repeat(np.cumsum(blocks) - blocks, blocks)
+    pos = base + 8 * step
+
+    words = _u32(buf, pos)
+    ttag = _u32(buf, pos + 4)
+
+    return (
+        _bitfield(words, fields["dataType"]),
+        _bitfield(words, fields["dataField"]),
+        ttag,
+    )
+
+
+def _esf_meas(buf, starts, lengths):
+
+    import porter.sensors.sensors_db.ublox as Udb
+
+    payload = Udb.esf_dict["MEAS"]["payload"]
+    flags = payload["flags"][1]
+    fields = payload["group"][1]["data"][1]
+
+    blocks = _bitfield(_u16(buf, starts + 6 + 4), flags["numMeas"])
+    # numMeas is not always filled, fall back on the payload length
+    blocks = np.where(blocks > 0, blocks, (lengths - 8) // 4)
+
+    base = np.repeat(starts + 6 + 8, blocks)
+    step = np.arange(blocks.sum()) - np.repeat(np.cumsum(blocks) - blocks, blocks)
+    pos = base + 4 * step
+
+    words = _u32(buf, pos)
+    ttag = np.repeat(_u32(buf, starts + 6), blocks)
+
+    return (
+        _bitfield(words, fields["dataType"]),
+        _bitfield(words, fields["dataField"]),
+        ttag,
+    )
+
+
+def decode_esf(source, message="RAW", chunk_size=1 << 22):
+    """Decode the IMU data of ESF-RAW or ESF-MEAS messages in a UBX stream
+
+    Each data word is split in dataType and value and scaled according to
+    the imu_group table of the sensors db. Everything is computed on arrays
+    covering all the messages of a chunk.
+
+    Args:
+        source (str, bytes or np.ndarray): filename or data with the stream
+        message (str): either RAW or MEAS
+        chunk_size (int): number of bytes decoded at once
+
+    Return:
+        data (dict): for each channel in imu_group, a dictionary with the time
+                     tag (time) and the scaled value (value) of every sample
+    """
+
+    # The layout of the ESF messages is only in the sensors db
+    import porter.sensors.sensors_db.ublox as Udb
+
+    esf = Udb.esf_dict[message.upper()]
+
+    if message.upper() == "RAW":
+        unpack = _esf_raw
+    else:
+        unpack = _esf_meas
+
+    table = esf["aux"]["group"]["data"]
+    scales = _imu_scales(table)
+
+    types, values, ttags = [], [], []
+
+    for buf, starts, lengths in iter_frames(
+        source, Udb.esf_dict["char"], esf["char"], chunk_size=chunk_size
+    ):
+        data_type, value, ttag = unpack(buf, starts, lengths)
+        types.append(data_type)
+        values.append(value)
+        ttags.append(ttag)
+
+    if len(types) == 0:
+        return {}
+
+    types = np.concatenate(types)
+    values = np.concatenate(values) * scales[types]
+    ttags = np.concatenate(ttags)
+
+    data = {}
+    for key, entry in table.items():
+        if key == "ref_key":
+            continue
+
+        sel = types == int(key)
+        if np.any(sel):
+            data[entry["name"]] = {"time": ttags[sel], "value": values[sel]}
+
+    return data
@@ -1,8 +1,14 @@
-import copy
 import logging
+import math
 import threading
 import time
 
+import numpy as np
+
+import porter.journal as journal
+import porter.scan as scan
+import porter.sensors.metadata as metadata
+
 logger = logging.getLogger()
 
 class Sensors(threading.Thread):
@@ -39,6 +45,7 @@ class Sensors(threading.Thread):
         self.sensor_name = sensor_name
         
         name = path + self.sensor_name + "_" + date + ".bin"
+        self.filename = name
         try:
             self.datafile = open(name, "r+b")
         except FileNotFoundError:
@@ -54,11 +61,16 @@ class Sensors(threading.Thread):
         
         self.sensor_handler._configuration()
 
+        metadata.save(self.filename, self.sensor_handler._metadata())
+
         logging.info(f"Sensor {self.sensor_name} started")
         
         with self.datafile as binary:
             self.sensor_handler.obj.read_continous_binary(binary, self.shutdown_flag, self.sensor_lock)
 
+        # Save again the metadata with the timing collected during the run
+        metadata.save(self.filename, self.sensor_handler._metadata())
+
 class Camera(threading.Thread):
 
     def __init__(
@@ -70,6 +82,8 @@ class Camera(threading.Thread):
         fps=2,
         frames=None,
         duration=None,
+        chunk=30 * 60,
+        gap=0.0,
         *args,
         **kwargs,
     ):
@@ -83,6 +97,10 @@ class Camera(threading.Thread):
             fps (float): number of fps in case of photo mode
             frames (int): number of photo in case of photo mode
             duration (float): duration of the video in case of video mode
+            chunk (float): length in s of the segments of the video
+            gap (float): time in s between the stop of a segment and the
+                         start of the next one, as short as the camera
+                         allows
         """
 
         super().__init__(*args, **kwargs)
@@ -107,43 +125,190 @@ class Camera(threading.Thread):
         else:
             self.duration = 20 * 60
 
+        self.chunk = chunk
+        self.gap = gap
+
         self.shutdown_flag = flag
 
+    def _send(self, command, value=math.nan, event=None):
+        """Send a command to the camera and journal it with its round trip
+        time, which is returned. The event is the command by default."""
+
+        t0 = time.perf_counter()
+        self.camera.messageHandler([command])
+        elapsed = time.perf_counter() - t0
+
+        journal.event(event or command, self.camera_name, value, elapsed)
+
+        return elapsed
+
+    def _video(self):
+        """Record the video in segments of chunk seconds
+
+        The segments are cut at absolute times on the monotonic clock, so
+        their length does not drift with the time taken by the commands. The
+        next segment is started gap seconds after the previous one is
+        stopped, and the real gap, from sending the stop to the reply to the
+        start, is journaled with the start and stop of each segment. The
+        shutdown flag is set when the duration is reached.
+        """
+
+        start = time.monotonic()
+        end = start + self.duration
+
+        segment = 0
+        stopped = None
+        gaps = []
+
+        while not self.shutdown_flag.is_set():
+            if stopped is not None:
+                wait = stopped + self.gap - time.monotonic()
+                if wait > 0 and self.shutdown_flag.wait(wait):
+                    break
+
+            self._send("videocontrol", segment, event="video_start")
+
+            if stopped is not None:
+                gaps.append(time.monotonic() - stopped)
+                journal.event("video_gap", self.camera_name, gaps[-1], segment)
+
+            stop = min(start + (segment + 1) * self.chunk, end)
+
+            logging.info(f"RECORDING segment {segment} until {stop - start:.1f} s")
+
+            self.shutdown_flag.wait(max(stop - time.monotonic(), 0))
+
+            stopped = time.monotonic()
+            self._send("videocontrol", segment, event="video_stop")
+
+            segment += 1
+
+            if stop >= end:
+                logging.info("STOPPING")
+                self.shutdown_flag.set()
+
+        if len(gaps) > 0:
+            logging.info(
+                f"Camera {self.camera_name}: {segment} segments, gap between "
+                f"segments mean {np.mean(gaps):.3f} s max {np.max(gaps):.3f} s"
+            )
+
+    def _photos(self):
+        """Capture the photos on a fixed cadence
+
+        The captures are triggered at absolute deadlines on the monotonic
+        clock, so the cadence does not drift with the time each capture
+        takes. When a capture takes longer than the period, the slots that
+        passed are skipped and journaled. The latency of each trigger from
+        its deadline and the round trip time of the capture are journaled,
+        so that fps can be pushed up to what the camera sustains.
+        """
+
+        period = int(self.timing * 1e9)
+        start = time.monotonic_ns()
+
+        slot = 0
+        photo_count = 0
+        missed = 0
+        latency = []
+        elapsed = []
+
+        while photo_count < self.frames:
+            deadline = start + slot * period
+
+            wait = deadline - time.monotonic_ns()
+            if wait > 0 and self.shutdown_flag.wait(wait / 1e9):
+                break
+            if self.shutdown_flag.is_set():
+                break
+
+            latency.append((time.monotonic_ns() - deadline) / 1e9)
+            elapsed.append(self._send("capture", latency[-1]))
+            photo_count += 1
+
+            # First slot that is still in the future
+            slot += 1
+            late = (time.monotonic_ns() - start) // period + 1
+            if late > slot:
+                journal.event("capture_missed", self.camera_name, late - slot, slot)
+                logging.warning(
+                    f"Camera {self.camera_name}: capture {photo_count} took "
+                    f"{elapsed[-1]:.3f} s, skipped {late - slot} slots"
+                )
+                missed += late - slot
+                slot = late
+
+        if photo_count > 0:
+            logging.info(
+                f"Camera {self.camera_name}: {photo_count} photos, {missed} "
+                f"slots skipped, trigger latency mean {np.mean(latency):.4f} s "
+                f"max {np.max(latency):.4f} s, capture time mean "
+                f"{np.mean(elapsed):.3f} s max {np.max(elapsed):.3f} s"
+            )
+
     def run(self):
 
         logging.info(f"Camera {self.camera_name} started")
 
         if self.mode == "video":
-            flag = True
-            video_chunks = 30 * 60 
-            secs_remaining = copy.copy(self.duration)
-            while not self.shutdown_flag.is_set():
-                time.sleep(0.1)
-                self.camera.messageHandler(["videocontrol"])
-                if flag:
-                    if secs_remaining < video_chunks:
-                        logging.info(f"RECORDING {secs_remaining}")
-                        self.shutdown_flag.wait(secs_remaining)
-                        self.camera.messageHandler(["videocontrol"])
-                        self.shutdown_flag.set()
-                        flag = not flag
-                        logging.info("STOPPING")
-                        break
-                    else: 
-                        self.shutdown_flag.wait(video_chunks)
-                        self.camera.messageHandler(["videocontrol"])
-                        time.sleep(2)
-                        secs_remaining -= video_chunks
-                else:
-                    flag = not flag
+            self._video()
 
         elif self.mode == "photo":
-            photo_count = 0
-            while not self.shutdown_flag.is_set():
-                t = time.time()
-                self.camera.messageHandler(["capture"])
-                time.sleep(self.timing - (time.time() - t))
-
-                photo_count += 1
-                if photo_count > self.frames:
-                    break
+            self._photos()
+
+
+class Scan(threading.Thread):
+
+    def __init__(self, synt, handler, flag, config, filename, *args, **kwargs):
+        """Class to create a thread for a scan of the Valon
+
+        Parameters:
+            synt (valon.Valon): synthesizer
+            handler (sensors_handler.Handler): handler of the ADC, connected
+                                               by its own Sensors thread
+            flag (threading.Event): flag to communicate to the thread a
+                                    particular event happened
+            config (dict): start, stop and step of the frequency, power,
+                           settle and dwell time in s and mult_factor
+            filename (str): name of the spectrum table without extension
+        """
+
+        super().__init__(*args, **kwargs)
+
+        self.synt = synt
+        self.handler = handler
+        self.config = config
+        self.filename = filename
+
+        self.shutdown_flag = flag
+
+    def run(self):
+
+        # The ADC is connected when its thread starts
+        while not hasattr(self.handler, "obj"):
+            if self.shutdown_flag.wait(0.1):
+                return
+
+        steps = scan.sweep(
+            self.config["start"],
+            self.config["stop"],
+            self.config["step"],
+            self.config["power"],
+        )
+
+        logging.info(f"Scan of {len(steps)} steps started")
+
+        scan.Scan(
+            self.synt,
+            self.handler.obj,
+            settle=self.config.get("settle", 0.05),
+            dwell=self.config.get("dwell", 1.0),
+            mult_factor=self.config.get("mult_factor", 1),
+        ).run(
+            steps,
+            output=self.filename,
+            fmt=self.config.get("format", "csv"),
+            flag=self.shutdown_flag,
+        )
+
+        logging.info("Scan completed")
@@ -1,47 +1,182 @@
 import logging
+import math
+import re
 import time
 
 import serial
 
+import porter.journal as journal
+
 logger = logging.getLogger()
 
+# Prompt sent by the Valon when it is ready for a new command line
+PROMPT = b"-->"
+
+# Value and unit at the start of a reply, e.g. "F 1000 MHz; // Act 1000 MHz"
+REPLY = re.compile(
+    r"^\s*([A-Za-z]+)\s+([-+]?[0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?)\s*([A-Za-z]*)"
+)
+
+# Settings kept in the state cache
+STATE = ["f", "pwr", "amd", "amf"]
+
+# Unit of the cached frequencies
+FREQ_UNITS = {
+    "f": "mhz",
+    "amf": "hz",
+}
+
+# Frequency units in Hz
+UNITS = {
+    "hz": 1.0,
+    "khz": 1e3,
+    "mhz": 1e6,
+    "ghz": 1e9,
+}
+
 
 class Valon:
     """
     Interface to a valon synthetizer using a serial interface
     """
 
-    def __init__(self, port, baud):
+    def __init__(self, port, baud, timeout=1):
         """
         Parameters:
         - port: serial port for connection
         - baud: baudrate for the serial connection
+        - timeout: longest time in s to wait for the reply to a command line
         """
 
-        self.conn = serial.Serial(port, baud, timeout=1)
+        self.conn = serial.Serial(port, baud, timeout=timeout)
+
+        # Last value read from or set on the Valon for each command in STATE
+        self.state = {}
+        self.refresh()
 
     def send_receive(self, msg, receive=True):
         """
-        Send and receive a message through a serial connection
+        Send a command line and read the reply until the Valon prompt, so that
+        each command takes only as long as the Valon needs to execute it.
         Parameters:
-        - msg: Message to be sent (string)
-        - receive: if True, the reply from the serial connection will be returned
+        - msg: Message to be sent (string), several commands can be separated
+               by ";"
+        - receive: if True, the lines of the reply will be returned
         """
+
         self.conn.write(str.encode(msg))
 
+        resp = self.conn.read_until(expected=PROMPT)
+
+        if resp.endswith(PROMPT):
+            resp = resp[: -len(PROMPT)]
+        else:
+            logger.warning(f"Valon reply to {msg.strip()} timed out: {resp}")
+
+        logger.info(resp)
+
+        # The command line is echoed before the reply
+        lines = [
+            i.strip()
+            for i in resp.decode(errors="replace").splitlines()
+            if i.strip() and i.strip() != msg.strip()
+        ]
+
         if receive:
-            time.sleep(0.1)
+            return lines
 
-            resp_size = self.conn.inWaiting()
-            resp = self.conn.read(resp_size)
+    def send_commands(self, commands):
+        """
+        Send several commands in a single command line
+        Parameters:
+        - commands: list of commands without the terminator
+        Return the lines of the reply
+        """
 
-            logger.info(resp)
+        return self.send_receive("; ".join(commands) + "\r")
 
-            return resp.decode().splitlines()
+    def _parse(self, lines):
+        """
+        Parse the value of each reply line by command, with the frequency in
+        MHz and the modulation frequency in Hz
+        """
 
-        else:
-            if self.conn.inWaiting() > 0:
-                self.conn.reset_input_buffer()
+        values = {}
+
+        for line in lines:
+            match = REPLY.match(line)
+            if match is None:
+                continue
+
+            cmd = match.group(1).lower()
+            value = float(match.group(2))
+            unit = match.group(3).lower()
+
+            if cmd in FREQ_UNITS and unit in UNITS:
+                value *= UNITS[unit] / UNITS[FREQ_UNITS[cmd]]
+
+            values[cmd] = value
+
+        return values
+
+    def refresh(self, commands=STATE):
+        """
+        Read the settings of the Valon with a single command line and store
+        them in the state cache
+        Parameters:
+        - commands: settings to be read, by default all the cached ones
+        """
+
+        values = self._parse(self.send_commands([i + "?" for i in commands]))
+
+        for i in commands:
+            if i in values:
+                self.state[i] = values[i]
+            else:
+                self.state.pop(i, None)
+                logger.warning(f"No Valon reply to {i}?")
+
+    def _get(self, cmd, refresh):
+
+        if refresh or cmd not in self.state:
+            self.refresh([cmd])
+
+        if cmd not in self.state:
+            raise ValueError(f"Cannot read {cmd} from the Valon")
+
+        return self.state[cmd]
+
+    def _set(self, settings):
+        """
+        Send only the settings that differ from the state cache, in a single
+        command line, and update the cache with the values in the reply
+        Parameters:
+        - settings: dictionary with the value of each command
+        Return True if anything was sent
+        """
+
+        changed = {
+            i: j
+            for i, j in settings.items()
+            if i not in self.state or not math.isclose(self.state[i], float(j))
+        }
+
+        if len(changed) == 0:
+            return False
+
+        t0 = time.perf_counter()
+
+        values = self._parse(
+            self.send_commands([i + " " + str(j) for i, j in changed.items()])
+        )
+
+        elapsed = time.perf_counter() - t0
+
+        for i, j in changed.items():
+            self.state[i] = values.get(i, float(j))
+            journal.event("valon_" + i, "valon", self.state[i], elapsed)
+
+        return True
 
     def get_id(self):
         """
@@ -73,22 +208,16 @@ class Valon:
         - f: frequency in MHz
         """
 
-        msg = "f " + str(f) + "\r"
-        self.send_receive(msg, receive=True)
+        self._set({"f": f})
 
-    def get_freq(self):
+    def get_freq(self, refresh=False):
         """
         Get current frequency output of the Valon in MHz
+        Parameters:
+        - refresh: if True, the value is read from the Valon instead of the cache
         """
 
-        msg = "f?\r"
-
-        freq_raw = self.send_receive(msg)
-
-        # freq_raw = freq_raw[1].split('//')
-
-        # return float(freq_raw[1][4:-4])
-        return freq_raw
+        return self._get("f", refresh)
 
     def set_pwr(self, pwr):
         """
@@ -97,21 +226,28 @@ class Valon:
         - pwr: power in dBm
         """
 
-        msg = "pwr " + str(pwr) + "\r"
-        self.send_receive(msg, receive=True)
+        self._set({"pwr": pwr})
 
-    def get_pwr(self):
+    def get_pwr(self, refresh=False):
         """
         Get current power output of the Valon in dBm
+        Parameters:
+        - refresh: if True, the value is read from the Valon instead of the cache
         """
 
-        msg = "pwr?\r"
-        pwr_raw = self.send_receive(msg)
+        return self._get("pwr", refresh)
 
-        # pwr_raw = pwr_raw[1].split(';')
+    def set_freq_pwr(self, f, pwr):
+        """
+        Set the frequency and power output of the Valon with a single command
+        line, which is sent only if one of them changes. The Valon replies once
+        both are applied.
+        Parameters:
+        - f: frequency in MHz
+        - pwr: power in dBm
+        """
 
-        # return float(pwr_raw[0][4:])
-        return pwr_raw
+        self._set({"f": f, "pwr": pwr})
 
     def set_amd(self, amd_db, amd_f):
         """
@@ -122,37 +258,40 @@ class Valon:
         - amd_f: AM modulation in Hz. the range is from 0.5 Hz and 10kHz
         """
 
-        msg_db = "amd " + str(amd_db) + "\r"
-        self.send_receive(msg_db, receive=True)
-
-        msg_f = "amf " + str(amd_f) + "\r"
-        self.send_receive(msg_f, receive=True)
+        self._set({"amd": amd_db, "amf": amd_f})
 
-    def get_amd(self):
+    def get_amd(self, refresh=False):
         """
         Get current AM modulation output of the Valon in dB and the frequency modulation
         in hz
+        Parameters:
+        - refresh: if True, the values are read from the Valon instead of the cache
         """
-        # time.sleep(5)
 
-        msg_db = "amd?\r"
-        amd_raw_db = self.send_receive(msg_db)
-        # amd_raw_db = amd_raw_db[1]
+        if refresh:
+            self.refresh(["amd", "amf"])
+
+        return self._get("amd", False), self._get("amf", False)
 
-        msg_f = "amf?\r"
-        amd_raw_f = self.send_receive(msg_f)
-        # amd_raw_f = amd_raw_f[1]
+    def setup(self, f, pwr, amd_db=0, amd_f=0):
+        """
+        Set frequency, power and AM modulation with a single command line,
+        which is sent only if some of them change
+        Parameters:
+        - f: frequency in MHz
+        - pwr: power in dBm
+        - amd_db: AM modulation in dB, 0 to turn it off
+        - amd_f: AM modulation frequency in Hz
+        """
 
-        # return float(amd_raw_db[4:-3]), float(amd_raw_f[3:-3])*1000
-        return amd_raw_db, amd_raw_f
+        self._set({"f": f, "pwr": pwr, "amd": amd_db, "amf": amd_f})
 
     def stop_amd(self):
         """
         Stop the AM modulation mode
         """
 
-        msg_db = "amd " + str(0) + "\r"
-        self.send_receive(msg_db, receive=True)
+        self._set({"amd": 0})
 
     def mode_sweep(
         self, start_freq, stop_freq, step, rate, rtime, halt=False, halt_time=100
@@ -163,7 +302,8 @@ class Valon:
             with frequency step size (in Mhz), step rate (in ms) and retrace time (ms)
             (retrace time sets a dweel interval of 0ms overt 100 s before to start
             a new sweep )
-            halt= stops sweeping
+            halt= stops sweeping after halt_time s
+        For a sweep synchronized with the ADC data see porter.scan
         """
 
         msg_sweep = "MOD SWE " + "\r"
@@ -181,21 +321,25 @@ class Valon:
         msg_rate = "RATE " + str(rate) + "\r"
         self.send_receive(msg_rate, receive=False)
 
-        msg_rtime = "RTIME " + str(time) + "\r"
+        msg_rtime = "RTIME " + str(rtime) + "\r"
         self.send_receive(msg_rtime, receive=False)
 
-        t = time.time()
+        t = time.monotonic()
 
         msg_run = "run " + "\r"
         self.send_receive(msg_run, receive=False)
+
+        journal.event("valon_sweep", "valon", start_freq, stop_freq)
+
+        # The frequency is changed by the sweep
+        self.state.pop("f", None)
         if halt:
-            while True:
-                if time.time() - t > halt_time:
-                    msg_halt = "halt " + "\r"
-                    self.send_receive(msg_halt, receive=False)
-                    msg_modecw = "MOD CW " + "\r"
-                    self.send_receive(msg_modecw, receive=False)
-                    break
+            time.sleep(max(0, halt_time - (time.monotonic() - t)))
+
+            msg_halt = "halt " + "\r"
+            self.send_receive(msg_halt, receive=False)
+            msg_modecw = "MOD CW " + "\r"
+            self.send_receive(msg_modecw, receive=False)
 
     def close_connection(self, valon_off=False):
         """
@@ -209,4 +353,5 @@ class Valon:
             msg = "pdn OFF\r"
             self.send_receive(msg, receive=False)
 
+        self.state = {}
         self.conn.close()
@@ -0,0 +1,475 @@
+import glob
+import os
+
+import numpy as np
+import yaml
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ModuleNotFoundError:
+    pa = None
+
+# Key of the schema metadata with the sensor information in Parquet files
+PARQUET_METADATA_KEY = b"porter"
+
+# Fixed size of the header of the .npy files, so that it can be rewritten in
+# place with the final number of rows
+NPY_HEADER_SIZE = 128
+
+# Number of files of a Parquet dataset above which the newest ones are merged
+PARQUET_MAX_PARTS = 16
+
+# Number of rows of the row groups of the merged Parquet files
+PARQUET_ROW_GROUP = 1 << 20
+
+
+def _npy_header(dtype, count):
+
+    header = {
+        "descr": np.lib.format.dtype_to_descr(dtype),
+        "fortran_order": False,
+        "shape": (count,),
+    }
+    header = repr(header).encode("latin1")
+
+    size = NPY_HEADER_SIZE - len(np.lib.format.MAGIC_PREFIX) - 4
+    header = header + b" " * (size - len(header) - 1) + b"\n"
+
+    return np.lib.format.magic(1, 0) + len(header).to_bytes(2, "little") + header
+
+
+def _npy_column(name, values):
+    """Array of a column that can be saved in a .npy file
+
+    The columns of Python objects, e.g. the fields missing from some
+    messages, are converted to float with NaN in place of None.
+    """
+
+    data = np.asarray(values)
+
+    if data.dtype.kind != "O":
+        return data
+
+    values = data.tolist()
+    missing = any(i is None for i in values)
+    if missing:
+        values = [np.nan if i is None else i for i in values]
+
+    try:
+        data = np.array(values, dtype=np.float64 if missing else None)
+    except (TypeError, ValueError):
+        data = None
+
+    if data is None or data.dtype.kind == "O":
+        raise ValueError(
+            f"Column {name} cannot be saved in a .npy file, only numbers, "
+            "strings and None are supported"
+        )
+
+    return data
+
+
+def _parquet_parts(path):
+
+    return sorted(glob.glob(path + "/part-*.parquet"))
+
+
+class CsvWriter:
+
+    def __init__(self, filename, metadata=None, append=False):
+        """Write columns to a CSV file chunk by chunk
+
+        Parameters:
+            filename (str): name of the output file without extension
+            metadata (dict): not used, the metadata of the sensor are
+                             available in its own metadata file
+            append (bool): if True, the chunks are added to an existing file
+        """
+
+        self.filename = filename + ".csv"
+
+        # Columns of the file, checked against the ones of each chunk
+        self._names = None
+        if append and os.path.exists(self.filename):
+            self._names = read_columns(filename, "csv")
+
+        self._header = self._names is None
+        self._fd = open(self.filename, "a" if append else "w")
+
+    def write(self, columns):
+
+        names = list(columns.keys())
+        arrays = [np.asarray(columns[i]) for i in names]
+
+        if self._names is not None and names != self._names:
+            raise ValueError(
+                f"Columns different from the header of {self.filename}: "
+                + ", ".join(names)
+            )
+        self._names = names
+
+        if len({len(i) for i in arrays}) > 1:
+            raise ValueError(
+                f"Columns of different lengths for {self.filename}: "
+                + ", ".join(f"{i} {len(j)}" for i, j in zip(names, arrays))
+            )
+
+        if self._header:
+            self._fd.write(",".join(names) + "\n")
+            self._header = False
+
+        if len(arrays) == 0 or len(arrays[0]) == 0:
+            return
+
+        # Each column is formatted at once, the floats with the shortest
+        # representation of Python, and the chunk is written in a single call
+        text = []
+        for i in arrays:
+            if i.dtype.kind in "fSVO":
+                text.append(list(map(str, i.tolist())))
+            else:
+                text.append(i.astype(str).tolist())
+
+        self._fd.write("\n".join(map(",".join, zip(*text))) + "\n")
+
+    def close(self):
+
+        self._fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class NpyWriter:
+
+    def __init__(self, filename, metadata=None, append=False):
+        """Write each column to its own .npy file, chunk by chunk
+
+        The columns are saved in a folder with one .npy file for each of them,
+        which can be memory mapped with np.load(..., mmap_mode="r"). The data
+        are appended to the files and the headers are updated with the number
+        of rows when the writer is closed. The columns with None are saved as
+        float with NaN, and a column is converted to a wider type if a later
+        chunk does not fit in the type saved, e.g. integers and then NaN.
+
+        Parameters:
+            filename (str): name of the output folder
+            metadata (dict): saved in the folder as metadata.yml
+            append (bool): if True, the chunks are added to existing columns
+        """
+
+        self.filename = filename
+        self.append = append
+
+        if not os.path.exists(self.filename):
+            os.mkdir(self.filename)
+
+        if metadata:
+            with open(self.filename + "/metadata.yml", "w") as fd:
+                yaml.safe_dump(metadata, fd, sort_keys=False)
+
+        self._files = {}
+
+    def _open(self, name, dtype):
+
+        path = self.filename + "/" + name + ".npy"
+
+        if self.append and os.path.exists(path):
+            fd = open(path, "r+b")
+            np.lib.format.read_magic(fd)
+            shape, _, dtype = np.lib.format.read_array_header_1_0(fd)
+            count = shape[0]
+            fd.seek(0, os.SEEK_END)
+        else:
+            fd = open(path, "w+b")
+            count = 0
+            fd.write(_npy_header(dtype, count))
+
+        self._files[name] = [fd, dtype, count]
+
+    def _promote(self, name, dtype):
+
+        fd, saved, count = self._files[name]
+
+        if (saved.kind in "SU") != (dtype.kind in "SU"):
+            raise ValueError(
+                f"Column {name} of {self.filename} changed from {saved} to {dtype}"
+            )
+
+        dtype = np.promote_types(saved, dtype)
+
+        # The rows already saved are converted to a new file, chunk by chunk
+        path = self.filename + "/" + name + ".npy"
+        with open(path + ".tmp", "wb") as tmp:
+            tmp.write(_npy_header(dtype, count))
+
+            fd.seek(NPY_HEADER_SIZE)
+            for i in range(0, count, 1 << 20):
+                rows = min(1 << 20, count - i)
+                data = np.frombuffer(fd.read(rows * saved.itemsize), dtype=saved)
+                tmp.write(data.astype(dtype).tobytes())
+
+        fd.close()
+        os.replace(path + ".tmp", path)
+
+        fd = open(path, "r+b")
+        fd.seek(0, os.SEEK_END)
+
+        self._files[name] = [fd, dtype, count]
+
+    def write(self, columns):
+
+        for name in columns.keys():
+            data = _npy_column(name, columns[name])
+
+            if name not in self._files:
+                self._open(name, data.dtype)
+
+            if not np.can_cast(data.dtype, self._files[name][1], "safe"):
+                self._promote(name, data.dtype)
+
+            fd, dtype, count = self._files[name]
+
+            data = np.ascontiguousarray(data, dtype=dtype)
+            fd.write(data.tobytes())
+
+            self._files[name][2] = count + data.size
+
+    def close(self):
+
+        for fd, dtype, count in self._files.values():
+            fd.seek(0)
+            fd.write(_npy_header(dtype, count))
+            fd.close()
+
+        self._files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ParquetWriter:
+
+    def __init__(self, filename, metadata=None, append=False):
+        """Write columns to a Parquet dataset, one row group for each chunk
+
+        The output is a folder with the extension .parquet and numbered
+        part-*.parquet files, which can be read at once in the order of the
+        names with pyarrow.parquet.read_table(folder) or
+        pandas.read_parquet(folder). Since Parquet files cannot be extended,
+        in append mode each writer adds a new file and the newest files are
+        merged when they are more than PARQUET_MAX_PARTS, so that decoding a
+        run while it is written does not leave thousands of small files.
+
+        The columns keep their native types, the ones without any value in
+        the first chunk are saved as float, and the metadata are saved as
+        YAML in the schema. A file is written with a hidden name and renamed
+        when closed, so the readers never see it incomplete.
+
+        Parameters:
+            filename (str): name of the output folder without extension
+            metadata (dict): sensor and configuration information
+            append (bool): if True, the chunks are added to the dataset
+        """
+
+        if pa is None:
+            raise ModuleNotFoundError("pyarrow is required for the Parquet output")
+
+        self.path = filename + ".parquet"
+        self.append = append
+
+        if not os.path.exists(self.path):
+            os.mkdir(self.path)
+
+        parts = _parquet_parts(self.path)
+
+        # Schema of the dataset, the new chunks are converted to it
+        self._schema = None
+        if append and len(parts) > 0:
+            self._schema = pq.read_schema(parts[-1])
+        else:
+            for i in parts:
+                os.remove(i)
+            parts = []
+
+        self.metadata = metadata
+
+        self.filename = self._part(parts)
+        self._writer = None
+
+    def _part(self, parts):
+
+        number = int(os.path.basename(parts[-1])[5:-8]) + 1 if parts else 0
+
+        return self.path + "/part-" + str(number).zfill(6) + ".parquet"
+
+    def _hidden(self, filename):
+
+        return os.path.dirname(filename) + "/." + os.path.basename(filename)
+
+    def write(self, columns):
+
+        table = pa.table({i: np.asarray(columns[i]) for i in columns.keys()})
+
+        if self._writer is None:
+            schema = self._schema
+            if schema is None:
+                schema = pa.schema(
+                    [
+                        (
+                            pa.field(i.name, pa.float64())
+                            if pa.types.is_null(i.type)
+                            else i
+                        )
+                        for i in table.schema
+                    ]
+                )
+            if self.metadata:
+                schema = schema.with_metadata(
+                    {PARQUET_METADATA_KEY: yaml.safe_dump(self.metadata)}
+                )
+            self._writer = pq.ParquetWriter(self._hidden(self.filename), schema)
+
+        try:
+            table = table.cast(self._writer.schema)
+        except (ValueError, pa.ArrowInvalid, pa.ArrowNotImplementedError) as err:
+            raise ValueError(
+                f"Chunk not compatible with the columns of {self.path}: {err}"
+            ) from None
+
+        self._writer.write_table(table)
+
+    def _compact(self):
+        """Merge the newest files of the dataset
+
+        The files are merged from the newest one while they are not larger
+        than the newer ones together, so that each row is rewritten only a
+        few times however long the dataset is followed.
+        """
+
+        parts = _parquet_parts(self.path)
+
+        merged = [parts[-1]]
+        size = os.path.getsize(parts[-1])
+        for i in parts[-2::-1]:
+            if os.path.getsize(i) > size:
+                break
+            merged.insert(0, i)
+            size += os.path.getsize(i)
+
+        filename = self._part(parts)
+
+        with pq.ParquetWriter(
+            self._hidden(filename), pq.read_schema(parts[-1])
+        ) as writer:
+            batches, rows = [], 0
+            for i in merged:
+                for batch in pq.ParquetFile(i).iter_batches():
+                    batches.append(batch)
+                    rows += batch.num_rows
+                    if rows >= PARQUET_ROW_GROUP:
+                        writer.write_table(pa.Table.from_batches(batches))
+                        batches, rows = [], 0
+            if len(batches) > 0:
+                writer.write_table(pa.Table.from_batches(batches))
+
+        os.replace(self._hidden(filename), filename)
+
+        for i in merged:
+            os.remove(i)
+
+    def close(self):
+
+        if self._writer is None:
+            return
+
+        self._writer.close()
+        self._writer = None
+
+        os.replace(self._hidden(self.filename), self.filename)
+
+        if self.append and len(_parquet_parts(self.path)) > PARQUET_MAX_PARTS:
+            self._compact()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_parquet_metadata(filename):
+    """Return the sensor metadata saved in a Parquet dataset"""
+
+    parts = _parquet_parts(filename)
+
+    if len(parts) == 0:
+        return {}
+
+    schema = pq.read_schema(parts[-1])
+
+    if schema.metadata is None or PARQUET_METADATA_KEY not in schema.metadata:
+        return {}
+
+    return yaml.safe_load(schema.metadata[PARQUET_METADATA_KEY])
+
+
+def read_columns(filename, fmt):
+    """Names of the columns of an existing output
+
+    Args:
+        filename (str): name of the output without extension
+        fmt (str): output format, one of WRITERS
+
+    Return:
+        columns (list): names of the columns, None if there is no output
+    """
+
+    if fmt == "csv":
+        if not os.path.exists(filename + ".csv"):
+            return None
+        with open(filename + ".csv") as fd:
+            header = fd.readline().rstrip("\n")
+        return header.split(",") if header else None
+
+    if fmt == "npy":
+        if not os.path.isdir(filename):
+            return None
+        return sorted(i[:-4] for i in os.listdir(filename) if i.endswith(".npy"))
+
+    parts = _parquet_parts(filename + ".parquet")
+    if len(parts) == 0:
+        return None
+
+    return pq.read_schema(parts[-1]).names
+
+
+WRITERS = {
+    "csv": CsvWriter,
+    "npy": NpyWriter,
+    "parquet": ParquetWriter,
+}
+
+
+def open_writer(filename, fmt="npy", metadata=None, append=False):
+    """Open a writer for decoded data
+
+    Args:
+        filename (str): name of the output without extension
+        fmt (str): output format, one of WRITERS
+        metadata (dict): sensor and configuration information
+        append (bool): if True, the data are added to an existing output
+
+    Return:
+        writer: object with write(columns) and close() methods, where columns
+                is a dictionary with an array for each column
+    """
+
+    return WRITERS[fmt](filename, metadata=metadata, append=append)